@@ -5,26 +5,44 @@ Top level script. Calls other functions that generate datasets that this script
 """
 
 import logging
+import sys
 from copy import deepcopy
-from os.path import expanduser, join
+from functools import partial
+from os import getenv
+from os.path import dirname, exists, expanduser, join
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
 
+from dateutil.relativedelta import relativedelta
 from slugify import slugify
 
-from hdx.api.configuration import Configuration
-from hdx.api.utilities.hdx_state import HDXState
-from hdx.data.dataset import Dataset
-from hdx.data.user import User
-from hdx.facades.infer_arguments import facade
 from hdx.scraper.wfp.hungermap._version import __version__
-from hdx.scraper.wfp.hungermap.pipeline import Pipeline
-from hdx.utilities.dateparse import now_utc
+from hdx.scraper.wfp.hungermap.backfill import Backfill
+from hdx.scraper.wfp.hungermap.cache import ResponseCache
+from hdx.scraper.wfp.hungermap.fetch import Fetcher
+from hdx.scraper.wfp.hungermap.instrumentation import Instrumentation, profiler
+from hdx.scraper.wfp.hungermap.pipeline import (
+    Pipeline,
+    record_hxltags,
+    write_country,
+)
+from hdx.scraper.wfp.hungermap.state import (
+    dict_to_state_str,
+    get_content_hash,
+    remove_unpublished_countries,
+    state_str_to_dict,
+)
+from hdx.scraper.wfp.hungermap.store import ObservationStore
+from hdx.utilities.dateparse import now_utc, parse_date
 from hdx.utilities.downloader import Download
+from hdx.utilities.loader import load_text
 from hdx.utilities.path import (
-    progress_storing_folder,
+    NotFoundError,
+    get_wheretostart,
     script_dir_plus_file,
     wheretostart_tempdir_batch,
 )
 from hdx.utilities.retriever import Retrieve
+from hdx.utilities.saver import save_text
 
 logger = logging.getLogger(__name__)
 
@@ -32,17 +50,156 @@ lookup = "hdx-scraper-wfp-hungermap"
 updated_by_script = "HDX Scraper: WFP HungerMap"
 
 
-def main(save: bool = False, use_saved: bool = False) -> None:
+def process_countries(
+    info: Dict,
+    countries: List[Dict],
+    process_country: Callable[[str], Any],
+    workers: int = 1,
+    stages: Sequence[Tuple[Callable[[Any], Any], int, bool]] = (),
+) -> Iterator[Any]:
+    """Call process_country on the iso3 of each country using up to workers
+    threads, yielding results in the order of countries. The result for each
+    country can be passed through further stages, each of which is a function
+    called with the result of the previous stage, a number of workers and
+    whether the workers are processes rather than threads. Stages overlap
+    across countries and each holds at most its number of workers' countries
+    so a slow stage holds back earlier ones. Progress is stored in the same
+    way as progress_storing_folder, but is only advanced once a country has
+    finished the last stage so that an interrupted or failed run resumes from
+    the earliest country not yet finished without skipping any.
+
+    Args:
+        info (Dict): Dictionary containing folder and batch
+        countries (List[Dict]): Countries in the form {"iso3": iso3}
+        process_country (Callable[[str], Any]): Function to call with iso3
+        workers (int): Number of countries to process in parallel. Defaults to 1.
+        stages (Sequence[Tuple[Callable[[Any], Any], int, bool]]): Further stages as (function, workers, processes). Defaults to ().
+
+    Returns:
+        Iterator[Any]: Results of process_country or the last stage in order
+    """
+    progress_file = join(info["folder"], "progress.txt")
+    contents = getenv("WHERETOSTART")
+    if contents:
+        wheretostart = get_wheretostart(contents, "Environment variable", "iso3")
+    elif exists(progress_file):
+        contents = load_text(progress_file, strip=True)
+        wheretostart = get_wheretostart(contents, "File", "iso3")
+    else:
+        wheretostart = None
+    countryiso3s = [countryinfo["iso3"] for countryinfo in countries]
+    if wheretostart == "IGNORE":
+        return
+    if wheretostart:
+        if wheretostart not in countryiso3s:
+            raise NotFoundError(
+                f"WHERETOSTART ({wheretostart}) not matched in iterator with key iso3 and no run started!"
+            )
+        logger.info(f"Starting run from WHERETOSTART {wheretostart}")
+        countryiso3s = countryiso3s[countryiso3s.index(wheretostart) :]
+    if not countryiso3s:
+        return
+    info["progress"] = f"iso3={countryiso3s[0]}"
+    save_text(info["progress"], progress_file)
+
+    results = Fetcher.imap(process_country, iter(countryiso3s), workers)
+    for function, stage_workers, processes in stages:
+        results = Fetcher.imap(function, results, stage_workers, processes)
+    for finished, result in enumerate(results, start=1):
+        if finished < len(countryiso3s):
+            info["progress"] = f"iso3={countryiso3s[finished]}"
+            save_text(info["progress"], progress_file)
+        yield result
+
+
+def create_dataset(
+    countryiso3: str,
+    dataset: Any,
+    showcase: Optional[Any],
+    bites_disabled: Tuple[bool, bool, bool],
+    hashes: Dict[str, str],
+    batch: str,
+    instrumentation: Instrumentation,
+    skip_unchanged: bool = False,
+) -> bool:
+    """Create a dataset and its showcase in HDX unless skip_unchanged is True
+    and the hash of its content is the one in hashes from when it was last
+    created. The hash is updated after creating it.
+
+    Args:
+        countryiso3 (str): Country ISO3 code
+        dataset (Dataset): Dataset
+        showcase (Optional[Showcase]): Showcase
+        bites_disabled (Tuple[bool, bool, bool]): Disabled quickchart bites
+        hashes (Dict[str, str]): Content hashes by ISO3 code
+        batch (str): Batch for creating in HDX
+        instrumentation (Instrumentation): Instrumentation
+        skip_unchanged (bool): Skip datasets that are unchanged. Defaults to False.
+
+    Returns:
+        bool: Whether the dataset was created
+    """
+    with instrumentation.stage("hash", countryiso3):
+        content_hash = get_content_hash(dataset, showcase, bites_disabled)
+    if skip_unchanged and hashes.get(countryiso3) == content_hash:
+        logger.info(f"Skipping unchanged {dataset['name']}")
+        return False
+    with instrumentation.stage("quickcharts", countryiso3):
+        dataset.generate_quickcharts(
+            bites_disabled=bites_disabled,
+            path=script_dir_plus_file(
+                join("config", "hdx_resource_view_static.yaml"), main
+            ),
+        )
+    with instrumentation.stage("create_in_hdx", countryiso3):
+        dataset.create_in_hdx(
+            remove_additional_resources=True,
+            hxl_update=False,
+            updated_by_script=updated_by_script,
+            batch=batch,
+        )
+        if showcase:
+            showcase.create_in_hdx()
+            showcase.add_dataset(dataset)
+    hashes[countryiso3] = content_hash
+    return True
+
+
+def main(
+    save: bool = False,
+    use_saved: bool = False,
+    workers: int = 1,
+    profile: Optional[str] = None,
+    rebuild: bool = False,
+    backfill_from: Optional[str] = None,
+    backfill_to: Optional[str] = None,
+    backfill_countries: Optional[str] = None,
+    cleanup_dry_run: bool = False,
+) -> None:
     """Generate datasets and create them in HDX
 
     Args:
         save (bool): Save downloaded data. Defaults to False.
         use_saved (bool): Use saved data. Defaults to False.
+        workers (int): Number of countries to fetch in parallel. Defaults to 1.
+        profile (Optional[str]): Profile run with cprofile or pyinstrument. Defaults to None.
+        rebuild (bool): Rebuild datasets from the local store without requesting the API. Defaults to False.
+        backfill_from (Optional[str]): Fetch history from this date into the store and rebuild datasets. Defaults to None.
+        backfill_to (Optional[str]): Last date to backfill. Defaults to None (yesterday).
+        backfill_countries (Optional[str]): Comma separated ISO3 codes to backfill. Defaults to None (all).
+        cleanup_dry_run (bool): Only report stale datasets rather than deleting them. Defaults to False.
 
     Returns:
         None
     """
 
+    # The HDX API client and data model are slow to import so are only
+    # imported when datasets are to be created
+    from hdx.api.configuration import Configuration
+    from hdx.api.utilities.hdx_state import HDXState
+    from hdx.data.user import User
+    from hdx.scraper.wfp.hungermap.cleanup import StaleDatasetCleanup
+
     logger.info(f"##### {lookup} version {__version__} ####")
     configuration = Configuration.read()
     User.check_current_user_write_access(
@@ -53,76 +210,281 @@ def main(save: bool = False, use_saved: bool = False) -> None:
         with HDXState(
             "pipeline-state-wfp-hungermap",
             folder,
-            HDXState.dates_str_to_country_date_dict,
-            HDXState.country_date_dict_to_dates_str,
+            state_str_to_dict,
+            dict_to_state_str,
             configuration,
         ) as state:
-            state_dict = deepcopy(state.get())
-            with Download(rate_limit={"calls": 1, "period": 0.1}) as downloader:
+            state_dict = deepcopy(state.get()["dates"])
+            hashes = dict(state.get()["hashes"])
+            skip_unchanged = configuration.get("skip_unchanged", False)
+            unchanged = []
+            # The Fetcher does any retrying
+            download_kwargs = Fetcher.get_download_kwargs(configuration.get("retry"))
+            with Download(**download_kwargs) as downloader:
                 retriever = Retrieve(
                     downloader, folder, "saved_data", folder, save, use_saved
                 )
                 today = now_utc()
-                pipeline = Pipeline(configuration, retriever, folder, today)
-                countries = pipeline.get_country_data(state_dict)
-                logger.info(f"Number of datasets: {len(countries)}")
-                for _, countryinfo in progress_storing_folder(info, countries, "iso3"):
-                    countryiso3 = countryinfo["iso3"]
-                    rows, earliest_date, latest_date, has_subnational = (
-                        pipeline.get_rows(countryiso3)
+                cache_configuration = configuration.get("response_cache")
+                if cache_configuration and not use_saved:
+                    cache = ResponseCache(
+                        expanduser(cache_configuration["folder"]),
+                        today,
+                        cache_configuration.get("max_size_mb", 512),
+                        cache_configuration.get("closed_ttl_days", 365),
+                        cache_configuration.get("open_ttl_days", 0),
+                        cache_configuration.get("closed_grace_days", 7),
                     )
-                    (
-                        dataset,
-                        showcase,
-                        bites_disabled,
-                    ) = pipeline.generate_dataset_and_showcase(
-                        countryiso3, rows, earliest_date, latest_date, has_subnational
+                else:
+                    cache = None
+                store_configuration = configuration.get("store")
+                if store_configuration:
+                    store = ObservationStore(
+                        expanduser(store_configuration["path"]), record_hxltags
                     )
-                    if not dataset:
-                        continue
-                    dataset.update_from_yaml(
-                        script_dir_plus_file(
-                            join("config", "hdx_dataset_static.yaml"), main
-                        )
-                    )
-                    # ensure markdown has line breaks
-                    dataset["notes"] = dataset["notes"].replace("\n", "  \n")
-
-                    dataset.generate_quickcharts(
-                        bites_disabled=bites_disabled,
-                        path=script_dir_plus_file(
-                            join("config", "hdx_resource_view_static.yaml"), main
-                        ),
-                    )
-                    dataset.create_in_hdx(
-                        remove_additional_resources=True,
-                        hxl_update=False,
-                        updated_by_script=updated_by_script,
-                        batch=info["batch"],
+                elif rebuild or backfill_from:
+                    raise ValueError(
+                        "Rebuilding or backfilling needs a store in the configuration!"
                     )
-                    if showcase:
-                        showcase.create_in_hdx()
-                        showcase.add_dataset(dataset)
-
-                dataset_name_prefix = slugify(pipeline.dataset_name_prefix)
-                for dataset in Dataset.search_in_hdx(fq="organization:wfp"):
-                    name = dataset["name"]
-                    if name.startswith(dataset_name_prefix):
-                        if (
-                            dataset.get_location_iso3s()[0]
-                            not in pipeline.get_shared_countries()
+                else:
+                    store = None
+                instrumentation = Instrumentation()
+                pipeline = Pipeline(
+                    configuration,
+                    retriever,
+                    folder,
+                    today,
+                    cache,
+                    instrumentation,
+                    store,
+                )
+                report_folder = expanduser(
+                    configuration.get("instrumentation_folder", folder)
+                )
+                # Datasets are generated from the store without the usual fetching
+                from_store = rebuild or bool(backfill_from)
+                history_months = None
+                try:
+                    with profiler(profile, report_folder):
+                        if backfill_from:
+                            with instrumentation.stage("backfill"):
+                                start_date = parse_date(backfill_from)
+                                if backfill_to:
+                                    end_date = parse_date(backfill_to)
+                                else:
+                                    end_date = today - relativedelta(days=1)
+                                if backfill_countries:
+                                    countryiso3s = backfill_countries.split(",")
+                                else:
+                                    countryiso3s = None
+                                backfill = Backfill(
+                                    pipeline,
+                                    join(
+                                        dirname(store.path), "backfill_checkpoint.json"
+                                    ),
+                                    configuration.get("backfill_concurrency", 4),
+                                )
+                                results = backfill.run(
+                                    start_date, end_date, countryiso3s
+                                )
+                            # Datasets cover at least the backfilled range
+                            months_ago = relativedelta(today, start_date)
+                            backfill_months = (
+                                months_ago.years * 12 + months_ago.months + 1
+                            )
+                            history_months = pipeline.get_history_months()
+                            if backfill_months > history_months:
+                                logger.warning(
+                                    f"Backfilled history older than {history_months} months will be left out of datasets by the next run. Increase history_months of store to keep it."
+                                )
+                                history_months = backfill_months
+                        with instrumentation.stage("national"):
+                            if from_store:
+                                # Countries without rows in the window would
+                                # get datasets without resources
+                                countryiso3s = pipeline.get_store_countries(
+                                    history_months
+                                )
+                                if backfill_from:
+                                    backfilled = set(results["countries"])
+                                    countryiso3s = [
+                                        countryiso3
+                                        for countryiso3 in countryiso3s
+                                        if countryiso3 in backfilled
+                                    ]
+                                pipeline.shared_countries.update(countryiso3s)
+                                countries = [
+                                    {"iso3": countryiso3}
+                                    for countryiso3 in countryiso3s
+                                ]
+                            else:
+                                countries = pipeline.get_country_data(
+                                    state_dict,
+                                    incremental=configuration.get(
+                                        "national_incremental", False
+                                    ),
+                                )
+                        logger.info(f"Number of datasets: {len(countries)}")
+
+                        # Countries go through three stages which overlap
+                        # across countries: fetching in threads, writing files
+                        # in worker processes and uploading in threads
+                        def fetch_country(countryiso3):
+                            with instrumentation.stage("subnational", countryiso3):
+                                if from_store:
+                                    rows_info = pipeline.get_rows_from_store(
+                                        countryiso3, history_months
+                                    )
+                                else:
+                                    rows_info = pipeline.get_rows(
+                                        countryiso3,
+                                        incremental=configuration.get(
+                                            "subnational_incremental", False
+                                        ),
+                                    )
+                            return (countryiso3, *rows_info)
+
+                        def upload_country(country):
+                            (
+                                countryiso3,
+                                results,
+                                earliest_date,
+                                latest_date,
+                                has_subnational,
+                                seconds,
+                            ) = country
+                            instrumentation.add_stage_time("csv", seconds, countryiso3)
+                            with instrumentation.stage("dataset", countryiso3):
+                                (
+                                    dataset,
+                                    showcase,
+                                    bites_disabled,
+                                ) = pipeline.generate_dataset_and_showcase(
+                                    countryiso3,
+                                    None,
+                                    earliest_date,
+                                    latest_date,
+                                    has_subnational,
+                                    results,
+                                )
+                            if not dataset:
+                                return countryiso3
+                            dataset.update_from_yaml(
+                                script_dir_plus_file(
+                                    join("config", "hdx_dataset_static.yaml"), main
+                                )
+                            )
+                            # ensure markdown has line breaks
+                            dataset["notes"] = dataset["notes"].replace("\n", "  \n")
+
+                            # Only rebuilding or backfilling can generate a
+                            # dataset that is unchanged: in daily runs, every
+                            # country returned has a new national row
+                            if not create_dataset(
+                                countryiso3,
+                                dataset,
+                                showcase,
+                                bites_disabled,
+                                hashes,
+                                info["batch"],
+                                instrumentation,
+                                skip_unchanged and from_store,
+                            ):
+                                unchanged.append(countryiso3)
+                            return countryiso3
+
+                        write_stage = partial(
+                            write_country,
+                            folder,
+                            pipeline.previous_folder,
+                            configuration.get("parquet", False),
+                        )
+                        stages = (
+                            (write_stage, configuration.get("csv_processes", 1), True),
+                            (
+                                upload_country,
+                                configuration.get("upload_concurrency", 1),
+                                False,
+                            ),
+                        )
+                        for _ in process_countries(
+                            info, countries, fetch_country, workers, stages
                         ):
-                            logger.info(f"Deleting {name}!")
-                            dataset.delete_from_hdx()
-            state.set(state_dict)
+                            pass
+                        if unchanged:
+                            logger.info(
+                                f"Skipped {len(unchanged)} unchanged datasets: {', '.join(unchanged)}"
+                            )
+                        pipeline.write_summaries(
+                            join(report_folder, "country_summaries.json")
+                        )
+
+                        if configuration.get("global_dataset", False):
+                            with instrumentation.stage("global"):
+                                dataset = pipeline.generate_global_dataset(
+                                    pipeline.get_shared_countries()
+                                )
+                                if dataset:
+                                    dataset.update_from_yaml(
+                                        script_dir_plus_file(
+                                            join("config", "hdx_dataset_static.yaml"),
+                                            main,
+                                        )
+                                    )
+                                    dataset["notes"] = dataset["notes"].replace(
+                                        "\n", "  \n"
+                                    )
+                                    dataset.create_in_hdx(
+                                        remove_additional_resources=True,
+                                        hxl_update=False,
+                                        updated_by_script=updated_by_script,
+                                        batch=info["batch"],
+                                    )
+
+                        # Which countries are still published is only known from the API
+                        if not from_store:
+                            with instrumentation.stage("delete stale datasets"):
+                                cleanup = StaleDatasetCleanup(
+                                    slugify(pipeline.dataset_name_prefix),
+                                    configuration=configuration,
+                                    workers=configuration.get("cleanup_concurrency", 4),
+                                    dry_run=cleanup_dry_run,
+                                )
+                                report = cleanup.run(pipeline.get_shared_countries())
+                                if not cleanup_dry_run:
+                                    for countryiso3 in report["deleted countries"]:
+                                        hashes.pop(countryiso3, None)
+                                    # Otherwise the incremental national walk
+                                    # never stops early
+                                    removed = remove_unpublished_countries(
+                                        state_dict, pipeline.get_shared_countries()
+                                    )
+                                    if removed:
+                                        logger.info(
+                                            f"Removed watermarks of {', '.join(removed)}"
+                                        )
+                finally:
+                    pipeline.close()
+                    if store:
+                        store.close()
+                    report = instrumentation.write_report(report_folder)
+                    instrumentation.log_summary(report)
+            state.set({"dates": state_dict, "hashes": hashes})
 
 
 if __name__ == "__main__":
-    facade(
-        main,
-        user_agent_config_yaml=join(expanduser("~"), ".useragents.yaml"),
-        user_agent_lookup=lookup,
-        project_config_yaml=script_dir_plus_file(
-            join("config", "project_configuration.yaml"), main
-        ),
-    )
+    if sys.argv[1:2] == ["fetch"]:
+        from hdx.scraper.wfp.hungermap.fetch_only import main as fetch_main
+
+        fetch_main(sys.argv[2:])
+    else:
+        from hdx.facades.infer_arguments import facade
+
+        facade(
+            main,
+            user_agent_config_yaml=join(expanduser("~"), ".useragents.yaml"),
+            user_agent_lookup=lookup,
+            project_config_yaml=script_dir_plus_file(
+                join("config", "project_configuration.yaml"), main
+            ),
+        )
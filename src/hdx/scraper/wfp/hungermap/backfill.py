@@ -0,0 +1,255 @@
+#!/usr/bin/python
+"""
+Backfill:
+--------
+
+Fetches a range of history from the HungerMap API in parallel monthly chunks
+into the store, resuming from a checkpoint if interrupted.
+
+"""
+
+import json
+import logging
+import threading
+from os import remove, replace
+from os.path import exists
+
+from dateutil.relativedelta import relativedelta
+
+from hdx.scraper.wfp.hungermap.countries import get_country_name
+from hdx.scraper.wfp.hungermap.fetch import NoDataError
+from hdx.scraper.wfp.hungermap.records import Observation, record_hxltags
+from hdx.scraper.wfp.hungermap.table import Table
+from hdx.utilities.base_downloader import DownloadError
+
+logger = logging.getLogger(__name__)
+
+
+def get_monthly_windows(start_date, end_date):
+    """Split a date range into windows of one month from the start date, the
+    last of which is cut short at the end date.
+
+    Args:
+        start_date (datetime): First date of range
+        end_date (datetime): Last date of range
+
+    Returns:
+        List[Tuple[datetime, datetime]]: Windows oldest first
+    """
+    windows = []
+    month = 0
+    window_start = start_date
+    while window_start <= end_date:
+        month += 1
+        next_start = start_date + relativedelta(months=month)
+        window_end = min(next_start - relativedelta(days=1), end_date)
+        windows.append((window_start, window_end))
+        window_start = next_start
+    return windows
+
+
+class Backfill:
+    """Fetches history between two dates into the pipeline's store. The range
+    is split into monthly windows and each window of national snapshots and
+    each country's window of subnational data is a work item. Work items are
+    fetched concurrently, sharing the pipeline's rate limit, but their rows
+    are written to the store in the order of the work items, oldest window
+    first, so that where windows have rows with the same key, the newest
+    window's rows win whichever finishes first. Finished work items are
+    recorded in a checkpoint file so that running the same backfill again
+    after an interruption only does what is left. The checkpoint is removed
+    once every work item has succeeded. Only the store is filled: datasets
+    generated later include history_months of it.
+
+    Args:
+        pipeline (Pipeline): Pipeline with a store
+        checkpoint_path (str): Path of checkpoint file
+        workers (int): Number of work items to run concurrently. Defaults to 4.
+    """
+
+    def __init__(self, pipeline, checkpoint_path, workers=4):
+        if not pipeline.store:
+            raise ValueError("Backfilling needs a store in the configuration!")
+        self.pipeline = pipeline
+        self.checkpoint_path = checkpoint_path
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.completed = self.load_checkpoint()
+
+    def load_checkpoint(self):
+        if not exists(self.checkpoint_path):
+            return set()
+        with open(self.checkpoint_path, encoding="utf-8") as f:
+            completed = set(json.load(f))
+        logger.info(f"Resuming backfill with {len(completed)} work items completed")
+        return completed
+
+    def complete(self, key):
+        with self.lock:
+            self.completed.add(key)
+            # Written to a temporary file first so an interruption cannot
+            # leave a truncated checkpoint
+            temp_path = f"{self.checkpoint_path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(sorted(self.completed), f, indent=2)
+            replace(temp_path, self.checkpoint_path)
+
+    def get_national_rows(self, start_date, end_date, countryiso3s=None):
+        """Get the national rows from the daily snapshots between two dates.
+        Snapshots are read oldest first so that where snapshots have rows with
+        the same key, the newest snapshot's row is written to the store last
+        and wins.
+
+        Args:
+            start_date (datetime): First date
+            end_date (datetime): Last date
+            countryiso3s (Optional[Set[str]]): Countries to include. Defaults to None (all).
+
+        Returns:
+            Table: National rows
+        """
+        pipeline = self.pipeline
+        country_url = pipeline.configuration["country_url"]
+        rows = Table(record_hxltags)
+        first_days_ago = (pipeline.today - end_date).days
+        last_days_ago = (pipeline.today - start_date).days
+        for days_ago in range(last_days_ago, first_days_ago - 1, -1):
+            url = f"{country_url}?days_ago={days_ago}"
+            rjson = pipeline.fetcher.download_json(url)
+            if rjson.get("statusCode") != "200":
+                continue
+            for country in rjson["body"]["countries"]:
+                if country["dataType"] == "PREDICTION":
+                    continue
+                countryiso3 = country["country"]["iso3"]
+                if countryiso3s and countryiso3 not in countryiso3s:
+                    continue
+                countryname = get_country_name(countryiso3)
+                observation = Observation.from_api(countryiso3, countryname, country)
+                rows.append(observation.get_values())
+        return rows
+
+    def get_subnational_rows(self, countryiso3, start_date, end_date):
+        """Get the subnational rows of a country between two dates.
+
+        Args:
+            countryiso3 (str): Country ISO3 code
+            start_date (datetime): First date
+            end_date (datetime): Last date
+
+        Returns:
+            Table: Subnational rows
+        """
+        pipeline = self.pipeline
+        countryname = get_country_name(countryiso3)
+        url = pipeline.get_subnational_url(countryiso3, start_date, end_date)
+        rows = Table(record_hxltags)
+        try:
+            for adminone_data in pipeline.fetcher.iterate_records(url):
+                if adminone_data["dataType"] == "PREDICTION":
+                    continue
+                observation = Observation.from_api(
+                    countryiso3, countryname, adminone_data, adminone_data["region"]
+                )
+                rows.append(observation.get_values())
+        except NoDataError:
+            logger.info(f"No subnational data for {countryname} from {url}")
+        return rows
+
+    def run_work_item(self, work_item):
+        """Run a work item getting its rows.
+
+        Args:
+            work_item (Tuple): (key, function, arguments)
+
+        Returns:
+            Tuple[str, Optional[Table]]: (key, rows or None if the work item failed)
+        """
+        key, function, arguments = work_item
+        try:
+            return key, function(*arguments)
+        except DownloadError:
+            logger.exception(f"Backfill work item {key} failed!")
+            return key, None
+
+    def run_work_items(self, work_items, results):
+        to_run = []
+        for work_item in work_items:
+            if work_item[0] in self.completed:
+                results["resumed"] += 1
+            else:
+                to_run.append(work_item)
+        results["work items"] += len(work_items)
+        # Results come in the order of the work items so rows are written to
+        # the store in that order and each work item is recorded in the
+        # checkpoint once its rows are written
+        for key, rows in self.pipeline.fetcher.imap(
+            self.run_work_item, to_run, self.workers
+        ):
+            if rows is None:
+                results["failed"] += 1
+                continue
+            no_rows = rows.get_no_data_rows()
+            if no_rows:
+                self.pipeline.store.upsert(rows)
+            self.complete(key)
+            results["rows"] += no_rows
+
+    def run(self, start_date, end_date, countryiso3s=None):
+        """Backfill national and subnational data between two dates. National
+        snapshots are fetched first and then subnational data for the given
+        countries or if none are given, every country in the store.
+
+        Args:
+            start_date (datetime): First date
+            end_date (datetime): Last date
+            countryiso3s (Optional[List[str]]): Countries to backfill. Defaults to None (all).
+
+        Returns:
+            Dict: Numbers of work items, resumed, failed and rows and the countries
+        """
+        windows = get_monthly_windows(start_date, end_date)
+        logger.info(
+            f"Backfilling {start_date.date()} to {end_date.date()} in {len(windows)} windows"
+        )
+        results = {"work items": 0, "resumed": 0, "failed": 0, "rows": 0}
+        if countryiso3s:
+            countryiso3s = set(countryiso3s)
+        # Windows fetched for some countries are not complete for others
+        if countryiso3s:
+            national_prefix = f"national/{','.join(sorted(countryiso3s))}"
+        else:
+            national_prefix = "national"
+        national_items = []
+        for window_start, window_end in windows:
+            key = f"{national_prefix}/{window_start.date()}/{window_end.date()}"
+            national_items.append(
+                (key, self.get_national_rows, (window_start, window_end, countryiso3s))
+            )
+        self.run_work_items(national_items, results)
+        if not countryiso3s:
+            countryiso3s = self.pipeline.store.get_countries()
+        countryiso3s = sorted(countryiso3s)
+        subnational_items = []
+        for countryiso3 in countryiso3s:
+            for window_start, window_end in windows:
+                key = f"subnational/{countryiso3}/{window_start.date()}/{window_end.date()}"
+                subnational_items.append(
+                    (
+                        key,
+                        self.get_subnational_rows,
+                        (countryiso3, window_start, window_end),
+                    )
+                )
+        self.run_work_items(subnational_items, results)
+        results["countries"] = countryiso3s
+        if results["failed"]:
+            logger.error(
+                f"{results['failed']} backfill work items failed. Run the backfill again to retry them."
+            )
+        elif exists(self.checkpoint_path):
+            remove(self.checkpoint_path)
+        logger.info(
+            f"Backfilled {results['rows']} rows from {results['work items'] - results['resumed']} work items ({results['resumed']} already done)"
+        )
+        return results
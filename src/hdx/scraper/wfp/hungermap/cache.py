@@ -0,0 +1,395 @@
+#!/usr/bin/python
+"""
+Response cache:
+--------------
+
+Persistent, compressed on-disk cache of HungerMap API JSON responses.
+
+"""
+
+import gzip
+import json
+import logging
+import threading
+from hashlib import sha1
+from os import makedirs, remove, replace
+from os.path import exists, getsize, join
+from time import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from dateutil.relativedelta import relativedelta
+
+from hdx.scraper.wfp.hungermap.dates import parse_iso_date
+from hdx.utilities.saver import save_json
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """Caches JSON responses in a folder keyed by URL. National snapshots
+    requested by days_ago are keyed by the date they refer to so that they can
+    be reused on later days. How long a response stays fresh depends on the
+    last date it covers: windows that end before the current month and at
+    least closed_grace_days before today are closed and kept for
+    closed_ttl_days while others are kept for open_ttl_days (0 means always
+    refetch). The grace period allows for data that is published late. Whether
+    a window is closed is recorded when it is fetched so that a response
+    fetched while its window was open (and may have been incomplete) is never
+    kept as closed. Stale entries with an ETag or Last-Modified header are
+    revalidated with a conditional request. When the total size exceeds
+    max_size_mb, the least recently used entries are evicted. The index of
+    entries is saved every index_save_interval new entries as well as on
+    closing so that a run that crashes loses few of them. Responses can be
+    streamed into and out of the cache so that they need not be held in
+    memory.
+
+    Args:
+        folder (str): Folder in which to store responses
+        today (datetime): Date of run
+        max_size_mb (float): Maximum size of cache in MB. Defaults to 512.
+        closed_ttl_days (float): Days to keep windows before current month. Defaults to 365.
+        open_ttl_days (float): Days to keep windows in current month. Defaults to 0.
+        closed_grace_days (int): Days after its end before a window can be closed. Defaults to 7.
+    """
+
+    index_filename = "index.json"
+    index_save_interval = 20
+
+    def __init__(
+        self,
+        folder,
+        today,
+        max_size_mb=512,
+        closed_ttl_days=365,
+        open_ttl_days=0,
+        closed_grace_days=7,
+    ):
+        self.folder = folder
+        makedirs(folder, exist_ok=True)
+        self.today = today
+        self.start_of_month = today.replace(
+            day=1, hour=0, minute=0, second=0, microsecond=0
+        )
+        self.max_size = max_size_mb * 1024 * 1024
+        self.closed_ttl = closed_ttl_days * 86400
+        self.open_ttl = open_ttl_days * 86400
+        self.closed_grace_days = closed_grace_days
+        self.lock = threading.Lock()
+        self.unsaved = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.index = self.load_index()
+
+    def load_index(self):
+        path = join(self.folder, self.index_filename)
+        if not exists(path):
+            return {}
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except ValueError:
+            logger.warning(f"Ignoring corrupt response cache index {path}!")
+            return {}
+
+    def get_key_and_end_date(self, url):
+        """Get the cache key for a URL and the last date covered by its
+        response. days_ago is replaced by the date it refers to.
+
+        Args:
+            url (str): URL to download
+
+        Returns:
+            Tuple[str, Optional[datetime]]: (cache key, end date)
+        """
+        spliturl = urlsplit(url)
+        query = dict(parse_qsl(spliturl.query))
+        days_ago = query.pop("days_ago", None)
+        if days_ago is not None:
+            end_date = self.today - relativedelta(days=int(days_ago))
+            query["date"] = end_date.date().isoformat()
+            spliturl = spliturl._replace(query=urlencode(sorted(query.items())))
+            return urlunsplit(spliturl), end_date
+        date_end = query.get("date_end")
+        if date_end:
+            return url, parse_iso_date(date_end)
+        return url, None
+
+    def is_closed(self, end_date):
+        if end_date is None or end_date >= self.start_of_month:
+            return False
+        return (self.today - end_date).days >= self.closed_grace_days
+
+    def get_ttl(self, entry):
+        # Entries written before closed was recorded are treated as open
+        if entry.get("closed", False):
+            return self.closed_ttl
+        return self.open_ttl
+
+    def get_path(self, key):
+        return join(self.folder, f"{sha1(key.encode('utf-8')).hexdigest()}.json.gz")
+
+    def load(self, key):
+        with gzip.open(self.get_path(key), "rt", encoding="utf-8") as f:
+            return json.load(f)
+
+    def store(self, key, url, rjson, etag, last_modified, closed):
+        with gzip.open(self.get_path(key), "wt", encoding="utf-8") as f:
+            json.dump(rjson, f)
+        self.add_entry(key, url, etag, last_modified, closed)
+
+    def add_entry(self, key, url, etag, last_modified, closed):
+        size = getsize(self.get_path(key))
+        now = time()
+        with self.lock:
+            self.index[key] = {
+                "url": url,
+                "size": size,
+                "fetched": now,
+                "accessed": now,
+                "etag": etag,
+                "last_modified": last_modified,
+                "closed": closed,
+            }
+            self.evict()
+            self.unsaved += 1
+            if self.unsaved >= self.index_save_interval:
+                self.save_index()
+
+    def save_index(self):
+        # Written to a temporary file first so that a crash cannot leave a
+        # truncated index
+        path = join(self.folder, self.index_filename)
+        temp_path = f"{path}.tmp"
+        save_json(self.index, temp_path)
+        replace(temp_path, path)
+        self.unsaved = 0
+
+    def evict(self):
+        total = sum(entry["size"] for entry in self.index.values())
+        if total <= self.max_size:
+            return
+        for key, entry in sorted(self.index.items(), key=lambda x: x[1]["accessed"]):
+            path = self.get_path(key)
+            if exists(path):
+                remove(path)
+            del self.index[key]
+            total -= entry["size"]
+            if total <= self.max_size:
+                break
+
+    def get_entry(self, key):
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is not None and not exists(self.get_path(key)):
+                del self.index[key]
+                entry = None
+        return entry
+
+    @staticmethod
+    def get_validators(entry):
+        headers = {}
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def open_fresh(self, key):
+        """Open the cached response for a key as a binary file if it is fresh.
+
+        Args:
+            key (str): Cache key
+
+        Returns:
+            Tuple[Optional[BinaryIO], Dict]: (file or None, headers for a conditional request)
+        """
+        entry = self.get_entry(key)
+        if entry is None:
+            return None, {}
+        now = time()
+        if now - entry["fetched"] < self.get_ttl(entry):
+            try:
+                f = gzip.open(self.get_path(key), "rb")
+                with self.lock:
+                    self.hits += 1
+                    entry["accessed"] = now
+                return f, {}
+            except FileNotFoundError:  # evicted by another thread
+                return None, {}
+        return None, self.get_validators(entry)
+
+    def open_revalidated(self, key, end_date):
+        """Open the cached response for a key as a binary file after a
+        conditional request for it returned 304 Not Modified.
+
+        Args:
+            key (str): Cache key
+            end_date (Optional[datetime]): Last date covered by response
+
+        Returns:
+            BinaryIO: File
+        """
+        now = time()
+        with self.lock:
+            self.revalidated += 1
+            entry = self.index[key]
+            entry["fetched"] = now
+            entry["accessed"] = now
+            entry["closed"] = self.is_closed(end_date)
+        return gzip.open(self.get_path(key), "rb")
+
+    def get_writer(self, key, url, end_date, stream, etag, last_modified):
+        """Get a file object that reads from a response stream while writing
+        what is read to the cache. The response is only added to the cache
+        once the writer is committed.
+
+        Args:
+            key (str): Cache key
+            url (str): URL of response
+            end_date (Optional[datetime]): Last date covered by response
+            stream (BinaryIO): Raw response stream
+            etag (Optional[str]): ETag header
+            last_modified (Optional[str]): Last-Modified header
+
+        Returns:
+            CacheWriter: File object to read
+        """
+        with self.lock:
+            self.misses += 1
+        return CacheWriter(
+            self, key, url, stream, etag, last_modified, self.is_closed(end_date)
+        )
+
+    def download_json(self, url, retriever, throttle=None):
+        """Get JSON for a URL from the cache if it is fresh, otherwise revalidate
+        or download it using the given retriever and store it.
+
+        Args:
+            url (str): URL to download
+            retriever (Retrieve): Retrieve object to use if not cached
+            throttle (Optional[Callable[[], None]]): Called before any request. Defaults to None.
+
+        Returns:
+            Any: The data from the JSON response
+        """
+        key, end_date = self.get_key_and_end_date(url)
+        now = time()
+        entry = self.get_entry(key)
+        if entry is not None:
+            if now - entry["fetched"] < self.get_ttl(entry):
+                try:
+                    rjson = self.load(key)
+                    with self.lock:
+                        self.hits += 1
+                        entry["accessed"] = now
+                    return rjson
+                except FileNotFoundError:  # evicted by another thread
+                    pass
+            headers = self.get_validators(entry)
+            if headers:
+                if throttle:
+                    throttle()
+                downloader = retriever.downloader
+                downloader.download(url, headers=headers)
+                if downloader.get_status() == 304:
+                    with self.lock:
+                        self.revalidated += 1
+                        entry["fetched"] = now
+                        entry["accessed"] = now
+                        entry["closed"] = self.is_closed(end_date)
+                    return self.load(key)
+                rjson = downloader.get_json()
+                if retriever.save:
+                    filename, _ = retriever.get_filename(url, None, ("json",))
+                    save_json(rjson, join(retriever.saved_dir, filename))
+                self.add_miss(key, url, rjson, downloader, end_date)
+                return rjson
+        if throttle:
+            throttle()
+        rjson = retriever.download_json(url)
+        self.add_miss(key, url, rjson, retriever.downloader, end_date)
+        return rjson
+
+    def add_miss(self, key, url, rjson, downloader, end_date):
+        with self.lock:
+            self.misses += 1
+        # Only keep responses that contain data
+        if rjson.get("statusCode") != "200":
+            return
+        self.store(
+            key,
+            url,
+            rjson,
+            downloader.get_header("ETag"),
+            downloader.get_header("Last-Modified"),
+            self.is_closed(end_date),
+        )
+
+    def get_statistics(self):
+        requests = self.hits + self.misses + self.revalidated
+        if requests:
+            hit_rate = (self.hits + self.revalidated) / requests
+        else:
+            hit_rate = 0.0
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidated": self.revalidated,
+            "hit rate": hit_rate,
+            "entries": len(self.index),
+            "bytes": sum(entry["size"] for entry in self.index.values()),
+        }
+
+    def close(self):
+        with self.lock:
+            self.save_index()
+        statistics = self.get_statistics()
+        logger.info(
+            f"Response cache: {statistics['hits']} hits, {statistics['misses']} misses, "
+            f"{statistics['revalidated']} revalidated ({statistics['hit rate']:.0%} hit rate)"
+        )
+
+
+class CacheWriter:
+    """Binary file object that reads from a response stream and writes what
+    is read compressed to a temporary file, which becomes the cache entry for
+    the response when committed and is removed when discarded.
+
+    Args:
+        cache (ResponseCache): Response cache
+        key (str): Cache key
+        url (str): URL of response
+        stream (BinaryIO): Raw response stream
+        etag (Optional[str]): ETag header
+        last_modified (Optional[str]): Last-Modified header
+        closed (bool): Whether the window of the response is closed
+    """
+
+    def __init__(self, cache, key, url, stream, etag, last_modified, closed):
+        self.cache = cache
+        self.key = key
+        self.url = url
+        self.stream = stream
+        self.etag = etag
+        self.last_modified = last_modified
+        self.closed = closed
+        self.path = f"{cache.get_path(key)}.{threading.get_ident()}.tmp"
+        self.file = gzip.open(self.path, "wb")
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.file.write(data)
+        return data
+
+    def commit(self):
+        self.file.close()
+        replace(self.path, self.cache.get_path(self.key))
+        self.cache.add_entry(
+            self.key, self.url, self.etag, self.last_modified, self.closed
+        )
+
+    def discard(self):
+        self.file.close()
+        if exists(self.path):
+            remove(self.path)
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+"""
+Cleanup:
+-------
+
+Finds and deletes datasets in HDX for countries no longer in the HungerMap
+API.
+
+"""
+
+import logging
+
+from hdx.data.dataset import Dataset
+from hdx.data.hdxobject import HDXError
+from hdx.scraper.wfp.hungermap.fetch import Fetcher
+
+logger = logging.getLogger(__name__)
+
+
+class StaleDatasetCleanup:
+    """Deletes an organisation's datasets whose names start with a prefix and
+    whose country is not among those given. Only datasets matching the prefix
+    are searched for, a page at a time, and only the fields needed are
+    returned. Datasets are indexed by the ISO3 code of their country (their
+    first group) so that finding the stale ones is a set difference. Deletions
+    run concurrently. In a dry run, the stale datasets are only reported.
+
+    Args:
+        name_prefix (str): Prefix of dataset names eg. "wfp-hungermap-data-for-"
+        organization (str): Organisation name. Defaults to "wfp".
+        configuration (Optional[Configuration]): HDX configuration. Defaults to global configuration.
+        workers (int): Number of concurrent deletions. Defaults to 4.
+        dry_run (bool): Only report stale datasets. Defaults to False.
+        page_size (int): Number of datasets per search request. Defaults to 1000.
+    """
+
+    fields = "id,name,groups"
+
+    def __init__(
+        self,
+        name_prefix,
+        organization="wfp",
+        configuration=None,
+        workers=4,
+        dry_run=False,
+        page_size=1000,
+    ):
+        self.name_prefix = name_prefix
+        self.organization = organization
+        self.configuration = configuration
+        self.workers = workers
+        self.dry_run = dry_run
+        self.page_size = page_size
+
+    def get_index(self):
+        """Get the datasets matching the prefix indexed by country ISO3 code.
+
+        Returns:
+            Dict[str, List[Dataset]]: Datasets by ISO3 code
+        """
+        datasets = Dataset.search_in_hdx(
+            f"name:{self.name_prefix}*",
+            configuration=self.configuration,
+            page_size=self.page_size,
+            fq=f"organization:{self.organization}",
+            fl=self.fields,
+        )
+        index = {}
+        for dataset in datasets:
+            name = dataset["name"]
+            # The search may also match names that only contain the prefix
+            if not name.startswith(self.name_prefix):
+                continue
+            groups = dataset.get("groups")
+            if not groups:
+                logger.warning(f"{name} has no country!")
+                continue
+            # Groups are names when fields are limited and dictionaries otherwise
+            group = groups[0]
+            if isinstance(group, dict):
+                group = group["name"]
+            countryiso3 = group.upper()
+            index.setdefault(countryiso3, []).append(dataset)
+        return index
+
+    def delete(self, dataset):
+        name = dataset["name"]
+        try:
+            dataset.delete_from_hdx()
+        except HDXError:
+            logger.exception(f"Failed to delete {name}!")
+            return name, False
+        logger.info(f"Deleted {name}")
+        return name, True
+
+    def run(self, countryiso3s):
+        """Delete the datasets of countries not in countryiso3s.
+
+        Args:
+            countryiso3s (Iterable[str]): ISO3 codes of countries to keep
+
+        Returns:
+            Dict: Report with numbers of datasets checked, lists of stale countries and stale, deleted and failed datasets and stale countries all of whose datasets were deleted
+        """
+        index = self.get_index()
+        stale_countries = sorted(set(index) - set(countryiso3s))
+        stale = [
+            dataset for countryiso3 in stale_countries for dataset in index[countryiso3]
+        ]
+        # Deleting a dataset clears its data so get the names beforehand
+        names = {
+            countryiso3: [dataset["name"] for dataset in index[countryiso3]]
+            for countryiso3 in stale_countries
+        }
+        report = {
+            "checked": sum(len(datasets) for datasets in index.values()),
+            "stale countries": stale_countries,
+            "stale": [
+                name for countryiso3 in stale_countries for name in names[countryiso3]
+            ],
+            "deleted": [],
+            "failed": [],
+            "deleted countries": [],
+            "dry run": self.dry_run,
+        }
+        if self.dry_run:
+            for name in report["stale"]:
+                logger.info(f"Would delete {name}")
+        else:
+            for name, deleted in Fetcher.imap(self.delete, stale, self.workers):
+                if deleted:
+                    report["deleted"].append(name)
+                else:
+                    report["failed"].append(name)
+            failed = set(report["failed"])
+            report["deleted countries"] = [
+                countryiso3
+                for countryiso3 in stale_countries
+                if not any(name in failed for name in names[countryiso3])
+            ]
+        logger.info(
+            f"Checked {report['checked']} datasets: {len(report['stale'])} stale, "
+            f"{len(report['deleted'])} deleted, {len(report['failed'])} failed"
+        )
+        return report
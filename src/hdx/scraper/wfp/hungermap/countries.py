@@ -0,0 +1,70 @@
+#!/usr/bin/python
+"""
+Countries:
+---------
+
+Country names looked up from a small table precomputed from the data of
+hdx-python-country so that its country data need not be loaded. Regenerate the
+table with: python -m hdx.scraper.wfp.hungermap.countries
+
+"""
+
+import json
+from functools import cache
+from os.path import dirname, join
+
+country_names_path = join(dirname(__file__), "config", "country_names.json")
+
+
+@cache
+def get_country_names():
+    with open(country_names_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+@cache
+def get_country_name(countryiso3):
+    """Get the name of a country from the precomputed table, falling back to
+    hdx-python-country (which loads its country data) for codes not in the
+    table. Results are memoised.
+
+    Args:
+        countryiso3 (str): Country ISO3 code
+
+    Returns:
+        Optional[str]: Country name or None if not found
+    """
+    countryname = get_country_names().get(countryiso3.upper())
+    if countryname is not None:
+        return countryname
+    from hdx.location.country import Country
+
+    return Country.get_country_name_from_iso3(countryiso3)
+
+
+def save_country_names(path=country_names_path):
+    """Save the name of every country in the offline data of hdx-python-country
+    to the table.
+
+    Args:
+        path (str): Path of table. Defaults to country_names_path.
+
+    Returns:
+        Dict[str, str]: Country ISO3 code to name
+    """
+    from hdx.location.country import Country
+
+    countriesdata = Country.countriesdata(use_live=False)
+    country_names = {}
+    for countryiso3 in sorted(countriesdata["countries"]):
+        countryname = Country.get_country_name_from_iso3(countryiso3)
+        if countryname:
+            country_names[countryiso3] = countryname
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(country_names, f, ensure_ascii=False, indent=0, sort_keys=True)
+        f.write("\n")
+    return country_names
+
+
+if __name__ == "__main__":
+    save_country_names()
@@ -0,0 +1,52 @@
+#!/usr/bin/python
+"""
+Dates:
+-----
+
+Memoised parsing of the dates used throughout the pipeline.
+
+"""
+
+from datetime import datetime, timezone
+from functools import lru_cache
+
+from hdx.utilities.dateparse import parse_date
+
+# A run sees a few hundred distinct dates so this is ample
+max_cached_dates = 4096
+
+
+@lru_cache(maxsize=max_cached_dates)
+def parse_iso_date(date_str):
+    """Parse a date string into a timezone-aware UTC datetime, remembering the
+    result. Plain YYYY-MM-DD dates, which is what the HungerMap API returns,
+    are parsed directly and anything else falls back to dateutil via
+    parse_date. Datetimes are immutable so cached values can be shared.
+
+    Args:
+        date_str (str): Date string
+
+    Returns:
+        datetime: Parsed date
+    """
+    if len(date_str) == 10:
+        try:
+            return datetime.fromisoformat(date_str).replace(tzinfo=timezone.utc)
+        except ValueError:
+            pass
+    return parse_date(date_str)
+
+
+def get_cache_statistics():
+    cache_info = parse_iso_date.cache_info()
+    calls = cache_info.hits + cache_info.misses
+    if calls:
+        hit_rate = cache_info.hits / calls
+    else:
+        hit_rate = 0.0
+    return {
+        "hits": cache_info.hits,
+        "misses": cache_info.misses,
+        "hit rate": hit_rate,
+        "size": cache_info.currsize,
+    }
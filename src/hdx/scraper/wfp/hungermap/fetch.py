@@ -0,0 +1,422 @@
+#!/usr/bin/python
+"""
+Fetcher:
+-------
+
+Thread-safe access to the HungerMap API with a global rate limit.
+
+"""
+
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from multiprocessing import get_context
+from os.path import getsize, join
+from time import perf_counter, sleep
+
+import ijson
+
+from hdx.scraper.wfp.hungermap.instrumentation import Instrumentation, get_url_class
+from hdx.scraper.wfp.hungermap.throttle import AdaptiveThrottle, Backoff
+from hdx.utilities.base_downloader import DownloadError
+from hdx.utilities.downloader import Download
+
+logger = logging.getLogger(__name__)
+
+
+class NoDataError(DownloadError):
+    """Raised when a HungerMap API response has a statusCode other than "200"
+    which means that there is no data rather than that the request failed."""
+
+
+def iterate_records(file, url):
+    """Parse a HungerMap API JSON response incrementally from a binary file
+    object, yielding each record in its body as soon as it has been read. A
+    NoDataError is raised if the statusCode is not "200".
+
+    Args:
+        file (BinaryIO): File object containing JSON
+        url (str): URL of JSON for error messages
+
+    Returns:
+        Iterator[Dict]: Records in body
+    """
+    status_code = None
+    events = ijson.parse(file, use_float=True)
+    for prefix, event, value in events:
+        if prefix == "statusCode":
+            status_code = value
+            if status_code != "200":
+                raise NoDataError(f"{url} has statusCode {status_code}!")
+        elif prefix == "body.item" and event in ("start_map", "start_array"):
+            builder = ijson.ObjectBuilder()
+            depth = 1
+            while depth:
+                builder.event(event, value)
+                prefix, event, value = next(events)
+                if event in ("start_map", "start_array"):
+                    depth += 1
+                elif event in ("end_map", "end_array"):
+                    depth -= 1
+            yield builder.value
+    if status_code != "200":
+        raise NoDataError(f"{url} has statusCode {status_code}!")
+
+
+def get_retry_after(response):
+    if response is None:
+        return None
+    retry_after = response.headers.get("Retry-After")
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        return None
+
+
+class Fetcher:
+    """Wraps a Retrieve object so that it can be used from many threads. The
+    thread that creates the Fetcher uses the given retriever while other threads
+    get their own clone with a separate Download object. All network requests
+    share one throttle regardless of the thread they are made from, which
+    adapts the rate to latency and errors if rate_limit has min_rate and
+    max_rate. Requests that fail with a connection error, HTTP 429 or 5xx are
+    retried with jittered exponential backoff. The URLs of requests that still
+    fail or that fail with another HTTP error are kept in failed_urls so that
+    they can be requested again in the next run. The number of concurrent requests per URL
+    class (national or subnational) can be limited. Every request is recorded
+    in the instrumentation.
+
+    Args:
+        retriever (Retrieve): Retrieve object
+        rate_limit (Optional[Dict]): Rate limit eg. {"calls": 1, "period": 0.1, "min_rate": 1, "max_rate": 20}. Defaults to None.
+        cache (Optional[ResponseCache]): Cache of responses. Defaults to None.
+        instrumentation (Optional[Instrumentation]): Instrumentation. Defaults to None (new one).
+        retry (Optional[Dict]): Retries eg. {"attempts": 5, "base_delay": 1, "max_delay": 60}. Defaults to None.
+        endpoint_concurrency (Optional[Dict]): Maximum concurrent requests by URL class. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        retriever,
+        rate_limit=None,
+        cache=None,
+        instrumentation=None,
+        retry=None,
+        endpoint_concurrency=None,
+    ):
+        self.retriever = retriever
+        self.cache = cache
+        if instrumentation is None:
+            instrumentation = Instrumentation()
+        self.instrumentation = instrumentation
+        self.owner = threading.get_ident()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.downloaders = []
+        if rate_limit:
+            self.throttle = AdaptiveThrottle(
+                rate_limit["calls"],
+                rate_limit["period"],
+                rate_limit.get("min_rate"),
+                rate_limit.get("max_rate"),
+                rate_limit.get("target_latency", 2.0),
+            )
+        else:
+            self.throttle = None
+        self.retry = retry
+        if retry:
+            self.backoff = Backoff(
+                retry.get("attempts", 5),
+                retry.get("base_delay", 1.0),
+                retry.get("max_delay", 60.0),
+            )
+        else:
+            self.backoff = None
+        if endpoint_concurrency is None:
+            endpoint_concurrency = {}
+        self.budgets = {
+            url_class: threading.BoundedSemaphore(limit)
+            for url_class, limit in endpoint_concurrency.items()
+        }
+        self.failed_urls = set()
+
+    @staticmethod
+    def get_download_kwargs(retry):
+        """Get keyword arguments for Download. If the Fetcher retries, Download
+        should not also retry.
+
+        Args:
+            retry (Optional[Dict]): Retry configuration
+
+        Returns:
+            Dict: Keyword arguments for Download
+        """
+        if retry:
+            return {"retry_attempts": 0, "status_forcelist": ()}
+        return {}
+
+    def get_retriever(self):
+        if threading.get_ident() == self.owner:
+            return self.retriever
+        retriever = getattr(self.local, "retriever", None)
+        if retriever is None:
+            downloader = Download(**self.get_download_kwargs(self.retry))
+            with self.lock:
+                self.downloaders.append(downloader)
+            retriever = self.retriever.clone(downloader)
+            self.local.retriever = retriever
+        return retriever
+
+    @staticmethod
+    def get_saved_path(retriever, url):
+        filename, _ = retriever.get_filename(url, None, ("json",))
+        return join(retriever.saved_dir, filename)
+
+    def get_budget(self, url):
+        budget = self.budgets.get(get_url_class(url))
+        if budget is None:
+            return nullcontext()
+        return budget
+
+    def add_failed_url(self, url):
+        with self.lock:
+            self.failed_urls.add(url)
+
+    def remove_failed_url(self, url):
+        with self.lock:
+            self.failed_urls.discard(url)
+
+    def call_with_retry(self, url, downloader, function):
+        """Call function which makes a request for url using downloader,
+        retrying on connection errors, HTTP 429 and 5xx. The throttle is told
+        about errors. Other HTTP errors are raised immediately. The URL is
+        added to failed_urls if the request fails.
+
+        Args:
+            url (str): URL requested
+            downloader (Download): Download object used by function
+            function (Callable[[], Any]): Function making request
+
+        Returns:
+            Any: Result of function
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return function()
+            except NoDataError:
+                raise
+            except DownloadError:
+                response = downloader.response
+                if response is None:
+                    status = None
+                else:
+                    status = response.status_code
+                    if status < 500 and status != 429:
+                        self.add_failed_url(url)
+                        raise
+                retry_after = get_retry_after(response)
+                if self.throttle:
+                    if status == 429:
+                        self.throttle.on_throttled(retry_after)
+                    else:
+                        self.throttle.on_error()
+                if not self.backoff or attempt >= self.backoff.attempts:
+                    self.add_failed_url(url)
+                    logger.error(f"Giving up on {url} after {attempt} attempts!")
+                    raise
+                delay = self.backoff.get_delay(attempt, retry_after)
+                logger.warning(
+                    f"Retrying {url} in {delay:.1f}s after {status or 'connection error'}"
+                )
+                sleep(delay)
+
+    def download_json(self, url):
+        retriever = self.get_retriever()
+        start = perf_counter()
+        if retriever.use_saved:
+            rjson = retriever.download_json(url)
+            self.instrumentation.record_request(
+                url,
+                perf_counter() - start,
+                getsize(self.get_saved_path(retriever, url)),
+                "saved",
+            )
+            return rjson
+        downloader = retriever.downloader
+
+        def download():
+            start = perf_counter()
+            previous_response = downloader.response
+            with self.get_budget(url):
+                if self.cache:
+                    rjson = self.cache.download_json(url, retriever, self.throttle)
+                else:
+                    if self.throttle:
+                        self.throttle()
+                    rjson = retriever.download_json(url)
+            response = downloader.response
+            latency = perf_counter() - start
+            # The cache only makes a request on a miss or revalidation
+            if response is None or response is previous_response:
+                self.instrumentation.record_request(url, latency, 0, "cache")
+            else:
+                self.instrumentation.record_request(url, latency, len(response.content))
+                if self.throttle:
+                    self.throttle.on_success(latency)
+            return rjson
+
+        return self.call_with_retry(url, downloader, download)
+
+    def iterate_records(self, url):
+        """Yield the records in the body of the JSON at url while it is being
+        parsed rather than loading it all into memory first. Saved data and
+        fresh cached responses are streamed from file and network responses
+        are streamed as they arrive, being written to the cache as they are
+        read. Responses that need to be saved are downloaded in full. Setting
+        up a streamed request is retried like other requests but a failure
+        part way through the stream is not, as records have already been
+        yielded. A NoDataError is raised if the statusCode is not "200" and a
+        DownloadError if the request fails.
+
+        Args:
+            url (str): URL to download
+
+        Returns:
+            Iterator[Dict]: Records in body
+        """
+        retriever = self.get_retriever()
+        if retriever.use_saved:
+            path = self.get_saved_path(retriever, url)
+            logger.info(f"Streaming saved {path}")
+            start = perf_counter()
+            with open(path, "rb") as f:
+                try:
+                    yield from iterate_records(f, url)
+                finally:
+                    self.instrumentation.record_request(
+                        url, perf_counter() - start, f.tell(), "saved"
+                    )
+            return
+        if retriever.save:
+            rjson = self.download_json(url)
+            if rjson.get("statusCode") != "200":
+                raise NoDataError(f"{url} has statusCode {rjson.get('statusCode')}!")
+            yield from rjson["body"]
+            return
+        headers = {}
+        if self.cache:
+            key, end_date = self.cache.get_key_and_end_date(url)
+            f, headers = self.cache.open_fresh(key)
+            if f:
+                start = perf_counter()
+                with f:
+                    try:
+                        yield from iterate_records(f, url)
+                    finally:
+                        self.instrumentation.record_request(
+                            url, perf_counter() - start, 0, "cache"
+                        )
+                return
+        downloader = retriever.downloader
+
+        def setup():
+            if self.throttle:
+                self.throttle()
+            start = perf_counter()
+            response = downloader.setup(url, stream=True, headers=headers)
+            if self.throttle:
+                self.throttle.on_success(perf_counter() - start)
+            return response
+
+        with self.get_budget(url):
+            logger.info(f"Streaming from {retriever.get_url_logstr(url)}")
+            start = perf_counter()
+            response = self.call_with_retry(url, downloader, setup)
+            response.raw.decode_content = True
+            writer = None
+            if not self.cache:
+                source = response.raw
+            elif response.status_code == 304:
+                source = self.cache.open_revalidated(key, end_date)
+            else:
+                writer = self.cache.get_writer(
+                    key,
+                    url,
+                    end_date,
+                    response.raw,
+                    response.headers.get("ETag"),
+                    response.headers.get("Last-Modified"),
+                )
+                source = writer
+            committed = False
+            try:
+                yield from iterate_records(source, url)
+                if writer:
+                    writer.commit()
+                    committed = True
+            except DownloadError:
+                raise
+            except Exception as e:
+                self.add_failed_url(url)
+                raise DownloadError(f"Streaming {url} failed!") from e
+            finally:
+                if writer and not committed:
+                    writer.discard()
+                if source is not response.raw and source is not writer:
+                    source.close()
+                self.instrumentation.record_request(
+                    url, perf_counter() - start, response.raw.tell()
+                )
+                response.close()
+
+    @staticmethod
+    def imap(function, iterable, max_workers=1, processes=False):
+        """Call function on each item of iterable yielding results in the order
+        of iterable. Up to max_workers calls run concurrently. Any exception is
+        raised when its result is reached and closing the generator cancels
+        outstanding calls. Items are only taken from iterable as calls finish
+        so the results of one imap can be passed to another to make a pipeline
+        of stages with backpressure.
+
+        Args:
+            function (Callable[[Any], Any]): Function to call
+            iterable (Iterable): Items to pass to function
+            max_workers (int): Maximum number of concurrent calls. Defaults to 1.
+            processes (bool): Run calls in worker processes rather than threads. Function, items and results must be picklable. Defaults to False.
+
+        Returns:
+            Iterator[Any]: Results of function in order
+        """
+        if max_workers <= 1:
+            for item in iterable:
+                yield function(item)
+            return
+        if processes:
+            # Forking a process with running threads can copy held locks
+            executor = ProcessPoolExecutor(
+                max_workers=max_workers, mp_context=get_context("spawn")
+            )
+        else:
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+        futures = deque()
+        try:
+            for item in iterable:
+                futures.append(executor.submit(function, item))
+                if len(futures) >= max_workers:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def close(self):
+        with self.lock:
+            for downloader in self.downloaders:
+                downloader.close()
+            self.downloaders = []
+        if self.cache:
+            self.cache.close()
@@ -0,0 +1,166 @@
+#!/usr/bin/python
+"""
+Fetch only:
+----------
+
+Fetches HungerMap data and writes the country CSVs and summaries without
+reading state from, or creating datasets in, HDX. Nothing here imports the HDX
+API client or its data model so it starts quickly. Run with:
+python -m hdx.scraper.wfp.hungermap fetch
+
+"""
+
+import argparse
+import logging
+from os import makedirs
+from os.path import exists, expanduser, join
+
+from hdx.scraper.wfp.hungermap.cache import ResponseCache
+from hdx.scraper.wfp.hungermap.fetch import Fetcher
+from hdx.scraper.wfp.hungermap.instrumentation import Instrumentation
+from hdx.scraper.wfp.hungermap.pipeline import Pipeline, write_country
+from hdx.utilities.dateparse import default_date, now_utc
+from hdx.utilities.downloader import Download
+from hdx.utilities.loader import load_yaml
+from hdx.utilities.path import get_temp_dir, script_dir_plus_file
+from hdx.utilities.retriever import Retrieve
+from hdx.utilities.useragent import UserAgent
+
+logger = logging.getLogger(__name__)
+
+lookup = "hdx-scraper-wfp-hungermap"
+
+
+def fetch_only(
+    configuration,
+    retriever,
+    folder,
+    today,
+    countryiso3s=None,
+    workers=1,
+    cache=None,
+    instrumentation=None,
+    max_days_ago=365,
+):
+    """Fetch the rows of each country with national data, or of countryiso3s
+    if given, and write their CSVs and summaries to folder. There is no state
+    so all available national data and the full subnational history are
+    fetched. As each national snapshot has every country, all max_days_ago
+    snapshots are requested even if only some countries are wanted. URLs that
+    fail are not saved for the next normal run to retry.
+
+    Args:
+        configuration (Dict): Project configuration
+        retriever (Retrieve): Retrieve object
+        folder (str): Folder in which to write files
+        today (datetime): Date of run
+        countryiso3s (Optional[Iterable[str]]): ISO3 codes of countries to fetch. Defaults to None (all).
+        workers (int): Number of countries to fetch in parallel. Defaults to 1.
+        cache (Optional[ResponseCache]): Cache of API responses. Defaults to None.
+        instrumentation (Optional[Instrumentation]): Instrumentation. Defaults to None.
+        max_days_ago (int): Number of days of national data to fetch. Defaults to 365.
+
+    Returns:
+        Dict[str, Dict]: Numbers of wide and long rows written for each country
+    """
+    pipeline = Pipeline(
+        configuration,
+        retriever,
+        folder,
+        today,
+        cache,
+        instrumentation,
+        save_failed_urls=False,
+    )
+    if countryiso3s:
+        countryiso3s = set(countryiso3s)
+    try:
+        countries = pipeline.get_country_data(
+            {"DEFAULT": default_date},
+            max_days_ago=max_days_ago,
+            countryiso3s=countryiso3s,
+        )
+        logger.info(f"Number of countries: {len(countries)}")
+        parquet = configuration.get("parquet", False)
+
+        def fetch_country(country):
+            countryiso3 = country["iso3"]
+            rows_info = pipeline.get_rows(countryiso3)
+            return write_country(folder, None, parquet, (countryiso3, *rows_info))
+
+        results = {}
+        for countryiso3, result, *_ in Fetcher.imap(fetch_country, countries, workers):
+            results[countryiso3] = result
+        pipeline.write_summaries(join(folder, "country_summaries.json"))
+    finally:
+        pipeline.close()
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Fetch HungerMap data and write CSVs without using HDX"
+    )
+    parser.add_argument("--countries", help="Comma separated ISO3 codes")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument(
+        "--folder", help="Output folder. Defaults to a folder in the temp folder."
+    )
+    parser.add_argument("--country-url", help="Override country_url")
+    args = parser.parse_args(args)
+    logging.basicConfig(level=logging.INFO)
+    configuration = load_yaml(
+        script_dir_plus_file(join("config", "project_configuration.yaml"), main)
+    )
+    if args.country_url:
+        configuration["country_url"] = args.country_url
+    user_agent_config_yaml = join(expanduser("~"), ".useragents.yaml")
+    if exists(user_agent_config_yaml):
+        UserAgent.set_global(
+            user_agent_config_yaml=user_agent_config_yaml, user_agent_lookup=lookup
+        )
+    else:
+        UserAgent.set_global(lookup)
+    if args.folder:
+        folder = args.folder
+        makedirs(folder, exist_ok=True)
+    else:
+        folder = get_temp_dir(lookup)
+    if args.countries:
+        countryiso3s = args.countries.split(",")
+    else:
+        countryiso3s = None
+    today = now_utc()
+    cache_configuration = configuration.get("response_cache")
+    if cache_configuration:
+        cache = ResponseCache(
+            expanduser(cache_configuration["folder"]),
+            today,
+            cache_configuration.get("max_size_mb", 512),
+            cache_configuration.get("closed_ttl_days", 365),
+            cache_configuration.get("open_ttl_days", 0),
+            cache_configuration.get("closed_grace_days", 7),
+        )
+    else:
+        cache = None
+    instrumentation = Instrumentation()
+    download_kwargs = Fetcher.get_download_kwargs(configuration.get("retry"))
+    with Download(**download_kwargs) as downloader:
+        retriever = Retrieve(downloader, folder, "saved_data", folder, False, False)
+        results = fetch_only(
+            configuration,
+            retriever,
+            folder,
+            today,
+            countryiso3s,
+            args.workers,
+            cache,
+            instrumentation,
+        )
+    report = instrumentation.write_report(folder)
+    instrumentation.log_summary(report)
+    logger.info(f"Wrote files of {len(results)} countries to {folder}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+#!/usr/bin/python
+"""
+Instrumentation:
+---------------
+
+Timing of pipeline stages and HungerMap API requests with JSON and Prometheus
+text file reports and optional profiling.
+
+"""
+
+import cProfile
+import logging
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from os import makedirs
+from os.path import join
+from time import perf_counter
+from urllib.parse import urlsplit
+
+from hdx.utilities.saver import save_json, save_text
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of request latency histogram buckets
+latency_buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def get_url_class(url):
+    """Classify a HungerMap API URL as national (?days_ago=), subnational
+    (/{iso3}/region) or other.
+
+    Args:
+        url (str): URL
+
+    Returns:
+        str: URL class
+    """
+    spliturl = urlsplit(url)
+    if "days_ago=" in spliturl.query:
+        return "national"
+    if spliturl.path.rstrip("/").endswith("/region"):
+        return "subnational"
+    return "other"
+
+
+class Instrumentation:
+    """Accumulates statistics for a run: the number of requests, bytes and a
+    latency histogram per URL class and source (network, cache or saved), the
+    time spent in each stage overall and per country and the number of rows
+    produced per country. It can be updated from many threads. Stage times of
+    countries processed in parallel overlap so their total can exceed the run
+    time.
+    """
+
+    report_filename = "instrumentation"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = perf_counter()
+        self.requests = defaultdict(
+            lambda: {
+                "count": 0,
+                "bytes": 0,
+                "seconds": 0.0,
+                "buckets": [0] * (len(latency_buckets) + 1),
+            }
+        )
+        self.stages = defaultdict(lambda: {"count": 0, "seconds": 0.0})
+        self.countries = defaultdict(lambda: {"stages": {}, "rows": {}})
+
+    def record_request(self, url, seconds, no_bytes, source="network"):
+        """Record a request.
+
+        Args:
+            url (str): URL requested
+            seconds (float): Time taken
+            no_bytes (int): Number of bytes received
+            source (str): Where response came from. Defaults to "network".
+
+        Returns:
+            None
+        """
+        key = (get_url_class(url), source)
+        with self.lock:
+            request = self.requests[key]
+            request["count"] += 1
+            request["bytes"] += no_bytes
+            request["seconds"] += seconds
+            request["buckets"][bisect_left(latency_buckets, seconds)] += 1
+
+    def add_stage_time(self, name, seconds, countryiso3=None):
+        with self.lock:
+            stage = self.stages[name]
+            stage["count"] += 1
+            stage["seconds"] += seconds
+            if countryiso3:
+                stages = self.countries[countryiso3]["stages"]
+                stages[name] = stages.get(name, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name, countryiso3=None):
+        """Time the code run in the with block as a stage, optionally for a
+        country.
+
+        Args:
+            name (str): Name of stage
+            countryiso3 (Optional[str]): Country ISO3 code. Defaults to None.
+
+        Returns:
+            None
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_time(name, perf_counter() - start, countryiso3)
+
+    def add_rows(self, countryiso3, name, no_rows):
+        with self.lock:
+            rows = self.countries[countryiso3]["rows"]
+            rows[name] = rows.get(name, 0) + no_rows
+
+    def get_report(self):
+        """Get a report of everything recorded so far.
+
+        Returns:
+            Dict: Report
+        """
+        with self.lock:
+            requests = []
+            for (url_class, source), request in sorted(self.requests.items()):
+                buckets = {}
+                cumulative = 0
+                for upper, count in zip((*latency_buckets, "+Inf"), request["buckets"]):
+                    cumulative += count
+                    buckets[str(upper)] = cumulative
+                requests.append(
+                    {
+                        "url class": url_class,
+                        "source": source,
+                        "count": request["count"],
+                        "bytes": request["bytes"],
+                        "seconds": request["seconds"],
+                        "latency buckets": buckets,
+                    }
+                )
+            return {
+                "run seconds": perf_counter() - self.start,
+                "requests": requests,
+                "stages": {name: dict(stage) for name, stage in self.stages.items()},
+                "countries": {
+                    countryiso3: {
+                        "stages": dict(country["stages"]),
+                        "rows": dict(country["rows"]),
+                    }
+                    for countryiso3, country in sorted(self.countries.items())
+                },
+            }
+
+    @staticmethod
+    def get_prometheus_text(report):
+        """Convert a report to the Prometheus text exposition format as read by
+        the node exporter's text file collector.
+
+        Args:
+            report (Dict): Report from get_report
+
+        Returns:
+            str: Prometheus text
+        """
+        lines = [
+            "# TYPE hungermap_run_seconds gauge",
+            f"hungermap_run_seconds {report['run seconds']}",
+            "# TYPE hungermap_requests_total counter",
+        ]
+        for request in report["requests"]:
+            labels = f'url_class="{request["url class"]}",source="{request["source"]}"'
+            lines.append(f"hungermap_requests_total{{{labels}}} {request['count']}")
+        lines.append("# TYPE hungermap_request_bytes_total counter")
+        for request in report["requests"]:
+            labels = f'url_class="{request["url class"]}",source="{request["source"]}"'
+            lines.append(
+                f"hungermap_request_bytes_total{{{labels}}} {request['bytes']}"
+            )
+        lines.append("# TYPE hungermap_request_seconds histogram")
+        for request in report["requests"]:
+            labels = f'url_class="{request["url class"]}",source="{request["source"]}"'
+            for upper, count in request["latency buckets"].items():
+                lines.append(
+                    f'hungermap_request_seconds_bucket{{{labels},le="{upper}"}} {count}'
+                )
+            lines.append(
+                f"hungermap_request_seconds_sum{{{labels}}} {request['seconds']}"
+            )
+            lines.append(
+                f"hungermap_request_seconds_count{{{labels}}} {request['count']}"
+            )
+        lines.append("# TYPE hungermap_stage_seconds_total counter")
+        for name, stage in report["stages"].items():
+            lines.append(
+                f'hungermap_stage_seconds_total{{stage="{name}"}} {stage["seconds"]}'
+            )
+        lines.append("# TYPE hungermap_country_stage_seconds gauge")
+        for countryiso3, country in report["countries"].items():
+            for name, seconds in country["stages"].items():
+                lines.append(
+                    f'hungermap_country_stage_seconds{{country="{countryiso3}",stage="{name}"}} {seconds}'
+                )
+        lines.append("# TYPE hungermap_country_rows gauge")
+        for countryiso3, country in report["countries"].items():
+            for name, no_rows in country["rows"].items():
+                lines.append(
+                    f'hungermap_country_rows{{country="{countryiso3}",table="{name}"}} {no_rows}'
+                )
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, folder):
+        """Write the report as JSON and Prometheus text files in folder.
+
+        Args:
+            folder (str): Folder in which to write report
+
+        Returns:
+            Dict: Report
+        """
+        report = self.get_report()
+        makedirs(folder, exist_ok=True)
+        save_json(report, join(folder, f"{self.report_filename}.json"))
+        save_text(
+            self.get_prometheus_text(report),
+            join(folder, f"{self.report_filename}.prom"),
+        )
+        return report
+
+    def log_summary(self, report=None):
+        if report is None:
+            report = self.get_report()
+        logger.info(f"Run took {report['run seconds']:.1f}s")
+        for name, stage in report["stages"].items():
+            logger.info(
+                f"Stage {name}: {stage['seconds']:.1f}s over {stage['count']} calls"
+            )
+        for request in report["requests"]:
+            count = request["count"]
+            mean = request["seconds"] / count if count else 0.0
+            logger.info(
+                f"{request['url class'].capitalize()} requests from {request['source']}: "
+                f"{count} requests, {request['bytes']} bytes, {mean:.3f}s mean latency"
+            )
+        rows = defaultdict(int)
+        for country in report["countries"].values():
+            for name, no_rows in country["rows"].items():
+                rows[name] += no_rows
+        for name, no_rows in rows.items():
+            logger.info(f"Rows {name}: {no_rows}")
+
+
+@contextmanager
+def profiler(kind, folder):
+    """Profile the code run in the with block using cProfile or pyinstrument
+    and write the output to folder. If pyinstrument is not installed, cProfile
+    is used instead.
+
+    Args:
+        kind (Optional[str]): cprofile, pyinstrument or None for no profiling
+        folder (str): Folder in which to write profile
+
+    Returns:
+        None
+    """
+    if not kind:
+        yield
+        return
+    kind = kind.lower()
+    if kind not in ("cprofile", "pyinstrument"):
+        raise ValueError(f"Unknown profiler {kind}!")
+    makedirs(folder, exist_ok=True)
+    if kind == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            logger.warning("pyinstrument is not installed so using cProfile!")
+            kind = "cprofile"
+    if kind == "pyinstrument":
+        profile = Profiler()
+        profile.start()
+        try:
+            yield
+        finally:
+            profile.stop()
+            path = join(folder, "profile.html")
+            save_text(profile.output_html(), path)
+            logger.info(f"Wrote pyinstrument profile to {path}")
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        path = join(folder, "profile.prof")
+        profile.dump_stats(path)
+        logger.info(f"Wrote cProfile profile to {path}")
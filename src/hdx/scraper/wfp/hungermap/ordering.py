@@ -0,0 +1,73 @@
+#!/usr/bin/python
+"""
+Ordering:
+--------
+
+Row ordering using precomputed integer keys.
+
+"""
+
+from datetime import date as Date
+from heapq import merge
+
+# Larger than any date ordinal (9999-12-31 is 3652059)
+ordinal_limit = 3700000
+
+
+def get_sort_keys(adminlevels, dates, adminones):
+    """Get one integer sort key per row that orders rows by admin level, then
+    date descending, then admin one name with national rows (which have no
+    admin one) treated as "ZZZ". Admin levels and admin one names are ranked by
+    their sorted order and each distinct ISO date is converted only once.
+
+    Args:
+        adminlevels (List[str]): Admin level of each row
+        dates (List[str]): ISO date of each row
+        adminones (List[str]): Admin one name of each row
+
+    Returns:
+        List[int]: Sort key of each row
+    """
+    adminlevel_ranks = {
+        adminlevel: i for i, adminlevel in enumerate(sorted(set(adminlevels)))
+    }
+    names = sorted({adminone if adminone else "ZZZ" for adminone in adminones})
+    adminone_ranks = {name: i for i, name in enumerate(names)}
+    adminone_ranks[""] = adminone_ranks.get("ZZZ", 0)
+    no_names = len(names)
+    date_keys = {}
+    keys = []
+    for adminlevel, date, adminone in zip(adminlevels, dates, adminones):
+        date_key = date_keys.get(date)
+        if date_key is None:
+            date_key = ordinal_limit - Date.fromisoformat(date).toordinal()
+            date_keys[date] = date_key
+        key = adminlevel_ranks[adminlevel] * ordinal_limit + date_key
+        keys.append(key * no_names + adminone_ranks[adminone])
+    return keys
+
+
+def get_order(keys, runs):
+    """Get the order of rows from their sort keys. Rows are given as runs of
+    consecutive row indices which are sorted separately. Subnational windows
+    are fetched newest first and do not overlap so the sorted runs normally
+    follow on from each other and are just concatenated, otherwise they are
+    merged. Rows with equal keys keep their original order.
+
+    Args:
+        keys (List[int]): Sort key of each row
+        runs (List[Tuple[int, int]]): (start, stop) row indices of each run
+
+    Returns:
+        List[int]: Row indices in order
+    """
+    key = keys.__getitem__
+    sorted_runs = [
+        sorted(range(start, stop), key=key) for start, stop in runs if stop > start
+    ]
+    order = []
+    for run in sorted_runs:
+        if order and keys[run[0]] < keys[order[-1]]:
+            return list(merge(*sorted_runs, key=key))
+        order.extend(run)
+    return order
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+"""
+Parquet:
+-------
+
+Writes tables to Parquet with typed columns. pyarrow is an optional dependency
+which is only imported when Parquet output is requested.
+
+"""
+
+# Text columns with few distinct values that are dictionary encoded
+dictionary_headers = {
+    "countrycode",
+    "countryname",
+    "adminone",
+    "adminlevel",
+    "datatype",
+    "indicator name",
+}
+
+
+def get_field(header, hxltag):
+    """Get the Parquet field for a column from its header. The HXL hashtag is
+    kept in the field metadata.
+
+    Args:
+        header (str): Column header
+        hxltag (str): HXL hashtag of column
+
+    Returns:
+        pyarrow.Field: Field
+    """
+    import pyarrow as pa
+
+    if header == "date":
+        field_type = pa.date32()
+    elif header.endswith("prevalence"):
+        field_type = pa.float64()
+    elif header == "population" or header.endswith(" people"):
+        field_type = pa.int64()
+    elif header in dictionary_headers:
+        field_type = pa.dictionary(pa.int32(), pa.string())
+    else:
+        field_type = pa.string()
+    return pa.field(header, field_type, metadata={"hxl": hxltag})
+
+
+def get_array(field, values):
+    import pyarrow as pa
+
+    if pa.types.is_dictionary(field.type):
+        return pa.array(values, type=pa.string()).dictionary_encode()
+    if pa.types.is_date32(field.type):
+        # Dates are ISO strings
+        return pa.array(values, type=pa.string()).cast(pa.date32())
+    if pa.types.is_string(field.type):
+        return pa.array(values, type=field.type)
+    return pa.array([None if value == "" else value for value in values], field.type)
+
+
+def write_parquet(path, table, group_header="adminlevel"):
+    """Write a table to a zstd compressed Parquet file. Text columns with few
+    distinct values are dictionary encoded, dates are typed as dates, people
+    as integers and prevalences as floats with empty values becoming nulls.
+    Rows are expected to be ordered by the group header and each run of rows
+    with the same value in it (eg. national and subnational) is written as a
+    separate row group.
+
+    Args:
+        path (str): Path of Parquet file
+        table (Table): Table to write
+        group_header (str): Header of column to partition row groups by. Defaults to "adminlevel".
+
+    Returns:
+        int: Number of row groups written
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema(
+        [get_field(header, table.hxltags[header]) for header in table.output_headers]
+    )
+    arrow_table = pa.Table.from_arrays(
+        [
+            get_array(field, table.columns[field.name]).cast(field.type)
+            for field in schema
+        ],
+        schema=schema,
+    )
+    groups = table.columns[group_header]
+    no_row_groups = 0
+    with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+        start = 0
+        no_rows = len(groups)
+        while start < no_rows:
+            stop = start + 1
+            while stop < no_rows and groups[stop] == groups[start]:
+                stop += 1
+            writer.write_table(
+                arrow_table.slice(start, stop - start), row_group_size=stop - start
+            )
+            no_row_groups += 1
+            start = stop
+    return no_row_groups
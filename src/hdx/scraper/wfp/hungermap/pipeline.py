@@ -7,209 +7,738 @@ Reads WFP Hunger Maps data and creates datasets.
 
 """
 
+import json
 import logging
-from copy import copy
+from collections import deque
+from csv import DictReader
+from os import makedirs
+from os.path import exists, join
+from shutil import copy2
+from time import perf_counter
+from urllib.parse import parse_qs, urlsplit
 
 from dateutil.relativedelta import relativedelta
 from slugify import slugify
 
-from hdx.data.dataset import Dataset
-from hdx.data.showcase import Showcase
-from hdx.location.country import Country
+from hdx.scraper.wfp.hungermap.countries import get_country_name
+from hdx.scraper.wfp.hungermap.dates import get_cache_statistics, parse_iso_date
+from hdx.scraper.wfp.hungermap.fetch import Fetcher, NoDataError
+from hdx.scraper.wfp.hungermap.instrumentation import get_url_class
+from hdx.scraper.wfp.hungermap.ordering import get_order, get_sort_keys
+from hdx.scraper.wfp.hungermap.parquet import write_parquet
+from hdx.scraper.wfp.hungermap.planner import RangePlanner
+from hdx.scraper.wfp.hungermap.records import (
+    Observation,
+    hxltags,
+    long_hxltags,
+    long_id_headers,
+    long_indicators,
+    record_hxltags,
+)
+from hdx.scraper.wfp.hungermap.summary import CountrySummary, write_summaries
+from hdx.scraper.wfp.hungermap.table import Table
+from hdx.scraper.wfp.hungermap.writer import write_global, write_wide_and_long
 from hdx.utilities.base_downloader import DownloadError
-from hdx.utilities.dateparse import default_date, default_enddate, parse_date
+from hdx.utilities.dateparse import default_date
 
 logger = logging.getLogger(__name__)
 
 
-hxltags = {
-    "countrycode": "#country+code",
-    "countryname": "#country+name",
-    "adminone": "#adm1+name",
-    "adminlevel": "#meta+adminlevel",
-    "population": "#population+total",
-    "date": "#date",
-    "datatype": "#data+type",
-    "fcs people": "#population+fcs",
-    "fcs prevalence": "#indicator+fcs+prevalence",
-    "rcsi people": "#population+rcsi",
-    "rcsi prevalence": "#indicator+rcsi+prevalence",
-    "health access people": "#population+health_access",
-    "health access prevalence": "#indicator+health_access+prevalence",
-    "market access people": "#population+market_access",
-    "market access prevalence": "#indicator+market_access+prevalence",
-}
-
-long_hxltags = {
-    "countrycode": "#country+code",
-    "countryname": "#country+name",
-    "adminone": "#adm1+name",
-    "adminlevel": "#meta+adminlevel",
-    "date": "#date",
-    "datatype": "#data+type",
-    "indicator name": "#indicator+name",
-    "population": "#population",
-    "prevalence": "#indicator+prevalence",
-}
+numeric_headers = [
+    header
+    for header in hxltags
+    if header == "population" or header.endswith((" people", " prevalence"))
+]
+
+# Latest values by country
+summary_headers = [
+    header for header in hxltags if header not in ("adminone", "adminlevel")
+]
+
+
+def get_filenames(slugified_name, parquet=False):
+    """Get the filenames of a country's wide and long CSVs and if parquet is
+    True, their Parquet versions.
+
+    Args:
+        slugified_name (str): Slugified dataset name
+        parquet (bool): Include Parquet files. Defaults to False.
+
+    Returns:
+        List[str]: Filenames
+    """
+    filenames = [f"{slugified_name}.csv", f"{slugified_name}-long.csv"]
+    if parquet:
+        filenames.extend(
+            (f"{slugified_name}.parquet", f"{slugified_name}-long.parquet")
+        )
+    return filenames
+
+
+def write_country_files(folder, previous_folder, slugified_name, rows, parquet=False):
+    """Write the wide and long CSVs of a country and if parquet is True and
+    there are rows, Parquet versions of them (which requires pyarrow). The CSVs
+    are copied to previous_folder if given. Arguments are picklable so that
+    this can run in a worker process.
+
+    Args:
+        folder (str): Folder in which to write files
+        previous_folder (Optional[str]): Folder in which to keep copies of the CSVs
+        slugified_name (str): Slugified dataset name used for filenames
+        rows (Table): Wide table
+        parquet (bool): Also write Parquet files. Defaults to False.
+
+    Returns:
+        Dict: Numbers of wide and long rows
+    """
+    filename, long_filename = get_filenames(slugified_name)
+    results = write_wide_and_long(
+        join(folder, filename),
+        join(folder, long_filename),
+        rows,
+        long_hxltags,
+        long_id_headers,
+        long_indicators,
+    )
+    if parquet and results["wide rows"]:
+        long_rows = rows.melt(long_hxltags, long_id_headers, long_indicators)
+        filenames = get_filenames(slugified_name, True)
+        write_parquet(join(folder, filenames[2]), rows)
+        write_parquet(join(folder, filenames[3]), long_rows)
+    if previous_folder:
+        makedirs(previous_folder, exist_ok=True)
+        for resource_filename in (filename, long_filename):
+            copy2(
+                join(folder, resource_filename),
+                join(previous_folder, resource_filename),
+            )
+    return results
+
+
+def write_country(folder, previous_folder, parquet, country):
+    """Write the files of a country as a stage run in a worker process, given
+    the country as returned by the fetch stage and returning it for the
+    upload stage with the rows replaced by the write results.
+
+    Args:
+        folder (str): Folder in which to write files
+        previous_folder (Optional[str]): Folder in which to keep copies of the CSVs
+        parquet (bool): Also write Parquet files
+        country (Tuple): (countryiso3, rows, earliest_date, latest_date, has_subnational)
+
+    Returns:
+        Tuple: (countryiso3, results, earliest_date, latest_date, has_subnational, seconds)
+    """
+    countryiso3, rows, earliest_date, latest_date, has_subnational = country
+    start = perf_counter()
+    slugified_name = slugify(Pipeline.get_name(countryiso3))
+    results = write_country_files(
+        folder, previous_folder, slugified_name, rows, parquet
+    )
+    seconds = perf_counter() - start
+    return countryiso3, results, earliest_date, latest_date, has_subnational, seconds
 
 
 class Pipeline:
     dataset_name_prefix = "wfp hungermap data for "
-
-    def __init__(self, configuration, retriever, folder, today):
+    # Does not start with dataset_name_prefix so is not deleted as stale
+    global_dataset_name = "wfp-hungermap-global-data"
+
+    def __init__(
+        self,
+        configuration,
+        retriever,
+        folder,
+        today,
+        cache=None,
+        instrumentation=None,
+        store=None,
+        save_failed_urls=True,
+    ):
         self.configuration = configuration
         self.retriever = retriever
+        self.fetcher = Fetcher(
+            retriever,
+            configuration.get("rate_limit"),
+            cache,
+            instrumentation,
+            configuration.get("retry"),
+            configuration.get("endpoint_concurrency"),
+        )
+        self.instrumentation = self.fetcher.instrumentation
         self.folder = folder
+        # Generated wide CSVs and URLs that failed are kept with the response
+        # cache for incremental runs
+        if cache:
+            self.previous_folder = join(cache.folder, "previous")
+        else:
+            self.previous_folder = None
+        if cache and save_failed_urls:
+            self.failed_urls_path = join(cache.folder, "failed_urls.json")
+        else:
+            self.failed_urls_path = None
+        failed_urls = self.load_failed_urls()
+        self.failed_start_dates = self.get_failed_start_dates(failed_urls)
+        # National snapshots that failed in the last run are requested again
+        # by not stopping the walk back early
+        self.national_failed = any(
+            get_url_class(url) == "national" for url in failed_urls
+        )
+        self.store = store
         self.today = today
         self.shared_countries = set()
         self.countries_data = {}
+        self.summaries = {}
+        planner_configuration = configuration.get("range_planner") or {}
+        if planner_configuration.get("enabled", False):
+            self.planner = RangePlanner(
+                planner_configuration.get("max_months", 3),
+                planner_configuration.get("max_records"),
+            )
+        else:
+            self.planner = None
+        # Subnational requests made for each country when planned
+        self.plans = {}
 
-    def get_country_data(self, state, max_days_ago=365):
-        try:
-            country_url = self.configuration["country_url"]
-            for days_ago in range(0, max_days_ago, 1):
-                url = f"{country_url}?days_ago={days_ago}"
-                json = self.retriever.download_json(url)
-                if json.get("statusCode") != "200":
-                    logger.info("No national data available!")
+    def get_country_data(
+        self, state, max_days_ago=365, incremental=False, countryiso3s=None
+    ):
+        country_url = self.configuration["country_url"]
+        national_concurrency = self.configuration.get("national_concurrency", 1)
+        fetched = set()
+        stopped_early = False
+        # Countries already published which have not yet been seen
+        pending = set(state) - {"DEFAULT"}
+        # Dates up to which countries' national rows are already held: in the
+        # store if there is one, otherwise in the published datasets
+        held_dates = dict(state)
+        if self.store:
+            for countryiso3 in pending:
+                last_date = self.store.get_last_date(countryiso3, "national")
+                if last_date:
+                    held_dates[countryiso3] = min(
+                        state[countryiso3], parse_iso_date(last_date)
+                    )
+                else:
+                    held_dates[countryiso3] = state["DEFAULT"]
+        # Countries seen walking back and those whose snapshots have reached
+        # their held dates
+        seen = set()
+        reached = set()
+
+        failed = set()
+
+        def download(days_ago):
+            fetched.add(days_ago)
+            url = f"{country_url}?days_ago={days_ago}"
+            try:
+                return self.fetcher.download_json(url)
+            except DownloadError:
+                # Carry on walking back rather than losing every older snapshot
+                logger.warning(f"National data for {days_ago} days ago failed!")
+                failed.add(days_ago)
+                return None
+
+        for rjson in self.fetcher.imap(
+            download, range(0, max_days_ago, 1), national_concurrency
+        ):
+            if rjson is None:
+                continue
+            if rjson.get("statusCode") != "200":
+                logger.info("No national data available!")
+                continue
+            for country in rjson["body"]["countries"]:
+                datatype = country["dataType"]
+                if datatype == "PREDICTION":
                     continue
-                for country in json["body"]["countries"]:
-                    datatype = country["dataType"]
-                    if datatype == "PREDICTION":
+                countryiso3 = country["country"]["iso3"]
+                self.shared_countries.add(countryiso3)
+                date = parse_iso_date(country["date"])
+                pending.discard(countryiso3)
+                if countryiso3s and countryiso3 not in countryiso3s:
+                    continue
+                seen.add(countryiso3)
+                # Without a store, the national history of a country with new
+                # data is only in the snapshots
+                if date <= held_dates.get(countryiso3, state["DEFAULT"]) and (
+                    self.store or countryiso3 not in self.countries_data
+                ):
+                    reached.add(countryiso3)
+                if date > state.get(countryiso3, state["DEFAULT"]):
+                    state[countryiso3] = date
+                    self.countries_data[countryiso3] = [
+                        self.get_national_observation(countryiso3, country)
+                    ]
+                else:
+                    current_rows = self.countries_data.get(countryiso3)
+                    if not current_rows:
                         continue
-                    countryiso3 = country["country"]["iso3"]
-                    self.shared_countries.add(countryiso3)
-                    date = parse_date(country["date"])
-                    if date > state.get(countryiso3, state["DEFAULT"]):
-                        state[countryiso3] = date
-                        self.countries_data[countryiso3] = [country]
-                    else:
-                        current_rows = self.countries_data.get(countryiso3)
-                        if not current_rows:
-                            continue
-                        current_date = current_rows[-1]["date"]
-                        date = country["date"]
-                        if date != current_date:
-                            self.countries_data[countryiso3].append(country)
-        except DownloadError:
-            logger.info("No national data available!")
+                    if date != parse_iso_date(current_rows[-1].date):
+                        self.countries_data[countryiso3].append(
+                            self.get_national_observation(countryiso3, country)
+                        )
+            # Snapshots only get older walking back so once every published
+            # country has been seen and every country seen has reached the
+            # date up to which its rows are held, no earlier snapshot can add
+            # anything unless a newer snapshot failed in this or the last run
+            if (
+                incremental
+                and not pending
+                and not failed
+                and not self.national_failed
+                and seen <= reached
+            ):
+                stopped_early = True
+                break
+        if failed:
+            logger.error(f"{len(failed)} of {len(fetched)} national requests failed!")
+        if stopped_early:
+            saved = max_days_ago - len(fetched)
+            logger.info(
+                f"Incremental mode saved {saved} of {max_days_ago} national requests"
+            )
 
         return [{"iso3": countryiso3} for countryiso3 in self.countries_data]
 
-    def get_rows(self, countryiso3, max_months_ago=12):
-        rows = [hxltags]
-        countryname = Country.get_country_name_from_iso3(countryiso3)
-
-        earliest_date = default_enddate
-        latest_date = default_date
-
-        def get_row(data, adminone="", population=""):
-            nonlocal earliest_date, latest_date
-
-            if adminone:
-                adminlevel = "subnational"
-            else:
-                adminlevel = "national"
-
-            def get_metric(metric):
-                metric_data = data["metrics"].get(metric)
-                if not metric_data:
-                    metric_data = {"people": "", "prevalence": ""}
-                return metric_data
-
-            fcs = get_metric("fcs")
-            rcsi = get_metric("rcsi")
-            health_access = get_metric("healthAccess")
-            market_access = get_metric("marketAccess")
-
-            date = parse_date(data["date"])
-            if date < earliest_date:
-                earliest_date = date
-            if date > latest_date:
-                latest_date = date
-            return {
-                "countrycode": countryiso3,
-                "countryname": countryname,
-                "adminone": adminone,
-                "adminlevel": adminlevel,
-                "population": population,
-                "date": date.date().isoformat(),
-                "datatype": data["dataType"],
-                "fcs people": fcs["people"],
-                "fcs prevalence": fcs["prevalence"],
-                "rcsi people": rcsi["people"],
-                "rcsi prevalence": rcsi["prevalence"],
-                "health access people": health_access["people"],
-                "health access prevalence": health_access["prevalence"],
-                "market access people": market_access["people"],
-                "market access prevalence": market_access["prevalence"],
-            }
-
-        country_rows = self.countries_data[countryiso3]
-        rows.extend([get_row(country_row) for country_row in country_rows])
+    @staticmethod
+    def get_national_observation(countryiso3, country):
+        countryname = get_country_name(countryiso3)
+        return Observation.from_api(countryiso3, countryname, country)
+
+    def get_previous_subnational_rows(self, countryiso3):
+        """Read the subnational rows of the wide CSV previously generated for a
+        country. The copy in the output folder is used if there is one,
+        otherwise the one kept with the response cache. Numeric columns are
+        converted back to numbers.
+
+        Args:
+            countryiso3 (str): Country ISO3 code
+
+        Returns:
+            List[Dict]: Subnational rows from previous CSV
+        """
+        filename = f"{slugify(self.get_name(countryiso3))}.csv"
+        for folder in (self.folder, self.previous_folder):
+            if not folder:
+                continue
+            path = join(folder, filename)
+            if exists(path):
+                break
+        else:
+            return []
+        previous_rows = []
+        with open(path, encoding="utf-8", newline="") as f:
+            reader = DictReader(f)
+            for row in reader:
+                if row["adminlevel"] != "subnational":
+                    continue
+                for header in numeric_headers:
+                    value = row[header]
+                    if value:
+                        try:
+                            row[header] = int(value)
+                        except ValueError:
+                            row[header] = float(value)
+                previous_rows.append(row)
+        logger.info(f"Read {len(previous_rows)} previous subnational rows from {path}")
+        return previous_rows
+
+    def load_failed_urls(self):
+        """Load the URLs that failed in the last run kept with the response
+        cache.
+
+        Returns:
+            List[str]: URLs that failed in the last run
+        """
+        if not self.failed_urls_path or not exists(self.failed_urls_path):
+            return []
+        with open(self.failed_urls_path, encoding="utf-8") as f:
+            failed_urls = json.load(f)
+        if failed_urls:
+            logger.info(f"{len(failed_urls)} URLs failed in the last run")
+        return failed_urls
+
+    @staticmethod
+    def get_failed_start_dates(failed_urls):
+        """Get the earliest start date of the subnational requests for each
+        country that failed in the last run.
+
+        Args:
+            failed_urls (List[str]): URLs that failed in the last run
+
+        Returns:
+            Dict[str, datetime]: Country ISO3 code to earliest failed start date
+        """
+        failed_start_dates = {}
+        for url in failed_urls:
+            parts = urlsplit(url)
+            path = parts.path.rstrip("/").split("/")
+            date_start = parse_qs(parts.query).get("date_start")
+            if len(path) < 2 or path[-1] != "region" or not date_start:
+                continue
+            countryiso3 = path[-2]
+            start_date = parse_iso_date(date_start[0])
+            current_start_date = failed_start_dates.get(countryiso3)
+            if current_start_date is None or start_date < current_start_date:
+                failed_start_dates[countryiso3] = start_date
+        return failed_start_dates
+
+    def save_failed_urls(self):
+        """Save the URLs that failed in this run with the response cache so
+        that they are requested again in the next run.
+
+        Returns:
+            None
+        """
+        failed_urls = sorted(self.fetcher.failed_urls)
+        if failed_urls:
+            logger.error(f"{len(failed_urls)} URLs failed!")
+        if not self.failed_urls_path:
+            return
+        with open(self.failed_urls_path, "w", encoding="utf-8") as f:
+            json.dump(failed_urls, f, indent=2)
+
+    def get_subnational_url(self, countryiso3, start_date, end_date):
         country_url = self.configuration["country_url"]
+        return f"{country_url}/{countryiso3}/region?date_start={start_date.date().isoformat()}&date_end={end_date.date().isoformat()}"
+
+    def get_windows(self, max_months_ago=12):
+        """Get the monthly (start date, end date) windows for which subnational
+        data is requested, newest first.
+
+        Args:
+            max_months_ago (int): Number of monthly windows. Defaults to 12.
+
+        Returns:
+            List[Tuple[datetime, datetime]]: Windows newest first
+        """
         end_date = self.today - relativedelta(days=1)
         start_date = self.today - relativedelta(months=1)
+        windows = []
+        for month in range(0, max_months_ago):
+            windows.append((start_date, end_date))
+            start_date = start_date - relativedelta(months=1)
+            end_date = end_date - relativedelta(months=1)
+        return windows
+
+    def get_rows(self, countryiso3, max_months_ago=12, incremental=False):
+        rows = Table(record_hxltags)
+        countryname = get_country_name(countryiso3)
+        # Filled as rows are added so that they need not be scanned again
+        summary = CountrySummary(countryiso3)
+
+        def add_row(values):
+            rows.append(values)
+            summary.add(values)
+
+        for observation in self.countries_data[countryiso3]:
+            add_row(observation.get_values())
+        # runs of rows that are each ordered separately before being combined
+        runs = [(0, rows.get_no_data_rows())]
+
+        def add_run(start):
+            runs.append((start, rows.get_no_data_rows()))
+
+        windows = self.get_windows(max_months_ago)
+        planner = self.planner
+        if planner:
+            windows = planner.plan(windows[-1][0], windows[0][1])
 
         def add_subnational_rows(sd, ed):
-            url = f"{country_url}/{countryiso3}/region?date_start={sd.date().isoformat()}&date_end={ed.date().isoformat()}"
+            """Returns number of records or None if there is no data. Raises
+            DownloadError if the request fails."""
+            url = self.get_subnational_url(countryiso3, sd, ed)
+            # Rows are appended as records are streamed and removed again if
+            # the request fails part way through
+            start = rows.get_no_data_rows()
+            no_records = 0
             try:
-                json = self.retriever.download_json(url)
-                if json.get("statusCode") != "200":
-                    logger.info(f"No subnational data for {countryname}!")
-                    return False
-                all_adminone_data = json["body"]
-                for adminone_data in all_adminone_data:
+                for adminone_data in self.fetcher.iterate_records(url):
+                    no_records += 1
                     datatype = adminone_data["dataType"]
                     if datatype == "PREDICTION":
                         continue
-                    adminone = adminone_data["region"]["name"]
-                    population = adminone_data["region"]["population"]
-                    rows.append(get_row(adminone_data, adminone, population))
-            except DownloadError:
+                    observation = Observation.from_api(
+                        countryiso3, countryname, adminone_data, adminone_data["region"]
+                    )
+                    rows.append(observation.get_values())
+            except NoDataError:
+                rows.truncate(start)
                 logger.info(f"No subnational data for {countryname}!")
-                return False
-            return True
+                return None
+            except DownloadError:
+                rows.truncate(start)
+                raise
+            for values in rows.iterate_values(start):
+                summary.add(values)
+            add_run(start)
+            return no_records
 
         has_subnational = False
-        for month in range(0, max_months_ago):
-            if add_subnational_rows(start_date, end_date):
+        previous_rows = []
+        last_previous_date = default_date
+        if incremental and self.store:
+            # Rows already in the store are not requested again
+            last_stored_date = self.store.get_last_date(countryiso3, "subnational")
+            if last_stored_date:
+                last_previous_date = parse_iso_date(last_stored_date)
+        elif incremental:
+            previous_rows = self.get_previous_subnational_rows(countryiso3)
+            if previous_rows:
+                last_previous_date = parse_iso_date(
+                    max(row["date"] for row in previous_rows)
+                )
+        # Windows that failed in the last run are fetched again
+        failed_start_date = self.failed_start_dates.get(countryiso3)
+        if failed_start_date:
+            last_previous_date = min(
+                last_previous_date, failed_start_date - relativedelta(days=1)
+            )
+        requests = []
+        pending = deque(windows)
+        max_months = planner.max_months if planner else None
+        while pending:
+            window = pending.popleft()
+            start_date, end_date = window
+            # earlier windows are already in the previous CSV
+            if end_date <= last_previous_date:
+                break
+            request = {
+                "start": start_date.date().isoformat(),
+                "end": end_date.date().isoformat(),
+            }
+            requests.append(request)
+            try:
+                no_records = add_subnational_rows(start_date, end_date)
+            except DownloadError:
+                halves = planner.split(window) if planner else None
+                if halves:
+                    logger.warning(
+                        f"Subnational data for {countryname} from {start_date.date()} to {end_date.date()} failed so splitting it!"
+                    )
+                    request["status"] = "split"
+                    # Its halves are recorded if they fail
+                    self.fetcher.remove_failed_url(
+                        self.get_subnational_url(countryiso3, start_date, end_date)
+                    )
+                    pending.extendleft(reversed(halves))
+                    continue
+                logger.warning(
+                    f"Subnational data for {countryname} from {start_date.date()} to {end_date.date()} failed and will be retried next run!"
+                )
+                request["status"] = "failed"
+                continue
+            if no_records is None:
+                request["status"] = "no data"
+                continue
+            request["status"] = "ok"
+            request["records"] = no_records
+            has_subnational = True
+            if planner and planner.is_too_large(no_records) and pending:
+                no_months = planner.get_no_months(window)
+                if no_months > 1 and no_months <= max_months:
+                    # Later windows for this country span fewer months
+                    max_months = max(1, no_months // 2)
+                    pending = deque(
+                        planner.plan(pending[-1][0], pending[0][1], max_months)
+                    )
+        if len(requests) < len(windows):
+            logger.info(
+                f"Incremental mode fetched {len(requests)} of {len(windows)} subnational windows for {countryname}"
+            )
+        if planner:
+            self.plans[countryiso3] = requests
+            logger.info(
+                f"Made {len(requests)} subnational requests for {countryname} instead of {max_months_ago}: "
+                + ", ".join(
+                    f"{request['start']} to {request['end']} ({request['status']})"
+                    for request in requests
+                )
+            )
+        if self.store:
+            self.store.upsert(rows)
+            return self.get_rows_from_store(
+                countryiso3, self.get_history_months(max_months_ago)
+            )
+        if previous_rows:
+            start = rows.get_no_data_rows()
+            first_date = windows[-1][0].date().isoformat()
+            last_date = windows[0][1].date().isoformat()
+            columns = rows.columns
+            fetched_keys = {
+                (adminone, date, datatype)
+                for adminlevel, adminone, date, datatype in zip(
+                    columns["adminlevel"],
+                    columns["adminone"],
+                    columns["date"],
+                    columns["datatype"],
+                )
+                if adminlevel == "subnational"
+            }
+            for row in previous_rows:
+                if not first_date <= row["date"] <= last_date:
+                    continue
+                key = (row["adminone"], row["date"], row["datatype"])
+                if key in fetched_keys:
+                    continue
+                fetched_keys.add(key)
+                # Previous CSVs do not have the columns that are not written out
+                add_row([row.get(header, "") for header in rows.headers])
                 has_subnational = True
-            start_date = start_date - relativedelta(months=1)
-            end_date = end_date - relativedelta(months=1)
-
-        class reverser:
-            def __init__(self, obj):
-                self.obj = obj
-
-            def __eq__(self, other):
-                return other.obj == self.obj
+            add_run(start)
 
-            def __lt__(self, other):
-                return other.obj < self.obj
-
-        rows = sorted(
-            rows,
-            key=lambda x: (
-                x["adminlevel"],
-                reverser(x["date"]),
-                x["adminone"] if x["adminone"] else "ZZZ",
-            ),
+        columns = rows.columns
+        keys = get_sort_keys(
+            columns["adminlevel"], columns["date"], columns["adminone"]
         )
+        order = get_order(keys, runs)
+        rows.reorder(order)
+        self.summaries[countryiso3] = summary
+        earliest_date, latest_date = summary.get_time_period()
         return rows, earliest_date, latest_date, has_subnational
 
+    def get_history_months(self, default=12):
+        """Get the number of months of history to include in datasets generated
+        from the store which is history_months in the store configuration so
+        that it can be longer than what is requested from the API.
+
+        Args:
+            default (int): Number of months if history_months is not set. Defaults to 12.
+
+        Returns:
+            int: Number of months
+        """
+        store_configuration = self.configuration.get("store") or {}
+        return store_configuration.get("history_months") or default
+
+    def get_store_start_date(self, history_months=None):
+        """Get the ISO date from which rows are read from the store which is
+        the start of the oldest of history_months monthly windows.
+
+        Args:
+            history_months (Optional[int]): Number of months. Defaults to None (get_history_months).
+
+        Returns:
+            str: ISO date
+        """
+        if history_months is None:
+            history_months = self.get_history_months()
+        return self.get_windows(history_months)[-1][0].date().isoformat()
+
+    def get_store_countries(self, history_months=None):
+        """Get the countries with rows in the store from the start of the
+        oldest of history_months monthly windows onwards. Others would have
+        datasets without any rows.
+
+        Args:
+            history_months (Optional[int]): Number of months. Defaults to None (get_history_months).
+
+        Returns:
+            List[str]: Country ISO3 codes in sorted order
+        """
+        return self.store.get_countries(self.get_store_start_date(history_months))
+
+    def get_rows_from_store(self, countryiso3, history_months=None):
+        """Get the rows of a country from the store without making any
+        requests, in the same form as get_rows. Rows from the start of the
+        oldest of history_months monthly windows onwards are included.
+
+        Args:
+            countryiso3 (str): Country ISO3 code
+            history_months (Optional[int]): Number of months. Defaults to None (get_history_months).
+
+        Returns:
+            Tuple[Table, datetime, datetime, bool]: Rows, earliest date, latest date and whether there are subnational rows
+        """
+        summary = CountrySummary(countryiso3)
+        rows = self.store.get_rows(
+            countryiso3,
+            record_hxltags,
+            self.get_store_start_date(history_months),
+            summary,
+        )
+        self.summaries[countryiso3] = summary
+        earliest_date, latest_date = summary.get_time_period()
+        return rows, earliest_date, latest_date, summary.has_subnational()
+
+    def add_parquet_resources(self, dataset, slugified_name, title):
+        """Add the Parquet versions of the wide and long tables written by
+        write_country_files to the dataset as resources after the CSVs.
+
+        Args:
+            dataset (Dataset): Dataset to which to add resources
+            slugified_name (str): Slugified dataset name used for filenames
+            title (str): Dataset title used for descriptions
+
+        Returns:
+            None
+        """
+        from hdx.data.resource import Resource
+
+        filenames = get_filenames(slugified_name, True)[2:]
+        for filename, description in zip(
+            filenames, (f"{title} parquet", f"{title} long format parquet")
+        ):
+            path = join(self.folder, filename)
+            resource = Resource({"name": filename, "description": description})
+            resource.set_format("parquet")
+            resource.set_file_to_upload(path)
+            dataset.add_update_resource(resource)
+
     @classmethod
     def get_name(cls, countryiso3):
         return f"{cls.dataset_name_prefix}{countryiso3}"
 
     def generate_dataset_and_showcase(
-        self, countryiso3, rows, earliest_date, latest_date, has_subnational
+        self,
+        countryiso3,
+        rows,
+        earliest_date,
+        latest_date,
+        has_subnational,
+        results=None,
     ):
+        """Generate the dataset and showcase of a country. Its files are
+        written unless the results of writing them with write_country_files
+        are given, in which case rows are not needed. If there are no rows,
+        no dataset is generated as creating it in HDX would remove the
+        resources of the existing one.
+
+        Args:
+            countryiso3 (str): Country ISO3 code
+            rows (Optional[Table]): Wide table
+            earliest_date (datetime): Earliest date of rows
+            latest_date (datetime): Latest date of rows
+            has_subnational (bool): Whether there are subnational rows
+            results (Optional[Dict]): Results of write_country_files. Defaults to None.
+
+        Returns:
+            Tuple[Optional[Dataset], Optional[Showcase], Optional[Tuple[bool, bool, bool]]]: Dataset, showcase and disabled quickchart bites or Nones if there are no rows
+        """
+        from hdx.data.dataset import Dataset
+        from hdx.data.resource import Resource
+        from hdx.data.showcase import Showcase
+
         name = self.get_name(countryiso3)
-        countryname = Country.get_country_name_from_iso3(countryiso3)
+        countryname = get_country_name(countryiso3)
         title = f"{countryname} - HungerMap data"
-        logger.info(f"Creating dataset: {title}")
         slugified_name = slugify(name)
+        filename, long_filename = get_filenames(slugified_name)
+        parquet = self.configuration.get("parquet", False)
+        if results is None:
+            results = write_country_files(
+                self.folder, self.previous_folder, slugified_name, rows, parquet
+            )
+        summary = self.summaries.get(countryiso3)
+        if summary is None:
+            summary = CountrySummary.from_table(countryiso3, rows)
+            self.summaries[countryiso3] = summary
+        self.instrumentation.add_rows(countryiso3, "wide", results["wide rows"])
+        self.instrumentation.add_rows(countryiso3, "long", results["long rows"])
+        if not results["wide rows"]:
+            logger.error(f"No data rows in {filename} so not creating dataset!")
+            return None, None, None
+        logger.info(f"Creating dataset: {title}")
         dataset = Dataset(
             {
                 "name": slugified_name,
@@ -223,57 +752,18 @@ class Pipeline:
         dataset.add_country_location(countryiso3)
         tags = ["hxl", "indicators", "food security"]
         dataset.add_tags(tags)
+        earliest_date, latest_date = summary.get_time_period()
+        for resource_filename, description in (
+            (filename, title),
+            (long_filename, f"{title} long format"),
+        ):
+            resource = Resource({"name": resource_filename, "description": description})
+            resource.set_format("csv")
+            resource.set_file_to_upload(join(self.folder, resource_filename))
+            dataset.add_update_resource(resource)
+        if parquet:
+            self.add_parquet_resources(dataset, slugified_name, title)
         dataset.set_time_period(earliest_date, latest_date)
-
-        filename = f"{slugified_name}.csv"
-        resourcedata = {"name": filename, "description": title}
-        dataset.generate_resource_from_rows(self.folder, filename, rows, resourcedata)
-        long_rows = [long_hxltags]
-        latest_date = default_date
-        latest_row = None
-        for row in rows[1:]:
-            date = parse_date(row["date"])
-            if date > latest_date:
-                latest_date = date
-                latest_row = row
-            base_row = {}
-            for col in row.keys():
-                if col in (
-                    "countrycode",
-                    "countryname",
-                    "adminone",
-                    "adminlevel",
-                    "date",
-                    "datatype",
-                ):
-                    base_row[col] = row[col]
-            population = row["population"]
-            if population:
-                new_row = copy(base_row)
-                new_row["indicator name"] = "total"
-                new_row["population"] = population
-                new_row["prevalence"] = ""
-                long_rows.append(new_row)
-
-            def add_indicator(indicator_name):
-                population = row[f"{indicator_name} people"]
-                if population:
-                    new_row = copy(base_row)
-                    new_row["indicator name"] = indicator_name
-                    new_row["population"] = population
-                    new_row["prevalence"] = row[f"{indicator_name} prevalence"]
-                    long_rows.append(new_row)
-
-            add_indicator("fcs")
-            add_indicator("rcsi")
-            add_indicator("health access")
-            add_indicator("market access")
-
-        filename = f"{slugified_name}-long.csv"
-        resourcedata = {"name": filename, "description": f"{title} long format"}
-        dataset.generate_resource_from_rows(
-            self.folder, filename, long_rows, resourcedata
-        )
         showcase = Showcase(
             {
                 "name": f"{slugified_name}-showcase",
@@ -284,23 +774,130 @@ class Pipeline:
             }
         )
         showcase.add_tags(tags)
-
-        fcs = latest_row.get("fcs prevalence")
-        if fcs:
-            fcs = False
-        else:
-            fcs = True
-        rcsi = latest_row.get("rcsi prevalence")
-        if rcsi:
-            rcsi = False
-        else:
-            rcsi = True
-        market_access = latest_row.get("market access prevalence")
-        if market_access:
-            market_access = False
-        else:
-            market_access = True
-        return dataset, showcase, (fcs, rcsi, market_access)
+        return dataset, showcase, summary.get_bites_disabled()
+
+    def get_country_paths(self, countryiso3):
+        """Get the paths of the wide and long CSVs of a country generated in this
+        run or if there are none, the ones kept with the response cache from
+        an earlier run.
+
+        Args:
+            countryiso3 (str): Country ISO3 code
+
+        Returns:
+            Optional[Tuple[str, str]]: (wide CSV path, long CSV path) or None
+        """
+        slugified_name = slugify(self.get_name(countryiso3))
+        for folder in (self.folder, self.previous_folder):
+            if not folder:
+                continue
+            paths = (
+                join(folder, f"{slugified_name}.csv"),
+                join(folder, f"{slugified_name}-long.csv"),
+            )
+            if all(exists(path) for path in paths):
+                return paths
+        return None
+
+    def generate_global_dataset(self, countryiso3s):
+        """Generate a dataset with all countries' rows in global wide and long
+        CSVs, ordered by country and then as in each country's CSVs, and a
+        summary CSV of each country's latest values. It is built from the CSVs
+        already written by generate_dataset_and_showcase (or kept from earlier
+        runs) so no extra requests are made. If any country has no CSVs, no
+        dataset is generated rather than one missing that country.
+
+        Args:
+            countryiso3s (Iterable[str]): Country ISO3 codes
+
+        Returns:
+            Optional[Dataset]: Global dataset or None if there is no data for every country
+        """
+        from hdx.data.dataset import Dataset
+        from hdx.data.resource import Resource
+
+        country_paths = []
+        missing = []
+        for countryiso3 in sorted(countryiso3s):
+            paths = self.get_country_paths(countryiso3)
+            if paths is None:
+                missing.append(countryiso3)
+                continue
+            country_paths.append(paths)
+        if missing:
+            logger.error(
+                f"No global dataset as there are no CSVs for {', '.join(missing)}!"
+            )
+            return None
+        if not country_paths:
+            logger.error("No data for global dataset!")
+            return None
+        name = self.global_dataset_name
+        title = "Global - HungerMap data"
+        logger.info(f"Creating dataset: {title}")
+        dataset = Dataset(
+            {
+                "name": name,
+                "title": title,
+            }
+        )
+        dataset.set_maintainer("196196be-6037-4488-8b71-d786adf4c081")
+        dataset.set_organization("3ecac442-7fed-448d-8f78-b385ef6f84e7")
+        dataset.set_expected_update_frequency("As needed")
+        dataset.set_subnational(True)
+        dataset.add_other_location("world")
+        dataset.add_tags(["hxl", "indicators", "food security"])
+
+        filenames = (
+            (f"{name}.csv", title),
+            (f"{name}-long.csv", f"{title} long format"),
+            (f"{name}-latest.csv", f"{title} latest values by country"),
+        )
+        results = write_global(
+            country_paths,
+            *(join(self.folder, filename) for filename, _ in filenames),
+            summary_headers,
+        )
+        dataset.set_time_period(
+            parse_iso_date(results["startdate"]), parse_iso_date(results["enddate"])
+        )
+        for filename, description in filenames:
+            resource = Resource({"name": filename, "description": description})
+            resource.set_format("csv")
+            resource.set_file_to_upload(join(self.folder, filename))
+            dataset.add_update_resource(resource)
+        logger.info(
+            f"Global dataset has {results['wide rows']} rows from {len(country_paths)} countries"
+        )
+        return dataset
+
+    def write_summaries(self, path):
+        """Write the summaries of the countries whose rows were generated in
+        this run and any planned subnational requests to a JSON file for
+        monitoring.
+
+        Args:
+            path (str): Path of JSON file
+
+        Returns:
+            Dict: Summaries as written
+        """
+        extras = {
+            countryiso3: {"requests": requests}
+            for countryiso3, requests in self.plans.items()
+        }
+        summaries = write_summaries(self.summaries, path, extras)
+        logger.info(f"Wrote summaries of {len(summaries)} countries to {path}")
+        return summaries
 
     def get_shared_countries(self):
         return self.shared_countries
+
+    def close(self):
+        self.save_failed_urls()
+        self.fetcher.close()
+        statistics = get_cache_statistics()
+        logger.info(
+            f"Date parsing: {statistics['hits']} hits, {statistics['misses']} misses "
+            f"({statistics['hit rate']:.0%} hit rate)"
+        )
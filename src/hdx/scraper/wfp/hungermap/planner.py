@@ -0,0 +1,117 @@
+#!/usr/bin/python
+"""
+Range planner:
+-------------
+
+Plans the date ranges of subnational requests on calendar boundaries so that
+the same ranges are requested every day and their responses can be cached.
+
+"""
+
+from dateutil.relativedelta import relativedelta
+
+
+def get_month_index(date):
+    return date.year * 12 + date.month - 1
+
+
+def get_month_start(date):
+    return date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def get_month_from_index(month_index, date):
+    """Get the start of a month from its index keeping the time zone of date.
+
+    Args:
+        month_index (int): Month index (year * 12 + month - 1)
+        date (datetime): Date whose time zone to use
+
+    Returns:
+        datetime: Start of month
+    """
+    year, month = divmod(month_index, 12)
+    return get_month_start(date).replace(year=year, month=month + 1)
+
+
+class RangePlanner:
+    """Plans subnational request windows aligned to calendar months. The month
+    containing the end date is requested on its own if it is incomplete as it
+    changes daily while complete months are merged into blocks of up to
+    max_months. Blocks are aligned to fixed boundaries (eg. calendar quarters
+    for 3 months) rather than to the range so that each block is requested
+    with the same dates on every day it is needed. Blocks at the start of the
+    range are cut short.
+    A window whose request fails can be split in two and a response with more
+    than max_records records means later windows should span fewer months.
+
+    Args:
+        max_months (int): Maximum number of months in one window. Defaults to 3.
+        max_records (Optional[int]): Records in a response above which windows are made smaller. Defaults to None (no limit).
+    """
+
+    def __init__(self, max_months=3, max_records=None):
+        self.max_months = max(1, max_months)
+        self.max_records = max_records
+
+    def plan(self, start_date, end_date, max_months=None):
+        """Get the windows covering the months from the one containing
+        start_date to end_date, newest first.
+
+        Args:
+            start_date (datetime): Date in first month
+            end_date (datetime): Last date
+            max_months (Optional[int]): Maximum number of months in one window. Defaults to None (max_months of planner).
+
+        Returns:
+            List[Tuple[datetime, datetime]]: Windows newest first
+        """
+        if max_months is None:
+            max_months = self.max_months
+        start_date = get_month_start(start_date)
+        if start_date > end_date:
+            return []
+        windows = []
+        last_index = get_month_index(end_date)
+        next_month_start = get_month_from_index(last_index + 1, end_date)
+        if end_date.date() < (next_month_start - relativedelta(days=1)).date():
+            # Incomplete month
+            windows.append((get_month_start(end_date), end_date))
+            last_index -= 1
+        first_index = get_month_index(start_date)
+        while last_index >= first_index:
+            block_index = max(last_index - last_index % max_months, first_index)
+            window_end = get_month_from_index(last_index + 1, end_date) - relativedelta(
+                days=1
+            )
+            windows.append((get_month_from_index(block_index, end_date), window_end))
+            last_index = block_index - 1
+        return windows
+
+    @staticmethod
+    def split(window):
+        """Split a window in two on a month boundary or if it is within one
+        month, on the 16th.
+
+        Args:
+            window (Tuple[datetime, datetime]): Window
+
+        Returns:
+            Optional[List[Tuple[datetime, datetime]]]: Two windows newest first or None if the window cannot be split
+        """
+        start_date, end_date = window
+        no_months = get_month_index(end_date) - get_month_index(start_date) + 1
+        if no_months > 1:
+            middle = get_month_start(start_date) + relativedelta(months=no_months // 2)
+        else:
+            middle = start_date.replace(day=16)
+            if not start_date < middle <= end_date:
+                return None
+        return [(middle, end_date), (start_date, middle - relativedelta(days=1))]
+
+    def is_too_large(self, no_records):
+        return self.max_records is not None and no_records > self.max_records
+
+    @staticmethod
+    def get_no_months(window):
+        start_date, end_date = window
+        return get_month_index(end_date) - get_month_index(start_date) + 1
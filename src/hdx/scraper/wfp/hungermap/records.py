@@ -0,0 +1,152 @@
+#!/usr/bin/python
+"""
+Records:
+-------
+
+Compact record type for HungerMap observations and the schema from which the
+headers and HXL hashtags of the wide and long CSVs are derived.
+
+"""
+
+from collections import namedtuple
+from sys import intern
+from typing import NamedTuple, Optional
+
+from hdx.scraper.wfp.hungermap.dates import parse_iso_date
+
+
+class Field(NamedTuple):
+    name: str
+    header: str
+    # None if the field is not written to the CSVs
+    hxltag: Optional[str]
+
+
+class Metric(NamedTuple):
+    key: str
+    name: str
+    header: str
+    output: bool
+
+
+# Metrics in the API's metrics dictionary. livelihoodCoping is only available
+# for some subnational data and is kept in records, tables and the store but not
+# written to the CSVs.
+metrics = (
+    Metric("fcs", "fcs", "fcs", True),
+    Metric("rcsi", "rcsi", "rcsi", True),
+    Metric("healthAccess", "health_access", "health access", True),
+    Metric("marketAccess", "market_access", "market access", True),
+    Metric("livelihoodCoping", "livelihood_coping", "livelihood coping", False),
+)
+
+id_fields = (
+    Field("countrycode", "countrycode", "#country+code"),
+    Field("countryname", "countryname", "#country+name"),
+    Field("adminone", "adminone", "#adm1+name"),
+    Field("adminlevel", "adminlevel", "#meta+adminlevel"),
+    Field("population", "population", "#population+total"),
+    Field("date", "date", "#date"),
+    Field("datatype", "datatype", "#data+type"),
+)
+
+
+def get_metric_fields(metric):
+    if metric.output:
+        hxltags = (f"#population+{metric.name}", f"#indicator+{metric.name}+prevalence")
+    else:
+        hxltags = (None, None)
+    return (
+        Field(f"{metric.name}_people", f"{metric.header} people", hxltags[0]),
+        Field(f"{metric.name}_prevalence", f"{metric.header} prevalence", hxltags[1]),
+    )
+
+
+# Fields written to the CSVs come first so that a record's values can be sliced
+field_metrics = [metric for metric in metrics if metric.output] + [
+    metric for metric in metrics if not metric.output
+]
+fields = list(id_fields)
+for metric in field_metrics:
+    fields.extend(get_metric_fields(metric))
+
+# Headers of every field with the HXL hashtag of those written to the CSVs
+record_hxltags = {field.header: field.hxltag for field in fields}
+hxltags = {header: hxltag for header, hxltag in record_hxltags.items() if hxltag}
+
+long_id_headers = [field.header for field in id_fields if field.header != "population"]
+
+long_hxltags = {header: hxltags[header] for header in long_id_headers}
+long_hxltags.update(
+    {
+        "indicator name": "#indicator+name",
+        "population": "#population",
+        "prevalence": "#indicator+prevalence",
+    }
+)
+
+# (indicator name, people header, prevalence header)
+long_indicators = [("total", "population", None)]
+long_indicators.extend(
+    (metric.header, f"{metric.header} people", f"{metric.header} prevalence")
+    for metric in metrics
+    if metric.output
+)
+
+empty_metric = {"people": "", "prevalence": ""}
+
+
+class Observation(namedtuple("Observation", [field.name for field in fields])):
+    """A national or subnational observation with one field per value. It is
+    a tuple with no per instance dictionary so is much smaller than the API's
+    nested dictionaries and repeated strings are interned.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_api(cls, countryiso3, countryname, data, region=None):
+        """Make an observation from a national or subnational record of the
+        HungerMap API.
+
+        Args:
+            countryiso3 (str): Country ISO3 code
+            countryname (str): Country name
+            data (Dict): National or subnational record
+            region (Optional[Dict]): Region of subnational record. Defaults to None.
+
+        Returns:
+            Observation: Observation
+        """
+        if region:
+            adminone = intern(region["name"])
+            adminlevel = "subnational"
+            population = region["population"]
+        else:
+            adminone = ""
+            adminlevel = "national"
+            population = ""
+        metric_values = []
+        data_metrics = data["metrics"]
+        for metric in field_metrics:
+            metric_data = data_metrics.get(metric.key) or empty_metric
+            metric_values.append(metric_data["people"])
+            metric_values.append(metric_data["prevalence"])
+        return cls(
+            intern(countryiso3),
+            countryname,
+            adminone,
+            adminlevel,
+            population,
+            intern(parse_iso_date(data["date"]).date().isoformat()),
+            intern(data["dataType"]),
+            *metric_values,
+        )
+
+    def get_values(self):
+        """Get the values of every field in the order of record_hxltags.
+
+        Returns:
+            Tuple: Values
+        """
+        return tuple(self)
@@ -0,0 +1,122 @@
+#!/usr/bin/python
+"""
+State:
+-----
+
+State kept in HDX between runs: the date watermark of each country and a hash
+of the content of its dataset used to skip uploading unchanged datasets.
+
+"""
+
+import hashlib
+import json
+
+from hdx.utilities.dateparse import iso_string_from_datetime, parse_date
+
+
+def state_str_to_dict(state_str):
+    """Convert a comma separated string of key=date or key=date;hash pairs eg.
+    "DEFAULT=2017-01-01,AFG=2024-01-01;3f2a..." to a dictionary with the
+    date watermarks under "dates" and the content hashes under "hashes". A
+    string without hashes as written before they were added is read too.
+
+    Args:
+        state_str (str): Comma separated string of key=date;hash pairs
+
+    Returns:
+        Dict: Dictionary of form {"dates": {key: date}, "hashes": {key: hash}}
+    """
+    dates = {}
+    hashes = {}
+    for keyvalue in state_str.strip().split(","):
+        key, value = keyvalue.split("=")
+        date, _, content_hash = value.partition(";")
+        dates[key] = parse_date(date)
+        if content_hash:
+            hashes[key] = content_hash
+    return {"dates": dates, "hashes": hashes}
+
+
+def dict_to_state_str(state):
+    """Convert a dictionary with date watermarks under "dates" and content
+    hashes under "hashes" to a comma separated string of key=date;hash pairs
+    (or key=date if there is no hash for the key). Keys with a hash but no
+    date watermark get the DEFAULT date.
+
+    Args:
+        state (Dict): Dictionary of form {"dates": {key: date}, "hashes": {key: hash}}
+
+    Returns:
+        str: Comma separated string of key=date;hash pairs
+    """
+    dates = state["dates"]
+    hashes = state["hashes"]
+    strlist = []
+    # Keys with a hash but no date, eg. from rebuilding, get the DEFAULT date
+    keys = [*dates, *(key for key in hashes if key not in dates)]
+    for key in keys:
+        valstr = iso_string_from_datetime(dates.get(key, dates["DEFAULT"]))
+        content_hash = hashes.get(key)
+        if content_hash:
+            strlist.append(f"{key}={valstr};{content_hash}")
+        else:
+            strlist.append(f"{key}={valstr}")
+    return ",".join(strlist)
+
+
+def remove_unpublished_countries(dates, countryiso3s):
+    """Remove the date watermarks of countries that are no longer published
+    so that an incremental walk back through national snapshots does not keep
+    looking for them. The DEFAULT watermark is kept.
+
+    Args:
+        dates (Dict[str, datetime]): Date watermarks by key
+        countryiso3s (Iterable[str]): ISO3 codes of published countries
+
+    Returns:
+        List[str]: ISO3 codes of countries removed
+    """
+    countryiso3s = set(countryiso3s)
+    removed = sorted(
+        key for key in dates if key != "DEFAULT" and key not in countryiso3s
+    )
+    for countryiso3 in removed:
+        del dates[countryiso3]
+    return removed
+
+
+def get_content_hash(dataset, showcase=None, extra=None, chunk_size=65536):
+    """Get a SHA-256 hash of what would be uploaded to HDX for a dataset: its
+    metadata, the metadata and file contents of its resources, the metadata
+    of its showcase and anything else that affects the upload such as the
+    disabled quickchart bites.
+
+    Args:
+        dataset (Dataset): Dataset with resources whose files are to be uploaded
+        showcase (Optional[Showcase]): Showcase. Defaults to None.
+        extra (Any): Other JSON serialisable values to include. Defaults to None.
+        chunk_size (int): Size of chunks in which files are read. Defaults to 65536.
+
+    Returns:
+        str: Hex digest
+    """
+
+    def update_json(value):
+        content_hash.update(
+            json.dumps(value, sort_keys=True, default=str).encode("utf-8")
+        )
+
+    content_hash = hashlib.sha256()
+    update_json(dataset.data)
+    for resource in dataset.get_resources():
+        update_json(resource.data)
+        path = resource.get_file_to_upload()
+        if not path:
+            continue
+        with open(path, "rb") as f:
+            while chunk := f.read(chunk_size):
+                content_hash.update(chunk)
+    if showcase:
+        update_json(showcase.data)
+    update_json(extra)
+    return content_hash.hexdigest()
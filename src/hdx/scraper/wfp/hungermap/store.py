@@ -0,0 +1,167 @@
+#!/usr/bin/python
+"""
+Store:
+-----
+
+Local SQLite store of HungerMap observations kept between runs.
+
+"""
+
+import sqlite3
+import threading
+from os import makedirs
+from os.path import dirname
+
+from hdx.scraper.wfp.hungermap.table import Table
+
+
+def quote(header):
+    return f'"{header}"'
+
+
+class ObservationStore:
+    """Stores national and subnational rows in an SQLite database with one
+    column per header. A row is identified by country, admin one (empty for
+    national rows), date and data type which is the primary key, so writing
+    the same rows again replaces rather than duplicates them. Rows of a
+    country are read back in the order of the CSVs: national before
+    subnational, newest first and then by admin one. Empty values are stored
+    as NULL and other values keep their type. The store can be used from
+    several threads.
+
+    Args:
+        path (str): Path of SQLite database
+        headers (List[str]): Headers of rows
+    """
+
+    key_headers = ("countrycode", "adminone", "date", "datatype")
+
+    def __init__(self, path, headers):
+        self.path = path
+        self.headers = list(headers)
+        folder = dirname(path)
+        if folder:
+            makedirs(folder, exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        columns = ", ".join(quote(header) for header in self.headers)
+        key = ", ".join(quote(header) for header in self.key_headers)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            # Columns have no type so that integers and floats are kept as is
+            self.connection.execute(
+                f"CREATE TABLE IF NOT EXISTS observations ({columns}, "
+                f"PRIMARY KEY ({key}))"
+            )
+            # Stores made before a header was added get a column for it
+            existing = {
+                row[1]
+                for row in self.connection.execute("PRAGMA table_info(observations)")
+            }
+            for header in self.headers:
+                if header not in existing:
+                    self.connection.execute(
+                        f"ALTER TABLE observations ADD COLUMN {quote(header)}"
+                    )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS observations_country_level_date "
+                'ON observations (countrycode, adminlevel, "date")'
+            )
+        placeholders = ", ".join("?" for _ in self.headers)
+        self.upsert_sql = (
+            f"INSERT OR REPLACE INTO observations ({columns}) VALUES ({placeholders})"
+        )
+        self.select_sql = f"SELECT {columns} FROM observations WHERE countrycode = ?"
+
+    def upsert(self, table):
+        """Write the rows of a table replacing any with the same country, admin
+        one, date and data type.
+
+        Args:
+            table (Table): Table with the store's headers
+
+        Returns:
+            int: Number of rows written
+        """
+        # Key columns keep empty values (admin one of national rows)
+        columns = [
+            table.columns[header]
+            if header in self.key_headers
+            else [None if value == "" else value for value in table.columns[header]]
+            for header in self.headers
+        ]
+        with self.lock, self.connection:
+            cursor = self.connection.executemany(self.upsert_sql, zip(*columns))
+        return cursor.rowcount
+
+    def get_last_date(self, countryiso3, adminlevel):
+        """Get the latest ISO date of a country's rows of an admin level.
+
+        Args:
+            countryiso3 (str): Country ISO3 code
+            adminlevel (str): "national" or "subnational"
+
+        Returns:
+            Optional[str]: Latest ISO date or None if there are no rows
+        """
+        with self.lock:
+            cursor = self.connection.execute(
+                'SELECT MAX("date") FROM observations '
+                "WHERE countrycode = ? AND adminlevel = ?",
+                (countryiso3, adminlevel),
+            )
+            return cursor.fetchone()[0]
+
+    def get_countries(self, start_date=None):
+        """Get the ISO3 codes of all countries in the store or if start_date
+        is given, of those with rows on or after it.
+
+        Args:
+            start_date (Optional[str]): Earliest ISO date of rows. Defaults to None (all).
+
+        Returns:
+            List[str]: Country ISO3 codes in sorted order
+        """
+        sql = "SELECT DISTINCT countrycode FROM observations"
+        parameters = []
+        if start_date:
+            sql = f'{sql} WHERE "date" >= ?'
+            parameters.append(start_date)
+        with self.lock:
+            cursor = self.connection.execute(f"{sql} ORDER BY countrycode", parameters)
+            return [row[0] for row in cursor]
+
+    def get_rows(self, countryiso3, hxltags, start_date=None, summary=None):
+        """Read a country's rows into a table in the order of the CSVs.
+
+        Args:
+            countryiso3 (str): Country ISO3 code
+            hxltags (Dict[str, str]): Mapping from header to HXL hashtag
+            start_date (Optional[str]): Earliest ISO date to include. Defaults to None (all).
+            summary (Optional[CountrySummary]): Summary to which to add rows. Defaults to None.
+
+        Returns:
+            Table: Rows of country
+        """
+        sql = self.select_sql
+        parameters = [countryiso3]
+        if start_date:
+            sql = f'{sql} AND "date" >= ?'
+            parameters.append(start_date)
+        # National rows have no admin one and are ordered as if it were "ZZZ"
+        sql = (
+            f'{sql} ORDER BY adminlevel, "date" DESC, '
+            "CASE adminone WHEN '' THEN 'ZZZ' ELSE adminone END, datatype"
+        )
+        table = Table(hxltags)
+        with self.lock:
+            for row in self.connection.execute(sql, parameters):
+                values = ["" if value is None else value for value in row]
+                table.append(values)
+                if summary:
+                    summary.add(values)
+        return table
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
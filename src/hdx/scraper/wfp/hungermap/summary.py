@@ -0,0 +1,201 @@
+#!/usr/bin/python
+"""
+Summary:
+-------
+
+Per country summary of rows accumulated while they are generated, from which
+the dataset time period and quickcharts are configured and a per run report is
+written for monitoring.
+
+"""
+
+from os import makedirs
+from os.path import dirname
+
+from hdx.scraper.wfp.hungermap.dates import parse_iso_date
+from hdx.scraper.wfp.hungermap.records import hxltags, long_indicators
+from hdx.utilities.dateparse import default_date, default_enddate
+from hdx.utilities.saver import save_json
+
+# Quickchart bites in the order of bites_disabled in hdx_resource_view_static.yaml
+bite_headers = ("fcs prevalence", "rcsi prevalence", "market access prevalence")
+
+index = {header: i for i, header in enumerate(hxltags)}
+adminlevel_index = index["adminlevel"]
+adminone_index = index["adminone"]
+date_index = index["date"]
+indicator_indices = [
+    (
+        indicator_name,
+        index[people_header],
+        index[prevalence_header] if prevalence_header else None,
+    )
+    for indicator_name, people_header, prevalence_header in long_indicators
+]
+
+
+class CountrySummary:
+    """Accumulates a summary of a country's wide rows as they are added: the
+    number of rows of each admin level, the earliest and latest dates, the
+    latest row of each admin level and for each indicator of the long CSV, the
+    number of rows with people and prevalence values and the latest date with
+    a value. The latest row of an admin level is the one that comes first in
+    the CSVs among those with the latest date, so the summary does not depend
+    on the order rows are added in.
+
+    Args:
+        countryiso3 (str): Country ISO3 code
+    """
+
+    def __init__(self, countryiso3):
+        self.countryiso3 = countryiso3
+        self.no_rows = {"national": 0, "subnational": 0}
+        # ISO dates so string comparison orders them
+        self.earliest_date = None
+        self.latest_date = None
+        self.latest_rows = {}
+        self.indicators = {
+            indicator_name: {"people": 0, "prevalence": 0, "latest date": None}
+            for indicator_name, _, _ in indicator_indices
+        }
+
+    @classmethod
+    def from_table(cls, countryiso3, table):
+        """Make a summary of the rows of a table.
+
+        Args:
+            countryiso3 (str): Country ISO3 code
+            table (Table): Wide table
+
+        Returns:
+            CountrySummary: Summary of rows
+        """
+        summary = cls(countryiso3)
+        rows = table.iterate_rows()
+        next(rows)
+        for row in rows:
+            summary.add(row)
+        return summary
+
+    def add(self, values):
+        """Add a wide row given as a sequence of values in the order of hxltags.
+
+        Args:
+            values (Sequence): Values in header order
+
+        Returns:
+            None
+        """
+        adminlevel = values[adminlevel_index]
+        date = values[date_index]
+        self.no_rows[adminlevel] = self.no_rows.get(adminlevel, 0) + 1
+        if self.earliest_date is None or date < self.earliest_date:
+            self.earliest_date = date
+        if self.latest_date is None or date > self.latest_date:
+            self.latest_date = date
+        latest_row = self.latest_rows.get(adminlevel)
+        if latest_row is None or date > latest_row[date_index]:
+            self.latest_rows[adminlevel] = values
+        elif (
+            date == latest_row[date_index]
+            and values[adminone_index] < latest_row[adminone_index]
+        ):
+            self.latest_rows[adminlevel] = values
+        for indicator_name, people_index, prevalence_index in indicator_indices:
+            if values[people_index] in ("", None):
+                continue
+            indicator = self.indicators[indicator_name]
+            indicator["people"] += 1
+            if prevalence_index is not None and values[prevalence_index] not in (
+                "",
+                None,
+            ):
+                indicator["prevalence"] += 1
+            if indicator["latest date"] is None or date > indicator["latest date"]:
+                indicator["latest date"] = date
+
+    def get_no_rows(self):
+        return sum(self.no_rows.values())
+
+    def has_subnational(self):
+        return self.no_rows.get("subnational", 0) > 0
+
+    def get_time_period(self):
+        """Get the earliest and latest dates of the rows.
+
+        Returns:
+            Tuple[datetime, datetime]: Earliest and latest dates (default_enddate and default_date if there are no rows)
+        """
+        if self.earliest_date is None:
+            return default_enddate, default_date
+        return parse_iso_date(self.earliest_date), parse_iso_date(self.latest_date)
+
+    def get_latest_row(self):
+        """Get the first row in the CSVs with the latest date. National rows
+        come first in the CSVs.
+
+        Returns:
+            Dict: Latest row keyed by header or empty dictionary if there are no rows
+        """
+        for adminlevel in sorted(self.latest_rows):
+            values = self.latest_rows[adminlevel]
+            if values[date_index] == self.latest_date:
+                return dict(zip(hxltags, values))
+        return {}
+
+    def get_bites_disabled(self):
+        """Get which of the fcs, rcsi and market access quickchart bites are
+        disabled because the latest row has no prevalence for them.
+
+        Returns:
+            Tuple[bool, bool, bool]: Whether each bite is disabled
+        """
+        latest_row = self.get_latest_row()
+        return tuple(not latest_row.get(header) for header in bite_headers)
+
+    def to_dict(self):
+        """Get the summary as a JSON serialisable dictionary.
+
+        Returns:
+            Dict: Summary
+        """
+        return {
+            "rows": dict(self.no_rows),
+            "earliest date": self.earliest_date,
+            "latest date": self.latest_date,
+            "latest rows": {
+                adminlevel: dict(zip(hxltags, values))
+                for adminlevel, values in sorted(self.latest_rows.items())
+            },
+            "indicators": {
+                indicator_name: dict(indicator)
+                for indicator_name, indicator in self.indicators.items()
+            },
+            "bites disabled": dict(zip(bite_headers, self.get_bites_disabled())),
+        }
+
+
+def write_summaries(summaries, path, extras=None):
+    """Write the summaries of countries to a JSON file keyed by ISO3 code.
+
+    Args:
+        summaries (Dict[str, CountrySummary]): Summary of each country
+        path (str): Path of JSON file
+        extras (Optional[Dict[str, Dict]]): Other values to include for each country. Defaults to None.
+
+    Returns:
+        Dict: Summaries as written
+    """
+    folder = dirname(path)
+    if folder:
+        makedirs(folder, exist_ok=True)
+    output = {
+        countryiso3: summaries[countryiso3].to_dict()
+        for countryiso3 in sorted(summaries)
+    }
+    if extras:
+        for countryiso3, extra in extras.items():
+            if countryiso3 in output:
+                output[countryiso3].update(extra)
+    save_json(output, path)
+    return output
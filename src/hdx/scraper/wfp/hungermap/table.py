@@ -0,0 +1,147 @@
+#!/usr/bin/python
+"""
+Table:
+-----
+
+Columnar storage of HungerMap rows.
+
+"""
+
+
+class Table:
+    """Holds rows as one list per column rather than one dictionary per row.
+    The column headers and HXL hashtags come from the given hxltags dictionary.
+    Columns whose HXL hashtag is None are kept but not written out. The length of a table is the number of rows that are written out which
+    includes the HXL hashtag row.
+
+    Args:
+        hxltags (Dict[str, str]): Mapping from header to HXL hashtag
+    """
+
+    def __init__(self, hxltags):
+        self.hxltags = hxltags
+        self.headers = list(hxltags)
+        self.output_headers = [header for header in self.headers if hxltags[header]]
+        self.columns = {header: [] for header in self.headers}
+
+    def __len__(self):
+        return len(self.columns[self.headers[0]]) + 1
+
+    def __eq__(self, other):
+        if not isinstance(other, Table):
+            return NotImplemented
+        return self.hxltags == other.hxltags and self.columns == other.columns
+
+    def get_no_data_rows(self):
+        return len(self.columns[self.headers[0]])
+
+    def append(self, values):
+        """Append a row given as a sequence of values in header order.
+
+        Args:
+            values (Sequence): Values in header order
+
+        Returns:
+            None
+        """
+        for column, value in zip(self.columns.values(), values):
+            column.append(value)
+
+    def append_dict(self, row):
+        """Append a row given as a dictionary keyed by header.
+
+        Args:
+            row (Dict): Row keyed by header
+
+        Returns:
+            None
+        """
+        for header, column in self.columns.items():
+            column.append(row[header])
+
+    def truncate(self, no_rows):
+        """Remove rows after the first no_rows.
+
+        Args:
+            no_rows (int): Number of rows to keep
+
+        Returns:
+            None
+        """
+        for column in self.columns.values():
+            del column[no_rows:]
+
+    def iterate_values(self, start=0):
+        """Iterate over rows from index start as lists of values in header
+        order.
+
+        Args:
+            start (int): Index of first row. Defaults to 0.
+
+        Returns:
+            Iterator[List]: Rows as lists
+        """
+        columns = list(self.columns.values())
+        for index in range(start, self.get_no_data_rows()):
+            yield [column[index] for column in columns]
+
+    def get_row(self, index):
+        return {header: column[index] for header, column in self.columns.items()}
+
+    def reorder(self, order):
+        """Reorder all columns by a list of row indices.
+
+        Args:
+            order (List[int]): Row indices in their new order
+
+        Returns:
+            None
+        """
+        for header, column in self.columns.items():
+            self.columns[header] = [column[i] for i in order]
+
+    def iterate_rows(self):
+        """Iterate over rows as lists of the values of the columns that are
+        written out, starting with the HXL hashtag row.
+
+        Returns:
+            Iterator[List]: Rows as lists
+        """
+        headers = self.output_headers
+        yield [self.hxltags[header] for header in headers]
+        yield from zip(*(self.columns[header] for header in headers))
+
+    def melt(self, hxltags, id_headers, indicators):
+        """Make a long table from this wide one. For each row, one long row is
+        made per indicator whose people column is not empty, keeping row order
+        and then indicator order.
+
+        Args:
+            hxltags (Dict[str, str]): Mapping from header to HXL hashtag for long table
+            id_headers (List[str]): Headers copied from each row
+            indicators (List[Tuple[str, str, Optional[str]]]): (indicator name, people header, prevalence header)
+
+        Returns:
+            Table: Long table
+        """
+        long_table = Table(hxltags)
+        no_rows = self.get_no_data_rows()
+        blank = [""] * no_rows
+        melt_columns = []
+        for indicator_name, people_header, prevalence_header in indicators:
+            if prevalence_header:
+                prevalences = self.columns[prevalence_header]
+            else:
+                prevalences = blank
+            melt_columns.append(
+                (indicator_name, self.columns[people_header], prevalences)
+            )
+        append = long_table.append
+        for index, id_values in enumerate(
+            zip(*(self.columns[header] for header in id_headers))
+        ):
+            for indicator_name, people, prevalences in melt_columns:
+                population = people[index]
+                if population:
+                    append((*id_values, indicator_name, population, prevalences[index]))
+        return long_table
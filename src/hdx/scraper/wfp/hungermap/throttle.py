@@ -0,0 +1,115 @@
+#!/usr/bin/python
+"""
+Throttle:
+--------
+
+Adaptive rate limiting and retry with backoff for the HungerMap API.
+
+"""
+
+import logging
+import threading
+from random import Random
+from time import monotonic, sleep
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveThrottle:
+    """Spaces requests from all threads so that they start no faster than the
+    current rate. The rate starts at calls per period and adapts between
+    min_rate and max_rate: it increases additively while requests succeed
+    within the target latency and decreases multiplicatively when latency is
+    higher, on server errors and most of all on rate limit (HTTP 429)
+    responses. A Retry-After pause applies to every thread. If min_rate and
+    max_rate are not given, the rate is fixed.
+
+    Args:
+        calls (int): Calls per period to start at
+        period (float): Period in seconds
+        min_rate (Optional[float]): Minimum calls per second. Defaults to None (starting rate).
+        max_rate (Optional[float]): Maximum calls per second. Defaults to None (starting rate).
+        target_latency (float): Latency in seconds above which to slow down. Defaults to 2.
+    """
+
+    def __init__(self, calls, period, min_rate=None, max_rate=None, target_latency=2.0):
+        self.rate = calls / period
+        if min_rate is None:
+            min_rate = self.rate
+        self.min_rate = min(min_rate, self.rate)
+        if max_rate is None:
+            max_rate = self.rate
+        self.max_rate = max(max_rate, self.rate)
+        # Reach max_rate from min_rate in about 100 successful requests
+        self.increase = (self.max_rate - self.min_rate) / 100
+        self.target_latency = target_latency
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def __call__(self):
+        with self.lock:
+            now = monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + 1 / self.rate
+        if start > now:
+            sleep(start - now)
+
+    def set_rate(self, rate):
+        rate = min(self.max_rate, max(self.min_rate, rate))
+        if rate != self.rate:
+            logger.debug(f"Request rate now {rate:.2f}/s")
+        self.rate = rate
+
+    def on_success(self, latency):
+        with self.lock:
+            if latency > self.target_latency:
+                self.set_rate(self.rate * 0.9)
+            else:
+                self.set_rate(self.rate + self.increase)
+
+    def on_error(self):
+        with self.lock:
+            self.set_rate(self.rate * 0.75)
+
+    def on_throttled(self, retry_after=None):
+        with self.lock:
+            self.set_rate(self.rate * 0.5)
+            if retry_after:
+                self.next_time = max(self.next_time, monotonic() + retry_after)
+
+
+class Backoff:
+    """Delays between retries growing exponentially from base_delay up to
+    max_delay with full jitter ie. a random delay between 0 and the
+    exponential value. A server's Retry-After is used if it is longer.
+
+    Args:
+        attempts (int): Maximum number of attempts including the first. Defaults to 5.
+        base_delay (float): Delay in seconds before jitter of first retry. Defaults to 1.
+        max_delay (float): Maximum delay in seconds before jitter. Defaults to 60.
+        seed (Optional[int]): Random seed. Defaults to None.
+    """
+
+    def __init__(self, attempts=5, base_delay=1.0, max_delay=60.0, seed=None):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.random = Random(seed)
+        self.lock = threading.Lock()
+
+    def get_delay(self, attempt, retry_after=None):
+        """Get the delay before a retry.
+
+        Args:
+            attempt (int): Number of attempts so far (1 for first retry)
+            retry_after (Optional[float]): Retry-After from server. Defaults to None.
+
+        Returns:
+            float: Delay in seconds
+        """
+        cap = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        with self.lock:
+            delay = self.random.uniform(0, cap)
+        if retry_after:
+            delay = max(delay, retry_after)
+        return delay
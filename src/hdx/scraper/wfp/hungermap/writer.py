@@ -0,0 +1,161 @@
+#!/usr/bin/python
+"""
+Writer:
+------
+
+Writes the wide and long CSVs of a country in a single pass over its rows and
+global CSVs from those of every country.
+
+"""
+
+from csv import reader, writer
+
+
+def write_wide_and_long(
+    wide_path, long_path, table, long_hxltags, long_id_headers, long_indicators
+):
+    """Write a table to a wide CSV and the long form of it to a second CSV at
+    the same time. Each wide row is written and then melted into one long row
+    per indicator whose people column is not empty so that the long table is
+    never held in memory. Columns not written out are left out of both CSVs.
+    The output is the same as that of
+    Dataset.generate_resource for the wide table and Table.melt.
+
+    Args:
+        wide_path (str): Path of wide CSV
+        long_path (str): Path of long CSV
+        table (Table): Wide table
+        long_hxltags (Dict[str, str]): Mapping from header to HXL hashtag for long CSV
+        long_id_headers (List[str]): Headers copied from each wide row to long rows
+        long_indicators (List[Tuple[str, str, Optional[str]]]): (indicator name, people header, prevalence header)
+
+    Returns:
+        Dict: Numbers of wide and long rows
+    """
+    headers = table.output_headers
+    index = {header: i for i, header in enumerate(headers)}
+    id_indices = [index[header] for header in long_id_headers]
+    indicator_indices = [
+        (
+            indicator_name,
+            index[people_header],
+            index[prevalence_header] if prevalence_header else None,
+        )
+        for indicator_name, people_header, prevalence_header in long_indicators
+    ]
+    no_wide_rows = 0
+    no_long_rows = 0
+    with (
+        open(wide_path, "w", encoding="utf-8", newline="") as wide_file,
+        open(long_path, "w", encoding="utf-8", newline="") as long_file,
+    ):
+        wide_writer = writer(wide_file, lineterminator="\n")
+        long_writer = writer(long_file, lineterminator="\n")
+        rows = table.iterate_rows()
+        wide_writer.writerow(headers)
+        wide_writer.writerow(next(rows))
+        long_writer.writerow(long_hxltags)
+        long_writer.writerow(long_hxltags.values())
+        for row in rows:
+            wide_writer.writerow(row)
+            no_wide_rows += 1
+            id_values = [row[i] for i in id_indices]
+            for indicator_name, people_index, prevalence_index in indicator_indices:
+                population = row[people_index]
+                if not population:
+                    continue
+                if prevalence_index is None:
+                    prevalence = ""
+                else:
+                    prevalence = row[prevalence_index]
+                long_writer.writerow(
+                    (*id_values, indicator_name, population, prevalence)
+                )
+                no_long_rows += 1
+    return {"wide rows": no_wide_rows, "long rows": no_long_rows}
+
+
+def write_global(
+    country_paths, global_path, global_long_path, summary_path, summary_headers
+):
+    """Write global wide and long CSVs by appending the rows of each country's
+    wide and long CSVs in the order given, one row at a time so that memory
+    use does not depend on the number of rows. The header and HXL hashtag rows
+    are written once. A summary CSV with one row per country is made from the
+    first national row of each wide CSV which is the latest as national rows
+    come first, newest first. Countries without national rows are not in the
+    summary.
+
+    Args:
+        country_paths (List[Tuple[str, str]]): (wide CSV path, long CSV path) of each country
+        global_path (str): Path of global wide CSV
+        global_long_path (str): Path of global long CSV
+        summary_path (str): Path of summary CSV
+        summary_headers (List[str]): Headers of wide CSV to include in summary
+
+    Returns:
+        Dict: Numbers of wide, long and summary rows and start and end dates
+    """
+    no_wide_rows = 0
+    no_long_rows = 0
+    no_summary_rows = 0
+    start_date = None
+    end_date = None
+    with (
+        open(global_path, "w", encoding="utf-8", newline="") as wide_file,
+        open(global_long_path, "w", encoding="utf-8", newline="") as long_file,
+        open(summary_path, "w", encoding="utf-8", newline="") as summary_file,
+    ):
+        wide_writer = writer(wide_file, lineterminator="\n")
+        long_writer = writer(long_file, lineterminator="\n")
+        summary_writer = writer(summary_file, lineterminator="\n")
+        for i, (wide_path, long_path) in enumerate(country_paths):
+            with open(wide_path, encoding="utf-8", newline="") as f:
+                rows = reader(f)
+                headers = next(rows)
+                hxltags = next(rows)
+                if i == 0:
+                    wide_writer.writerow(headers)
+                    wide_writer.writerow(hxltags)
+                    summary_indices = [
+                        headers.index(header) for header in summary_headers
+                    ]
+                    summary_writer.writerow(summary_headers)
+                    summary_writer.writerow(
+                        [hxltags[index] for index in summary_indices]
+                    )
+                    date_index = headers.index("date")
+                    adminlevel_index = headers.index("adminlevel")
+                summarised = False
+                for row in rows:
+                    if not summarised and row[adminlevel_index] == "national":
+                        summary_writer.writerow(
+                            [row[index] for index in summary_indices]
+                        )
+                        no_summary_rows += 1
+                        summarised = True
+                    wide_writer.writerow(row)
+                    no_wide_rows += 1
+                    # ISO dates so string comparison orders them
+                    date = row[date_index]
+                    if end_date is None or date > end_date:
+                        end_date = date
+                    if start_date is None or date < start_date:
+                        start_date = date
+            with open(long_path, encoding="utf-8", newline="") as f:
+                rows = reader(f)
+                headers = next(rows)
+                hxltags = next(rows)
+                if i == 0:
+                    long_writer.writerow(headers)
+                    long_writer.writerow(hxltags)
+                for row in rows:
+                    long_writer.writerow(row)
+                    no_long_rows += 1
+    return {
+        "wide rows": no_wide_rows,
+        "long rows": no_long_rows,
+        "summary rows": no_summary_rows,
+        "startdate": start_date,
+        "enddate": end_date,
+    }
@@ -7,7 +7,10 @@ from hdx.api.locations import Locations
 from hdx.data.vocabulary import Vocabulary
 from hdx.location.country import Country
 from hdx.scraper.wfp.hungermap.pipeline import Pipeline
+from hdx.utilities.dateparse import parse_date
+from hdx.utilities.downloader import Download
 from hdx.utilities.path import script_dir_plus_file
+from hdx.utilities.retriever import Retrieve
 from hdx.utilities.useragent import UserAgent
 
 
@@ -49,4 +52,50 @@ def configuration():
         "id": "4e61d464-4943-4e97-973a-84673c1aaa87",
         "name": "approved",
     }
-    return Configuration.read()
+    configuration = Configuration.read()
+    # The fixtures are of subnational windows relative to today
+    configuration["range_planner"] = {
+        **configuration["range_planner"],
+        "enabled": False,
+    }
+    return configuration
+
+
+@pytest.fixture
+def folder(tmp_path):
+    return str(tmp_path)
+
+
+@pytest.fixture(scope="session")
+def today():
+    return parse_date("2023-12-05")
+
+
+@pytest.fixture
+def retriever(folder, input_folder):
+    with Download() as downloader:
+        yield Retrieve(downloader, folder, input_folder, folder, False, True)
+
+
+@pytest.fixture
+def state_dict():
+    return {"DEFAULT": parse_date("2022-01-01")}
+
+
+@pytest.fixture
+def pipeline(configuration, retriever, folder, today, state_dict):
+    # With the national data of the saved snapshots from today
+    pipeline = Pipeline(configuration, retriever, folder, today)
+    pipeline.get_country_data(state_dict, max_days_ago=5)
+    yield pipeline
+    pipeline.close()
+
+
+def pytest_collection_modifyitems(config, items):
+    # Benchmarks are slow so only run when selected with -m benchmark
+    if "benchmark" in (config.option.markexpr or ""):
+        return
+    skip = pytest.mark.skip(reason="Select benchmarks with -m benchmark")
+    for item in items:
+        if item.get_closest_marker("benchmark"):
+            item.add_marker(skip)
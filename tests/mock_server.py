@@ -0,0 +1,375 @@
+#!/usr/bin/python
+"""
+Mock server:
+-----------
+
+Local stand-ins for the HungerMap API serving synthetic data with optional
+injected latency and failures, for load and soak testing, and for the parts of
+the HDX API used to clean up stale datasets.
+
+"""
+
+import argparse
+import json
+import logging
+import threading
+from abc import ABC, abstractmethod
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from random import Random
+from time import sleep
+from urllib.parse import parse_qsl, urlsplit
+
+from tests.synthetic import SyntheticAPI
+
+from hdx.utilities.dateparse import now_utc, parse_date
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundServer(ABC):
+    """HTTP server running in a background thread that can be used as a
+    context manager. Subclasses provide the request handler.
+
+    Args:
+        host (str): Host to listen on
+        port (int): Port to listen on (0 for any free port)
+    """
+
+    def __init__(self, host, port):
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self.get_handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @abstractmethod
+    def get_handler(self):
+        """Get the request handler class for the server.
+
+        Returns:
+            Type[BaseHTTPRequestHandler]: Request handler class
+        """
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info(f"{type(self).__name__} listening on {self.url}")
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class MockHungerMapServer(BackgroundServer):
+    """HTTP server that answers national (/country?days_ago=) and subnational
+    (/country/{iso3}/region?date_start=&date_end=) requests under any path
+    prefix using a SyntheticAPI. Failures are injected at random with the given
+    rates: HTTP 500 errors, bodies with a statusCode other than "200" and HTTP
+    429 rate limit responses with a Retry-After header. Subnational requests
+    spanning more than max_range_days days always get HTTP 500 as when the API
+    times out on large ranges. Each request is delayed by latency seconds. The
+    server runs in a background thread and can be used as a context manager.
+    Point country_url at url + "/v1/foodsecurity/country" to use it.
+
+    Args:
+        synthetic_api (SyntheticAPI): Source of responses
+        host (str): Host to listen on. Defaults to "127.0.0.1".
+        port (int): Port to listen on. Defaults to 0 (any free port).
+        latency (float): Seconds to wait before responding. Defaults to 0.
+        error_rate (float): Fraction of requests that get HTTP 500. Defaults to 0.
+        bad_status_rate (float): Fraction of requests with a non "200" statusCode. Defaults to 0.
+        rate_limit_rate (float): Fraction of requests that get HTTP 429. Defaults to 0.
+        retry_after (int): Retry-After seconds sent with HTTP 429. Defaults to 1.
+        seed (int): Random seed for failures. Defaults to 0.
+        max_range_days (Optional[int]): Longest subnational range answered. Defaults to None (no limit).
+    """
+
+    def __init__(
+        self,
+        synthetic_api,
+        host="127.0.0.1",
+        port=0,
+        latency=0,
+        error_rate=0,
+        bad_status_rate=0,
+        rate_limit_rate=0,
+        retry_after=1,
+        seed=0,
+        max_range_days=None,
+    ):
+        self.synthetic_api = synthetic_api
+        self.max_range_days = max_range_days
+        self.latency = latency
+        self.error_rate = error_rate
+        self.bad_status_rate = bad_status_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.random = Random(seed)
+        self.statistics = {
+            "requests": 0,
+            "errors": 0,
+            "bad statuses": 0,
+            "rate limited": 0,
+            "too large": 0,
+            "bytes": 0,
+        }
+        super().__init__(host, port)
+
+    def is_too_large(self, path):
+        """Check whether a request is for a subnational range longer than
+        max_range_days.
+
+        Args:
+            path (str): Path of request
+
+        Returns:
+            bool: Whether range is too long
+        """
+        if self.max_range_days is None:
+            return False
+        query = dict(parse_qsl(urlsplit(path).query))
+        if "date_start" not in query:
+            return False
+        start_date = date.fromisoformat(query["date_start"])
+        end_date = date.fromisoformat(query["date_end"])
+        if (end_date - start_date).days + 1 <= self.max_range_days:
+            return False
+        with self.lock:
+            self.statistics["too large"] += 1
+        return True
+
+    def get_fault(self):
+        """Decide which failure, if any, to inject for a request.
+
+        Returns:
+            Optional[str]: "error", "bad status", "rate limited" or None
+        """
+        with self.lock:
+            self.statistics["requests"] += 1
+            value = self.random.random()
+            for fault, rate, key in (
+                ("error", self.error_rate, "errors"),
+                ("bad status", self.bad_status_rate, "bad statuses"),
+                ("rate limited", self.rate_limit_rate, "rate limited"),
+            ):
+                if value < rate:
+                    self.statistics[key] += 1
+                    return fault
+                value -= rate
+        return None
+
+    def get_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if server.latency:
+                    sleep(server.latency)
+                fault = server.get_fault()
+                if fault == "error" or server.is_too_large(self.path):
+                    self.send_json(500, {"message": "Internal Server Error"})
+                    return
+                if fault == "rate limited":
+                    self.send_json(
+                        429,
+                        {"message": "Too Many Requests"},
+                        {"Retry-After": str(server.retry_after)},
+                    )
+                    return
+                rjson = server.synthetic_api.get_json(self.path)
+                if fault == "bad status":
+                    rjson = {"statusCode": "500", "body": {"message": "Error"}}
+                self.send_json(200, rjson)
+
+            def send_json(self, code, rjson, headers=None):
+                body = json.dumps(rjson).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                if headers:
+                    for key, value in headers.items():
+                        self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+                with server.lock:
+                    server.statistics["bytes"] += len(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        return Handler
+
+
+class MockHDXServer(BackgroundServer):
+    """HTTP server standing in for the CKAN action API of HDX with the
+    package_search action and the hdx_dataset_purge action that HDX uses for
+    deletions (or package_delete as in CKAN). Searches support a query of
+    "*:*" or "name:prefix*", a filter query of "organization:name", paging
+    with rows and start and limiting fields with fl, in which case groups
+    are returned as a list of names as Solr does. Every search and deletion
+    is recorded. Point hdx_url of an HDX Configuration at url to use it.
+
+    Args:
+        datasets (List[Dict]): Datasets with id, name, organization and groups
+        host (str): Host to listen on. Defaults to "127.0.0.1".
+        port (int): Port to listen on. Defaults to 0 (any free port).
+    """
+
+    delete_actions = ("hdx_dataset_purge", "package_delete")
+
+    def __init__(self, datasets, host="127.0.0.1", port=0):
+        self.datasets = {dataset["id"]: dataset for dataset in datasets}
+        self.searches = []
+        self.deleted = []
+        super().__init__(host, port)
+
+    def search(self, parameters):
+        with self.lock:
+            self.searches.append(parameters)
+            datasets = sorted(self.datasets.values(), key=lambda x: x["name"])
+        query = parameters.get("q", "*:*")
+        if query.startswith("name:") and query.endswith("*"):
+            prefix = query[5:-1]
+            datasets = [x for x in datasets if x["name"].startswith(prefix)]
+        filter_query = parameters.get("fq", "")
+        if filter_query.startswith("organization:"):
+            organization = filter_query[13:]
+            datasets = [
+                x for x in datasets if x["organization"]["name"] == organization
+            ]
+        count = len(datasets)
+        start = int(parameters.get("start", 0))
+        rows = int(parameters.get("rows", 1000))
+        datasets = datasets[start : start + rows]
+        fields = parameters.get("fl")
+        if fields:
+            results = []
+            for dataset in datasets:
+                result = {}
+                for field in fields.split(","):
+                    value = dataset.get(field)
+                    if field == "groups":
+                        value = [group["name"] for group in value]
+                    result[field] = value
+                results.append(result)
+        else:
+            results = datasets
+        return {"count": count, "results": results}
+
+    def delete(self, parameters):
+        with self.lock:
+            dataset = self.datasets.pop(parameters["id"], None)
+            if dataset is None:
+                return None
+            self.deleted.append(dataset["name"])
+        return None
+
+    def get_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.handle_action(dict(parse_qsl(urlsplit(self.path).query)))
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                parameters = json.loads(body) if body else {}
+                self.handle_action(parameters)
+
+            def handle_action(self, parameters):
+                action = urlsplit(self.path).path.rstrip("/").split("/")[-1]
+                if action == "package_search":
+                    result = server.search(parameters)
+                elif action in server.delete_actions and parameters.get("id") in (
+                    server.datasets
+                ):
+                    result = server.delete(parameters)
+                else:
+                    error = {"__type": "Not Found Error", "message": "Not found"}
+                    self.send_json(404, {"success": False, "error": error})
+                    return
+                self.send_json(200, {"success": True, "result": result})
+
+            def send_json(self, code, rjson):
+                body = json.dumps(rjson).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock HungerMap API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--today", help="Date of run. Defaults to today.")
+    parser.add_argument("--countries", help="Comma separated ISO3 codes")
+    parser.add_argument("--regions", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--bad-status-rate", type=float, default=0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--max-range-days", type=int)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    from hdx.location.country import Country
+
+    Country.countriesdata(use_live=False)
+    if args.today:
+        today = parse_date(args.today)
+    else:
+        today = now_utc()
+    if args.countries:
+        countryiso3s = args.countries.split(",")
+    else:
+        countryiso3s = None
+    synthetic_api = SyntheticAPI(today, countryiso3s, args.regions, args.seed)
+    server = MockHungerMapServer(
+        synthetic_api,
+        args.host,
+        args.port,
+        args.latency,
+        args.error_rate,
+        args.bad_status_rate,
+        args.rate_limit_rate,
+        args.retry_after,
+        args.seed,
+        args.max_range_days,
+    )
+    logger.info(
+        f"Set country_url to {server.url}/v1/foodsecurity/country to use this server"
+    )
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
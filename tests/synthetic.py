@@ -0,0 +1,206 @@
+#!/usr/bin/python
+"""
+Synthetic data:
+--------------
+
+Seeded synthetic HungerMap API responses for benchmarks and load testing.
+
+"""
+
+from datetime import timedelta
+from os.path import join
+from random import Random
+from urllib.parse import parse_qsl, urlsplit
+
+from dateutil.relativedelta import relativedelta
+
+from hdx.scraper.wfp.hungermap.dates import parse_iso_date
+from hdx.utilities.saver import save_json
+
+# Countries that HungerMap publishes survey data for
+synthetic_countries = [
+    "AGO",
+    "BEN",
+    "BFA",
+    "CAF",
+    "CIV",
+    "CMR",
+    "COD",
+    "COG",
+    "COL",
+    "ETH",
+    "GIN",
+    "GTM",
+    "HND",
+    "HTI",
+    "IRQ",
+    "KEN",
+    "LAO",
+    "MDG",
+    "MLI",
+    "MOZ",
+    "MRT",
+    "MWI",
+    "NAM",
+    "NER",
+    "NGA",
+    "SLE",
+    "SLV",
+    "SOM",
+    "SYR",
+    "TCD",
+    "TZA",
+    "UKR",
+    "YEM",
+    "ZMB",
+    "ZWE",
+]
+
+metric_names = ("fcs", "rcsi", "healthAccess", "marketAccess", "livelihoodCoping")
+
+
+class SyntheticAPI:
+    """Generates HungerMap API responses from a seed. The same URL always gives
+    the same response. National snapshots report each country's data with a
+    lag of a couple of days and subnational windows have one record per region
+    per day.
+
+    Args:
+        today (datetime): Date of run
+        countryiso3s (List[str]): Countries to generate. Defaults to synthetic_countries.
+        no_regions (int): Number of admin one regions per country. Defaults to 20.
+        seed (int): Random seed. Defaults to 0.
+        lag_days (int): Days between date of snapshot and data. Defaults to 2.
+    """
+
+    def __init__(self, today, countryiso3s=None, no_regions=20, seed=0, lag_days=2):
+        self.today = today
+        if countryiso3s is None:
+            countryiso3s = synthetic_countries
+        self.countryiso3s = countryiso3s
+        self.no_regions = no_regions
+        self.seed = seed
+        self.lag_days = lag_days
+
+    def get_random(self, *args):
+        return Random("-".join(str(arg) for arg in (self.seed, *args)))
+
+    def get_metrics(self, population, *args):
+        random = self.get_random(*args)
+        metrics = {}
+        for metric_name in metric_names:
+            prevalence = random.random()
+            metrics[metric_name] = {
+                "people": int(population * prevalence),
+                "prevalence": prevalence,
+            }
+        return metrics
+
+    def get_country(self, countryiso3):
+        # Not imported at module load as this module is only for testing
+        from hdx.location.country import Country
+
+        return {
+            "id": self.countryiso3s.index(countryiso3) + 1,
+            "name": Country.get_country_name_from_iso3(countryiso3),
+            "iso3": countryiso3,
+            "iso2": Country.get_iso2_from_iso3(countryiso3),
+        }
+
+    def get_population(self, *args):
+        return self.get_random("population", *args).randint(100000, 10000000)
+
+    def get_national(self, days_ago):
+        date = self.today - relativedelta(days=days_ago + self.lag_days)
+        date = date.date().isoformat()
+        countries = []
+        for countryiso3 in self.countryiso3s:
+            population = self.get_population(countryiso3)
+            countries.append(
+                {
+                    "country": self.get_country(countryiso3),
+                    "date": date,
+                    "dataType": "SURVEY",
+                    "metrics": self.get_metrics(population, countryiso3, date),
+                }
+            )
+        return {"statusCode": "200", "body": {"countries": countries}}
+
+    def get_subnational(self, countryiso3, date_start, date_end):
+        if countryiso3 not in self.countryiso3s:
+            return {"statusCode": "404", "body": []}
+        country = self.get_country(countryiso3)
+        regions = []
+        for i in range(self.no_regions):
+            regions.append(
+                {
+                    "id": i + 1,
+                    "name": f"Region {i + 1}",
+                    "population": self.get_population(countryiso3, i),
+                }
+            )
+        records = []
+        date = parse_iso_date(date_start)
+        end_date = parse_iso_date(date_end)
+        while date <= end_date:
+            date_str = date.date().isoformat()
+            for region in regions:
+                records.append(
+                    {
+                        "country": country,
+                        "region": region,
+                        "date": date_str,
+                        "dataType": "SURVEY",
+                        "metrics": self.get_metrics(
+                            region["population"],
+                            countryiso3,
+                            region["id"],
+                            date_str,
+                        ),
+                    }
+                )
+            date += timedelta(days=1)
+        return {"statusCode": "200", "body": records}
+
+    def get_json(self, url):
+        """Get the response for a national (?days_ago=) or subnational
+        (/{iso3}/region?date_start=&date_end=) URL.
+
+        Args:
+            url (str): URL or path and query
+
+        Returns:
+            Dict: Response
+        """
+        spliturl = urlsplit(url)
+        query = dict(parse_qsl(spliturl.query))
+        if "days_ago" in query:
+            return self.get_national(int(query["days_ago"]))
+        parts = spliturl.path.rstrip("/").split("/")
+        if parts[-1] == "region":
+            return self.get_subnational(
+                parts[-2].upper(), query["date_start"], query["date_end"]
+            )
+        return {"statusCode": "404", "body": None}
+
+    def save_fixtures(self, retriever, urls):
+        """Save the response for each URL where the retriever will look for
+        saved data.
+
+        Args:
+            retriever (Retrieve): Retrieve object
+            urls (Iterable[str]): URLs to save
+
+        Returns:
+            int: Number of records saved
+        """
+        no_records = 0
+        for url in urls:
+            rjson = self.get_json(url)
+            body = rjson["body"]
+            if isinstance(body, dict):
+                body = body["countries"]
+            no_records += len(body)
+            filename, _ = retriever.get_filename(url, None, ("json",))
+            save_json(rjson, join(retriever.saved_dir, filename))
+        return no_records
@@ -0,0 +1,291 @@
+#!/usr/bin/python
+"""
+Benchmarks for the pipeline using synthetic HungerMap responses.
+
+The size of the synthetic data can be set with the environment variables
+HUNGERMAP_BENCHMARK_COUNTRIES, HUNGERMAP_BENCHMARK_DAYS,
+HUNGERMAP_BENCHMARK_MONTHS and HUNGERMAP_BENCHMARK_REGIONS. A full size run
+is 35 countries, 365 days, 12 months and 20 regions.
+
+"""
+
+import json
+import subprocess
+import sys
+import tracemalloc
+from os import environ, getenv, pathsep
+from os.path import join
+
+import pytest
+
+from tests.synthetic import SyntheticAPI, synthetic_countries
+
+from hdx.api.locations import Locations
+from hdx.data.dataset import Dataset
+from hdx.scraper.wfp.hungermap.pipeline import (
+    Pipeline,
+    long_hxltags,
+    long_id_headers,
+    long_indicators,
+)
+from hdx.scraper.wfp.hungermap.writer import write_wide_and_long
+from hdx.utilities.dateparse import parse_date
+from hdx.utilities.downloader import Download
+from hdx.utilities.path import temp_dir
+from hdx.utilities.retriever import Retrieve
+
+no_countries = int(getenv("HUNGERMAP_BENCHMARK_COUNTRIES", 3))
+max_days_ago = int(getenv("HUNGERMAP_BENCHMARK_DAYS", 30))
+max_months_ago = int(getenv("HUNGERMAP_BENCHMARK_MONTHS", 3))
+no_regions = int(getenv("HUNGERMAP_BENCHMARK_REGIONS", 10))
+
+
+def get_peak_mb(function, *args):
+    """Call function once more outside the benchmark, returning the peak size
+    in MB of memory allocated while it runs."""
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    finally:
+        tracemalloc.stop()
+
+
+def add_extra_info(benchmark, no_rows, peak_mb):
+    benchmark.extra_info["rows"] = no_rows
+    # There are no stats when benchmarks are disabled
+    if benchmark.stats:
+        benchmark.extra_info["rows per second"] = no_rows / benchmark.stats.stats.mean
+    benchmark.extra_info["peak mb"] = peak_mb
+
+
+# Imported when creating datasets in HDX but not when only fetching
+hdx_client_modules = ("hdx.api", "hdx.data", "ckanapi", "hxl", "hdx.location")
+
+
+def run_python(code):
+    # A new interpreter with the same path so modules are imported afresh
+    env = dict(environ, PYTHONPATH=pathsep.join(sys.path))
+    return subprocess.run(
+        [sys.executable, "-W", "ignore", "-c", code],
+        check=True,
+        capture_output=True,
+        env=env,
+        text=True,
+    ).stdout
+
+
+def time_import(module):
+    """Import module in a new interpreter, returning the seconds taken and
+    which of hdx_client_modules were imported."""
+    code = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        f"import {module}\n"
+        "seconds = time.perf_counter() - start\n"
+        f"modules = [m for m in {hdx_client_modules!r} if m in sys.modules]\n"
+        "print(json.dumps({'seconds': seconds, 'modules': modules}))\n"
+    )
+    return json.loads(run_python(code))
+
+
+@pytest.mark.benchmark(group="import")
+class TestImportTime:
+    @pytest.mark.parametrize(
+        "module,hdx_client",
+        [
+            ("hdx.scraper.wfp.hungermap.__main__", False),
+            ("hdx.scraper.wfp.hungermap.fetch_only", False),
+            ("hdx.api.configuration", True),
+        ],
+    )
+    def test_import_time(self, benchmark, module, hdx_client):
+        results = benchmark.pedantic(time_import, args=(module,), rounds=3)
+        benchmark.extra_info["import seconds"] = results["seconds"]
+        benchmark.extra_info["hdx client modules"] = results["modules"]
+        assert bool(results["modules"]) is hdx_client
+
+    def test_get_country_name(self, benchmark):
+        # Country names come from a precomputed table not the country data
+        code = (
+            "import sys\n"
+            "from hdx.scraper.wfp.hungermap.countries import get_country_name\n"
+            "assert get_country_name('COD') == "
+            "'Democratic Republic of the Congo'\n"
+            "assert 'hdx.location.country' not in sys.modules\n"
+        )
+        benchmark.pedantic(run_python, args=(code,), rounds=3)
+
+
+@pytest.mark.benchmark(group="pipeline")
+class TestBenchmark:
+    today = parse_date("2023-12-05")
+    state = {"DEFAULT": parse_date("2022-01-01")}
+
+    @pytest.fixture(scope="class", autouse=True)
+    def locations(self, configuration):
+        validlocations = Locations.validlocations()
+        Locations.set_validlocations(
+            [
+                {"name": countryiso3.lower(), "title": countryiso3}
+                for countryiso3 in synthetic_countries
+            ]
+        )
+        yield
+        Locations.set_validlocations(validlocations)
+
+    @pytest.fixture(scope="class")
+    def folder(self):
+        with temp_dir(
+            "test_wfp_hungermaps_benchmark",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as folder:
+            yield folder
+
+    @pytest.fixture(scope="class")
+    def retriever(self, configuration, folder):
+        saved_dir = join(folder, "saved")
+        with Download() as downloader:
+            retriever = Retrieve(downloader, folder, saved_dir, folder, True, False)
+            synthetic_api = SyntheticAPI(
+                self.today, synthetic_countries[:no_countries], no_regions
+            )
+            country_url = configuration["country_url"]
+            urls = [f"{country_url}?days_ago={i}" for i in range(max_days_ago)]
+            pipeline = Pipeline(configuration, retriever, folder, self.today)
+            for countryiso3 in synthetic_api.countryiso3s:
+                for start_date, end_date in pipeline.get_windows(max_months_ago):
+                    urls.append(
+                        f"{country_url}/{countryiso3}/region?date_start={start_date.date().isoformat()}&date_end={end_date.date().isoformat()}"
+                    )
+            synthetic_api.save_fixtures(retriever, urls)
+            yield Retrieve(downloader, folder, saved_dir, folder, False, True)
+
+    def get_pipeline(self, configuration, retriever, folder):
+        pipeline = Pipeline(configuration, retriever, folder, self.today)
+        pipeline.get_country_data(dict(self.state), max_days_ago=max_days_ago)
+        return pipeline
+
+    @pytest.fixture(scope="class")
+    def pipeline(self, configuration, retriever, folder):
+        return self.get_pipeline(configuration, retriever, folder)
+
+    @pytest.fixture(scope="class")
+    def country_rows(self, pipeline):
+        return {
+            countryiso3: pipeline.get_rows(countryiso3, max_months_ago=max_months_ago)
+            for countryiso3 in pipeline.countries_data
+        }
+
+    def test_get_country_data(self, benchmark, configuration, retriever, folder):
+        def setup():
+            pipeline = Pipeline(configuration, retriever, folder, self.today)
+            return (pipeline, dict(self.state)), {}
+
+        def get_country_data(pipeline, state):
+            return pipeline.get_country_data(state, max_days_ago=max_days_ago)
+
+        countries = benchmark.pedantic(
+            get_country_data, setup=setup, rounds=5, warmup_rounds=1
+        )
+        assert len(countries) == no_countries
+        peak_mb = get_peak_mb(get_country_data, *setup()[0])
+        add_extra_info(benchmark, no_countries * max_days_ago, peak_mb)
+
+    def test_get_rows(self, benchmark, pipeline):
+        def get_rows():
+            return [
+                pipeline.get_rows(countryiso3, max_months_ago=max_months_ago)
+                for countryiso3 in pipeline.countries_data
+            ]
+
+        results = benchmark(get_rows)
+        assert len(results) == no_countries
+        no_rows = sum(len(result[0]) - 1 for result in results)
+        add_extra_info(benchmark, no_rows, get_peak_mb(get_rows))
+
+    def test_generate_dataset_and_showcase(self, benchmark, pipeline, country_rows):
+        def generate_datasets_and_showcases():
+            for countryiso3, (
+                rows,
+                earliest_date,
+                latest_date,
+                has_subnational,
+            ) in country_rows.items():
+                pipeline.generate_dataset_and_showcase(
+                    countryiso3, rows, earliest_date, latest_date, has_subnational
+                )
+
+        benchmark(generate_datasets_and_showcases)
+        no_rows = sum(len(result[0]) - 1 for result in country_rows.values())
+        add_extra_info(benchmark, no_rows, get_peak_mb(generate_datasets_and_showcases))
+
+    def test_generate_resources(self, benchmark, folder, country_rows):
+        # Writing wide and long CSVs separately with Dataset.generate_resource
+        no_rows = 0
+
+        def write_csvs():
+            nonlocal no_rows
+            no_rows = 0
+            dataset = Dataset()
+            for countryiso3, (rows, _, _, _) in country_rows.items():
+                filename = f"benchmark-{countryiso3}.csv"
+                dataset.generate_resource(
+                    folder,
+                    filename,
+                    rows.iterate_rows(),
+                    {"name": filename, "description": ""},
+                    rows.output_headers,
+                )
+                long_rows = rows.melt(long_hxltags, long_id_headers, long_indicators)
+                no_rows += rows.get_no_data_rows() + long_rows.get_no_data_rows()
+                filename = f"benchmark-{countryiso3}-long.csv"
+                dataset.generate_resource(
+                    folder,
+                    filename,
+                    long_rows.iterate_rows(),
+                    {"name": filename, "description": ""},
+                    long_rows.output_headers,
+                )
+
+        benchmark(write_csvs)
+        add_extra_info(benchmark, no_rows, get_peak_mb(write_csvs))
+
+    def test_write_wide_and_long(self, benchmark, folder, country_rows):
+        no_rows = 0
+
+        def write_csvs():
+            nonlocal no_rows
+            no_rows = 0
+            for countryiso3, (rows, _, _, _) in country_rows.items():
+                results = write_wide_and_long(
+                    join(folder, f"benchmark-{countryiso3}.csv"),
+                    join(folder, f"benchmark-{countryiso3}-long.csv"),
+                    rows,
+                    long_hxltags,
+                    long_id_headers,
+                    long_indicators,
+                )
+                no_rows += results["wide rows"] + results["long rows"]
+
+        benchmark(write_csvs)
+        add_extra_info(benchmark, no_rows, get_peak_mb(write_csvs))
+
+    def test_total_time(self, benchmark, configuration, retriever, folder):
+        # One pass through all stages to report overall throughput
+        def run():
+            pipeline = self.get_pipeline(configuration, retriever, folder)
+            no_rows = 0
+            for countryiso3 in pipeline.countries_data:
+                rows, earliest_date, latest_date, has_subnational = pipeline.get_rows(
+                    countryiso3, max_months_ago=max_months_ago
+                )
+                no_rows += rows.get_no_data_rows()
+                pipeline.generate_dataset_and_showcase(
+                    countryiso3, rows, earliest_date, latest_date, has_subnational
+                )
+            return no_rows
+
+        no_rows = benchmark.pedantic(run, rounds=1, iterations=1)
+        add_extra_info(benchmark, no_rows, get_peak_mb(run))
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+"""
+Benchmarks for ordering of rows.
+
+"""
+
+from random import Random
+
+import pytest
+
+from hdx.scraper.wfp.hungermap.ordering import get_order, get_sort_keys
+from hdx.scraper.wfp.hungermap.pipeline import Pipeline
+from hdx.utilities.dateparse import parse_date
+from hdx.utilities.downloader import Download
+from hdx.utilities.path import temp_dir
+from hdx.utilities.retriever import Retrieve
+
+
+class reverser:
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __eq__(self, other):
+        return other.obj == self.obj
+
+    def __lt__(self, other):
+        return other.obj < self.obj
+
+
+def get_legacy_order(adminlevels, dates, adminones):
+    return sorted(
+        range(len(dates)),
+        key=lambda i: (
+            adminlevels[i],
+            reverser(dates[i]),
+            adminones[i] if adminones[i] else "ZZZ",
+        ),
+    )
+
+
+def get_precomputed_order(adminlevels, dates, adminones):
+    keys = get_sort_keys(adminlevels, dates, adminones)
+    return get_order(keys, [(0, len(keys))])
+
+
+class TestOrdering:
+    @pytest.fixture(scope="class")
+    def columns(self, configuration, input_folder):
+        with temp_dir(
+            "test_wfp_hungermaps_ordering",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as folder:
+            with Download() as downloader:
+                retriever = Retrieve(
+                    downloader, folder, input_folder, folder, False, True
+                )
+                today = parse_date("2023-12-05")
+                pipeline = Pipeline(configuration, retriever, folder, today)
+                state_dict = {"DEFAULT": parse_date("2022-01-01")}
+                pipeline.get_country_data(state_dict, max_days_ago=5)
+                rows, _, _, _ = pipeline.get_rows("COD", max_months_ago=5)
+                pipeline.close()
+        columns = rows.columns
+        shuffled = list(range(rows.get_no_data_rows()))
+        Random(1).shuffle(shuffled)
+        return tuple(
+            [columns[header][i] for i in shuffled]
+            for header in ("adminlevel", "date", "adminone")
+        )
+
+    def test_order_unchanged(self, columns):
+        expected = get_legacy_order(*columns)
+        assert get_precomputed_order(*columns) == expected
+        # runs that overlap are merged
+        keys = get_sort_keys(*columns)
+        no_rows = len(keys)
+        runs = [
+            (0, no_rows // 3),
+            (no_rows // 3, no_rows // 2),
+            (no_rows // 2, no_rows),
+        ]
+        assert get_order(keys, runs) == expected
+
+    @pytest.mark.benchmark(group="ordering")
+    def test_legacy_ordering(self, benchmark, columns):
+        benchmark(get_legacy_order, *columns)
+
+    @pytest.mark.benchmark(group="ordering")
+    def test_precomputed_ordering(self, benchmark, columns):
+        benchmark(get_precomputed_order, *columns)
@@ -4,155 +4,1624 @@ Unit tests for WFP ADAM.
 
 """
 
+import gzip
+import json
+import subprocess
+import sys
+from copy import copy
 from datetime import datetime, timezone
-from os.path import join
+from functools import partial
+from glob import glob
+from io import BytesIO
+from os import environ, makedirs, pathsep
+from os.path import exists, join
+from shutil import copy2
+from time import sleep
+from types import SimpleNamespace
 
-from hdx.scraper.wfp.hungermap.pipeline import Pipeline
+import pytest
+
+from tests.mock_server import MockHDXServer, MockHungerMapServer
+from tests.synthetic import SyntheticAPI
+
+from hdx.api.configuration import Configuration
+from hdx.api.locations import Locations
+from hdx.location.country import Country
+from hdx.scraper.wfp.hungermap.__main__ import create_dataset, process_countries
+from hdx.scraper.wfp.hungermap.backfill import Backfill, get_monthly_windows
+from hdx.scraper.wfp.hungermap.cache import ResponseCache
+from hdx.scraper.wfp.hungermap.cleanup import StaleDatasetCleanup
+from hdx.scraper.wfp.hungermap.countries import get_country_name, get_country_names
+from hdx.scraper.wfp.hungermap.dates import get_cache_statistics, parse_iso_date
+from hdx.scraper.wfp.hungermap.fetch import Fetcher, iterate_records
+from hdx.scraper.wfp.hungermap.fetch_only import fetch_only
+from hdx.scraper.wfp.hungermap.instrumentation import Instrumentation
+from hdx.scraper.wfp.hungermap.pipeline import (
+    Pipeline,
+    hxltags,
+    long_hxltags,
+    long_id_headers,
+    long_indicators,
+    record_hxltags,
+    summary_headers,
+    write_country,
+    write_country_files,
+)
+from hdx.scraper.wfp.hungermap.planner import RangePlanner
+from hdx.scraper.wfp.hungermap.records import Observation
+from hdx.scraper.wfp.hungermap.state import (
+    dict_to_state_str,
+    get_content_hash,
+    remove_unpublished_countries,
+    state_str_to_dict,
+)
+from hdx.scraper.wfp.hungermap.store import ObservationStore
+from hdx.scraper.wfp.hungermap.summary import CountrySummary
+from hdx.scraper.wfp.hungermap.table import Table
+from hdx.scraper.wfp.hungermap.throttle import AdaptiveThrottle, Backoff
+from hdx.scraper.wfp.hungermap.writer import write_global
+from hdx.utilities.base_downloader import DownloadError
 from hdx.utilities.compare import assert_files_same
 from hdx.utilities.dateparse import parse_date
 from hdx.utilities.downloader import Download
+from hdx.utilities.loader import load_text
 from hdx.utilities.path import temp_dir
 from hdx.utilities.retriever import Retrieve
+from hdx.utilities.saver import save_json, save_text
 
 
 class TestPipeline:
     def test_generate_datasets_and_showcases(
+        self, pipeline, state_dict, folder, fixtures
+    ):
+        assert len(pipeline.countries_data) == 35
+
+        rows, earliest_date, latest_date, has_subnational = pipeline.get_rows(
+            "COD", max_months_ago=5
+        )
+        assert len(rows) == 3620
+        assert earliest_date == parse_date("2023-07-05")
+        assert latest_date == parse_date("2023-11-20")
+
+        (
+            dataset,
+            showcase,
+            bites_disabled,
+        ) = pipeline.generate_dataset_and_showcase(
+            "COD", rows, earliest_date, latest_date, has_subnational
+        )
+        assert has_subnational is True
+        assert dataset == {
+            "data_update_frequency": "-2",
+            "dataset_date": "[2023-07-05T00:00:00 TO 2023-11-20T23:59:59]",
+            "groups": [{"name": "cod"}],
+            "maintainer": "196196be-6037-4488-8b71-d786adf4c081",
+            "name": "wfp-hungermap-data-for-cod",
+            "owner_org": "3ecac442-7fed-448d-8f78-b385ef6f84e7",
+            "subnational": "1",
+            "tags": [
+                {
+                    "name": "hxl",
+                    "vocabulary_id": "4e61d464-4943-4e97-973a-84673c1aaa87",
+                },
+                {
+                    "name": "indicators",
+                    "vocabulary_id": "4e61d464-4943-4e97-973a-84673c1aaa87",
+                },
+                {
+                    "name": "food security",
+                    "vocabulary_id": "4e61d464-4943-4e97-973a-84673c1aaa87",
+                },
+            ],
+            "title": "Democratic Republic of the Congo - HungerMap data",
+        }
+        resources = dataset.get_resources()
+        assert resources == [
+            {
+                "description": "Democratic Republic of the Congo - HungerMap data",
+                "format": "csv",
+                "name": "wfp-hungermap-data-for-cod.csv",
+            },
+            {
+                "description": "Democratic Republic of the Congo - HungerMap data long "
+                "format",
+                "format": "csv",
+                "name": "wfp-hungermap-data-for-cod-long.csv",
+            },
+        ]
+        for resource in resources:
+            filename = resource["name"]
+            expected_path = join(fixtures, filename)
+            actual_path = join(folder, filename)
+            assert_files_same(expected_path, actual_path)
+
+        assert showcase == {
+            "image_url": "https://www.wfp.org/sites/default/files/2020-11/migrated-story-hero-images/1%2AwHonqWsryfHjnj3FRQS_xA.png",
+            "name": "wfp-hungermap-data-for-cod-showcase",
+            "notes": "HungerMap LIVE",
+            "tags": [
+                {
+                    "name": "hxl",
+                    "vocabulary_id": "4e61d464-4943-4e97-973a-84673c1aaa87",
+                },
+                {
+                    "name": "indicators",
+                    "vocabulary_id": "4e61d464-4943-4e97-973a-84673c1aaa87",
+                },
+                {
+                    "name": "food security",
+                    "vocabulary_id": "4e61d464-4943-4e97-973a-84673c1aaa87",
+                },
+            ],
+            "title": "Democratic Republic of the Congo - HungerMap data showcase",
+            "url": "https://hungermap.wfp.org/",
+        }
+
+        assert bites_disabled == (False, False, False)
+
+        assert state_dict == {
+            "AGO": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "BEN": datetime(2022, 1, 11, 0, 0, tzinfo=timezone.utc),
+            "BFA": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "CAF": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "CIV": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "CMR": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "COD": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "COG": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "COL": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "DEFAULT": datetime(2022, 1, 1, 0, 0, tzinfo=timezone.utc),
+            "ETH": datetime(2023, 6, 12, 0, 0, tzinfo=timezone.utc),
+            "GIN": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "GTM": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "HND": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "HTI": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "IRQ": datetime(2023, 5, 7, 0, 0, tzinfo=timezone.utc),
+            "KEN": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "LAO": datetime(2023, 7, 26, 0, 0, tzinfo=timezone.utc),
+            "MDG": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "MLI": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "MOZ": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "MRT": datetime(2023, 7, 13, 0, 0, tzinfo=timezone.utc),
+            "MWI": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "NAM": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "NER": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "NGA": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "SLE": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "SLV": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "SOM": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "SYR": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "TCD": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "TZA": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "UKR": datetime(2023, 9, 3, 0, 0, tzinfo=timezone.utc),
+            "YEM": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "ZMB": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            "ZWE": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+        }
+
+    def test_get_country_data_concurrent(self, configuration, input_folder):
+        national_concurrency = configuration["national_concurrency"]
+        results = []
+        try:
+            for concurrency in (1, 3):
+                configuration["national_concurrency"] = concurrency
+                with temp_dir(
+                    "test_wfp_hungermaps_concurrent",
+                    delete_on_success=True,
+                    delete_on_failure=False,
+                ) as folder:
+                    with Download() as downloader:
+                        retriever = Retrieve(
+                            downloader, folder, input_folder, folder, False, True
+                        )
+                        today = parse_date("2023-12-05")
+                        pipeline = Pipeline(configuration, retriever, folder, today)
+                        state_dict = {"DEFAULT": parse_date("2022-01-01")}
+                        countries = pipeline.get_country_data(
+                            state_dict, max_days_ago=5
+                        )
+                        results.append((countries, state_dict, pipeline.countries_data))
+                        pipeline.close()
+        finally:
+            configuration["national_concurrency"] = national_concurrency
+        assert results[0] == results[1]
+
+    def test_get_country_data_incremental(
         self,
         configuration,
         input_folder,
-        fixtures,
+        retriever,
+        folder,
+        today,
+        pipeline,
+        state_dict,
+    ):
+        shared_countries = pipeline.get_shared_countries()
+        countries_data = pipeline.countries_data
+        pipeline.close()
+
+        pipeline = Pipeline(configuration, retriever, folder, today)
+        incremental_state_dict = copy(state_dict)
+        countries = pipeline.get_country_data(
+            incremental_state_dict, max_days_ago=5, incremental=True
+        )
+        assert countries == []
+        assert incremental_state_dict == state_dict
+        assert pipeline.get_shared_countries() == shared_countries
+        pipeline.close()
+
+        # A country no longer published stops the walk ending early
+        # until its watermark is removed
+        unpublished_state_dict = {**state_dict, "AAA": state_dict["COD"]}
+        no_requests = []
+        removed = []
+        for _ in range(2):
+            instrumentation = Instrumentation()
+            pipeline = Pipeline(
+                configuration, retriever, folder, today, None, instrumentation
+            )
+            pipeline.get_country_data(
+                unpublished_state_dict, max_days_ago=5, incremental=True
+            )
+            report = instrumentation.get_report()
+            no_requests.append(report["requests"][0]["count"])
+            removed.append(
+                remove_unpublished_countries(
+                    unpublished_state_dict, pipeline.get_shared_countries()
+                )
+            )
+            pipeline.close()
+        assert no_requests[0] == 5
+        # Requests already in flight still complete
+        assert no_requests[1] < 5
+        assert removed == [["AAA"], []]
+        assert unpublished_state_dict == state_dict
+
+        # National snapshots that failed in the last run stop the walk ending
+        # early
+        instrumentation = Instrumentation()
+        pipeline = Pipeline(
+            configuration, retriever, folder, today, None, instrumentation
+        )
+        pipeline.national_failed = True
+        pipeline.get_country_data(copy(state_dict), max_days_ago=5, incremental=True)
+        assert instrumentation.get_report()["requests"][0]["count"] == 5
+        pipeline.close()
+
+        # With the history of each country in the store up to its
+        # watermark, the walk stops once the watermarks are reached
+        # even though there is new data
+        rjson = json.loads(
+            load_text(join(input_folder, "foodsecurity-country-days-ago-1.json"))
+        )
+        watermarks = {"DEFAULT": state_dict["DEFAULT"]}
+        for country in rjson["body"]["countries"]:
+            if country["dataType"] != "PREDICTION":
+                countryiso3 = country["country"]["iso3"]
+                watermarks[countryiso3] = parse_iso_date(country["date"])
+        store = ObservationStore(join(folder, "store.sqlite"), record_hxltags)
+        rows = Table(record_hxltags)
+        for countryiso3, observations in countries_data.items():
+            for observation in observations:
+                if parse_iso_date(observation.date) <= watermarks[countryiso3]:
+                    rows.append(observation.get_values())
+        store.upsert(rows)
+        serial_configuration = {**configuration, "national_concurrency": 1}
+        no_requests = []
+        new_countries = []
+        for pipeline_store in (None, store):
+            instrumentation = Instrumentation()
+            pipeline = Pipeline(
+                serial_configuration,
+                retriever,
+                folder,
+                today,
+                None,
+                instrumentation,
+                pipeline_store,
+            )
+            countries = pipeline.get_country_data(
+                copy(watermarks), max_days_ago=5, incremental=True
+            )
+            report = instrumentation.get_report()
+            no_requests.append(report["requests"][0]["count"])
+            new_countries.append(countries)
+            pipeline.close()
+        store.close()
+        assert new_countries[0] == new_countries[1]
+        assert len(new_countries[1]) > 0
+        # Without the store, the history is needed from the snapshots
+        assert no_requests == [5, 2]
+
+    def test_process_countries(self):
+        countries = [{"iso3": iso3} for iso3 in ("AGO", "BFA", "CAF", "COD", "ETH")]
+        with temp_dir(
+            "test_wfp_hungermaps_process",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as folder:
+            info = {"folder": folder, "batch": "1234"}
+
+            def process_country(countryiso3):
+                # finish out of order
+                sleep(0.01 * (5 - len(processed)))
+                processed.append(countryiso3)
+                return countryiso3
+
+            processed = []
+            results = list(process_countries(info, countries, process_country, 3))
+            assert results == ["AGO", "BFA", "CAF", "COD", "ETH"]
+            assert sorted(processed) == results
+
+            save_text("iso3=COD", join(folder, "progress.txt"))
+            processed = []
+            results = list(process_countries(info, countries, process_country, 3))
+            assert results == ["COD", "ETH"]
+            assert load_text(join(folder, "progress.txt")) == "iso3=ETH"
+
+            # A process stage and a thread stage after the first
+            save_text("iso3=BFA", join(folder, "progress.txt"))
+            processed = []
+            uploaded = []
+
+            def upload(countryiso3):
+                sleep(0.01 * (3 - len(uploaded)))
+                uploaded.append(countryiso3)
+                return countryiso3
+
+            stages = ((str.lower, 2, True), (upload, 2, False))
+            results = list(
+                process_countries(info, countries, process_country, 2, stages)
+            )
+            assert results == ["bfa", "caf", "cod", "eth"]
+            assert sorted(uploaded) == results
+            assert load_text(join(folder, "progress.txt")) == "iso3=ETH"
+
+            # A failed upload leaves progress at that country for the next run
+            save_text("iso3=AGO", join(folder, "progress.txt"))
+            processed = []
+            uploaded = []
+
+            def failing_upload(countryiso3):
+                if countryiso3 == "caf":
+                    raise ValueError(countryiso3)
+                return upload(countryiso3)
+
+            stages = ((str.lower, 2, False), (failing_upload, 2, False))
+            results = process_countries(info, countries, process_country, 3, stages)
+            with pytest.raises(ValueError):
+                for result in results:
+                    assert result in ("ago", "bfa")
+            assert load_text(join(folder, "progress.txt")) == "iso3=CAF"
+
+    def test_response_cache(self):
+        class Downloader:
+            def __init__(self):
+                self.urls = []
+                self.headers = {}
+
+            def get_header(self, header):
+                return self.headers.get(header)
+
+        class Retriever:
+            save = False
+
+            def __init__(self):
+                self.downloader = Downloader()
+
+            def download_json(self, url):
+                self.downloader.urls.append(url)
+                return {"statusCode": "200", "body": url}
+
+        with temp_dir(
+            "test_wfp_hungermaps_cache",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as folder:
+            today = parse_date("2023-12-05")
+            retriever = Retriever()
+            country_url = "https://api.hungermapdata.org/v1/foodsecurity/country"
+            closed_url = (
+                f"{country_url}/COD/region?date_start=2023-10-05&date_end=2023-11-04"
+            )
+            open_url = (
+                f"{country_url}/COD/region?date_start=2023-11-05&date_end=2023-12-04"
+            )
+            cache = ResponseCache(folder, today)
+            for _ in range(2):
+                cache.download_json(closed_url, retriever)
+                cache.download_json(open_url, retriever)
+                cache.download_json(f"{country_url}?days_ago=40", retriever)
+            assert retriever.downloader.urls == [
+                closed_url,
+                open_url,
+                f"{country_url}?days_ago=40",
+                open_url,
+            ]
+            cache.close()
+
+            # days_ago is keyed by date so the snapshot is reused the next day
+            cache = ResponseCache(folder, parse_date("2023-12-06"))
+            rjson = cache.download_json(f"{country_url}?days_ago=41", retriever)
+            assert rjson["body"] == f"{country_url}?days_ago=40"
+            statistics = cache.get_statistics()
+            assert statistics["hits"] == 1
+            assert statistics["misses"] == 0
+
+            # evict least recently used when over maximum size
+            cache.max_size = statistics["bytes"] - 1
+            cache.download_json(closed_url, retriever)
+            cache.evict()
+            assert cache.get_statistics()["entries"] == 2
+            cache.close()
+
+            # A snapshot or window fetched while open is not kept as closed
+            # once its month has ended
+            retriever.downloader.urls = []
+            cache = ResponseCache(folder, parse_date("2023-11-30T10:00:00Z"))
+            cache.download_json(f"{country_url}?days_ago=0", retriever)
+            cache.download_json(open_url, retriever)
+            cache.close()
+            # On the 1st of the month, yesterday's snapshot is within the grace
+            # period for late data so is not closed unlike an older one
+            cache = ResponseCache(folder, parse_date("2023-12-01T10:00:00Z"))
+            cache.download_json(f"{country_url}?days_ago=1", retriever)
+            cache.download_json(f"{country_url}?days_ago=10", retriever)
+            cache.download_json(open_url, retriever)
+            cache.close()
+            cache = ResponseCache(folder, parse_date("2024-01-02"))
+            cache.download_json(f"{country_url}?days_ago=33", retriever)
+            cache.download_json(f"{country_url}?days_ago=42", retriever)
+            cache.download_json(open_url, retriever)
+            assert retriever.downloader.urls == [
+                f"{country_url}?days_ago=0",
+                open_url,
+                f"{country_url}?days_ago=1",
+                f"{country_url}?days_ago=10",
+                open_url,
+                f"{country_url}?days_ago=33",
+                open_url,
+            ]
+            # Only the snapshot of 2023-11-21 was closed when fetched
+            assert cache.get_statistics()["hits"] == 1
+
+            # The index is saved as entries are added, not only on closing
+            cache.index_save_interval = 1
+            cache.download_json(f"{country_url}?days_ago=50", retriever)
+            entries = cache.get_statistics()["entries"]
+            assert ResponseCache(folder, today).get_statistics()["entries"] == entries
+            cache.close()
+
+    def test_get_rows_incremental(
+        self, configuration, retriever, folder, today, pipeline
     ):
+        expected = pipeline.get_rows("COD", max_months_ago=5)
+        pipeline.generate_dataset_and_showcase("COD", *expected)
+        pipeline.close()
+
+        pipeline = Pipeline(configuration, retriever, folder, today)
+        state_dict = {"DEFAULT": parse_date("2022-01-01")}
+        pipeline.get_country_data(state_dict, max_days_ago=5)
+        downloads = []
+        iterate_records = pipeline.fetcher.iterate_records
+
+        def fetch(url):
+            downloads.append(url)
+            return iterate_records(url)
+
+        pipeline.fetcher.iterate_records = fetch
+        result = pipeline.get_rows("COD", max_months_ago=5, incremental=True)
+        # Rows from the previous CSV do not have the columns that are
+        # not written out
+        assert list(result[0].iterate_rows()) == list(expected[0].iterate_rows())
+        assert result[1:] == expected[1:]
+        assert len(downloads) == 1
+        pipeline.close()
+
+    def test_iterate_records(self, input_folder):
+        path = join(
+            input_folder, "cod-region-date-start-2023-07-05-date-end-2023-08-04.json"
+        )
+        with open(path, "rb") as f:
+            records = list(iterate_records(f, path))
+        with open(path, encoding="utf-8") as f:
+            assert records == json.load(f)["body"]
+        with pytest.raises(DownloadError):
+            list(iterate_records(BytesIO(b'{"statusCode": "500", "body": []}'), ""))
+        with pytest.raises(DownloadError):
+            list(iterate_records(BytesIO(b'{"body": [{"a": 1}]}'), ""))
+
+    def test_observation(self, input_folder):
+        path = join(
+            input_folder, "cod-region-date-start-2023-07-05-date-end-2023-08-04.json"
+        )
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)["body"][0]
+        observation = Observation.from_api(
+            "COD", "Democratic Republic of the Congo", data, data["region"]
+        )
+        assert observation.get_values() == (
+            "COD",
+            "Democratic Republic of the Congo",
+            "Kasaï-Oriental",
+            "subnational",
+            5602792,
+            "2023-07-05",
+            "SURVEY",
+            3144757,
+            0.5612839098792174,
+            2421179,
+            0.43213794122644567,
+            3417041,
+            0.8955217339798114,
+            2818568,
+            0.5030649004996081,
+            4005799,
+            0.714965503949282,
+        )
+        # Not written to the CSVs but kept
+        assert observation.livelihood_coping_people == 4005799
+        assert observation.livelihood_coping_prevalence == 0.714965503949282
+        assert not hasattr(observation, "__dict__")
+        del data["metrics"]["livelihoodCoping"]
+        observation = Observation.from_api("COD", "Congo", data)
+        assert observation.adminlevel == "national"
+        assert observation.livelihood_coping_people == ""
+
+    def test_write_country_processes(self, pipeline, folder, today, fixtures):
+        countryiso3s = ["COD", "AGO"]
+        # A country without rows too
+        countries = [
+            ("COD", *pipeline.get_rows("COD", max_months_ago=5)),
+            ("AGO", Table(hxltags), today, today, False),
+        ]
+        previous_folder = join(folder, "previous")
+        write_stage = partial(write_country, folder, previous_folder, False)
+        results = list(Fetcher.imap(write_stage, countries, 2, True))
+        assert [result[0] for result in results] == countryiso3s
+        (
+            countryiso3,
+            write_results,
+            earliest_date,
+            latest_date,
+            has_subnational,
+            seconds,
+        ) = results[0]
+        assert write_results == {"wide rows": 3619, "long rows": 18090}
+        assert seconds > 0
+        dataset, _, bites_disabled = pipeline.generate_dataset_and_showcase(
+            countryiso3,
+            None,
+            earliest_date,
+            latest_date,
+            has_subnational,
+            write_results,
+        )
+        assert dataset["dataset_date"] == (
+            "[2023-07-05T00:00:00 TO 2023-11-20T23:59:59]"
+        )
+        assert bites_disabled == (False, False, False)
+        # Same files as when written in the main process
+        for filename in (
+            "wfp-hungermap-data-for-cod.csv",
+            "wfp-hungermap-data-for-cod-long.csv",
+        ):
+            assert_files_same(join(fixtures, filename), join(folder, filename))
+            assert_files_same(join(fixtures, filename), join(previous_folder, filename))
+        assert results[1][1] == {"wide rows": 0, "long rows": 0}
+        assert exists(join(folder, "wfp-hungermap-data-for-ago.csv"))
+
+    def test_country_summary(self, pipeline, folder):
+        rows, earliest_date, latest_date, has_subnational = pipeline.get_rows(
+            "COD", max_months_ago=5
+        )
+        summary = pipeline.summaries["COD"]
+        assert summary.get_no_rows() == rows.get_no_data_rows()
+        assert summary.no_rows == {"national": 5, "subnational": 3614}
+        assert summary.get_time_period() == (earliest_date, latest_date)
+        assert summary.has_subnational() is has_subnational
+        # Same as the first row with the latest date in the CSVs
+        dates = rows.columns["date"]
+        row = rows.get_row(dates.index(max(dates)))
+        expected = {header: row[header] for header in hxltags}
+        assert summary.get_latest_row() == expected
+        assert summary.get_bites_disabled() == (False, False, False)
+        # Independent of the order rows are added in
+        assert CountrySummary.from_table("COD", rows).to_dict() == (summary.to_dict())
+
+        _, _, bites_disabled = pipeline.generate_dataset_and_showcase(
+            "COD", rows, earliest_date, latest_date, has_subnational
+        )
+        assert bites_disabled == (False, False, False)
+        path = join(folder, "summaries", "country_summaries.json")
+        summaries = pipeline.write_summaries(path)
+        with open(path, encoding="utf-8") as f:
+            assert json.load(f) == summaries
+        cod = summaries["COD"]
+        assert cod["earliest date"] == "2023-07-05"
+        assert cod["latest date"] == "2023-11-20"
+        assert cod["latest rows"]["national"]["date"] == "2023-10-13"
+        assert cod["latest rows"]["subnational"]["date"] == "2023-11-20"
+        # Indicators with people are the rows of the long CSV
+        no_long_rows = sum(
+            indicator["people"] for indicator in cod["indicators"].values()
+        )
+        long_path = join(folder, "wfp-hungermap-data-for-cod-long.csv")
+        with open(long_path, encoding="utf-8") as f:
+            assert no_long_rows == len(f.readlines()) - 2
+
+        summary = CountrySummary("AFG")
+        assert summary.get_latest_row() == {}
+        assert summary.get_bites_disabled() == (True, True, True)
+        assert summary.has_subnational() is False
+
+    def test_parse_iso_date(self):
+        for date_str in ("2023-10-13", "2023-10-13T12:30:00", "13/10/2023"):
+            assert parse_iso_date(date_str) == parse_date(date_str)
+        hits = get_cache_statistics()["hits"]
+        parse_iso_date("2023-10-13")
+        assert get_cache_statistics()["hits"] == hits + 1
+
+    def test_instrumentation(self, configuration, retriever, folder, today, state_dict):
+        instrumentation = Instrumentation()
+        pipeline = Pipeline(
+            configuration, retriever, folder, today, None, instrumentation
+        )
+        with instrumentation.stage("national"):
+            pipeline.get_country_data(state_dict, max_days_ago=5)
+        with instrumentation.stage("subnational", "COD"):
+            rows, earliest_date, latest_date, has_subnational = pipeline.get_rows(
+                "COD", max_months_ago=5
+            )
+        pipeline.generate_dataset_and_showcase(
+            "COD", rows, earliest_date, latest_date, has_subnational
+        )
+        report = instrumentation.write_report(folder)
+        requests = {request["url class"]: request for request in report["requests"]}
+        assert requests["national"]["count"] == 5
+        assert requests["national"]["source"] == "saved"
+        assert requests["national"]["latency buckets"]["+Inf"] == 5
+        assert requests["subnational"]["count"] == 5
+        assert requests["subnational"]["bytes"] > 0
+        assert report["stages"]["national"]["count"] == 1
+        assert "subnational" in report["countries"]["COD"]["stages"]
+        assert report["countries"]["COD"]["rows"]["wide"] == 3619
+        with open(join(folder, "instrumentation.json"), encoding="utf-8") as f:
+            assert json.load(f)["requests"] == report["requests"]
+        prometheus = load_text(join(folder, "instrumentation.prom"))
+        assert (
+            'hungermap_requests_total{url_class="subnational",source="saved"} 5'
+            in prometheus
+        )
+        assert 'hungermap_country_rows{country="COD",table="wide"} 3619' in (prometheus)
+
+    def test_state(self, configuration, retriever, folder, today):
+        state = state_str_to_dict("DEFAULT=2017-01-01,AFG=2019-01-01")
+        assert state == {
+            "dates": {
+                "DEFAULT": parse_date("2017-01-01"),
+                "AFG": parse_date("2019-01-01"),
+            },
+            "hashes": {},
+        }
+        state["hashes"]["AFG"] = "3f2a"
+        state_str = dict_to_state_str(state)
+        assert state_str == "DEFAULT=2017-01-01,AFG=2019-01-01;3f2a"
+        assert state_str_to_dict(state_str) == state
+        # A hash without a date, eg. from rebuilding, is kept with the DEFAULT date
+        state["hashes"]["COD"] = "9c1b"
+        state_str = dict_to_state_str(state)
+        assert state_str == "DEFAULT=2017-01-01,AFG=2019-01-01;3f2a,COD=2017-01-01;9c1b"
+        assert state_str_to_dict(state_str)["hashes"] == state["hashes"]
+
+        content_hashes = []
+        for _ in range(2):
+            pipeline = Pipeline(configuration, retriever, folder, today)
+            state_dict = {"DEFAULT": parse_date("2022-01-01")}
+            pipeline.get_country_data(state_dict, max_days_ago=5)
+            rows, earliest_date, latest_date, has_subnational = pipeline.get_rows(
+                "COD", max_months_ago=5
+            )
+            dataset, showcase, bites_disabled = pipeline.generate_dataset_and_showcase(
+                "COD", rows, earliest_date, latest_date, has_subnational
+            )
+            content_hashes.append(get_content_hash(dataset, showcase, bites_disabled))
+        # Same data gives the same hash
+        assert content_hashes[0] == content_hashes[1]
+        assert (
+            get_content_hash(dataset, showcase, (True, True, True))
+            != (content_hashes[0])
+        )
+        dataset["title"] = "Changed"
+        assert (
+            get_content_hash(dataset, showcase, bites_disabled) != (content_hashes[0])
+        )
+        dataset["title"] = showcase["title"].replace(" showcase", "")
+        assert (
+            get_content_hash(dataset, showcase, bites_disabled) == (content_hashes[0])
+        )
+        # An unchanged dataset is not created in HDX
+        created = []
+        dataset.create_in_hdx = lambda **kwargs: created.append(kwargs)
+        content_hash = get_content_hash(dataset, None, bites_disabled)
+        hashes = {"COD": content_hash}
+        instrumentation = Instrumentation()
+        assert not create_dataset(
+            "COD",
+            dataset,
+            None,
+            bites_disabled,
+            hashes,
+            "batch",
+            instrumentation,
+            True,
+        )
+        assert created == []
+        assert create_dataset(
+            "COD",
+            dataset,
+            None,
+            bites_disabled,
+            hashes,
+            "batch",
+            instrumentation,
+        )
+        assert len(created) == 1
+        assert hashes == {"COD": content_hash}
+        path = join(folder, "wfp-hungermap-data-for-cod-long.csv")
+        with open(path, "a", encoding="utf-8") as f:
+            f.write("\n")
+        assert (
+            get_content_hash(dataset, showcase, bites_disabled) != (content_hashes[0])
+        )
+
+    def test_store(self, configuration, retriever, folder, today, pipeline):
+        expected = pipeline.get_rows("COD", max_months_ago=5)
+
+        store = ObservationStore(join(folder, "store.sqlite"), record_hxltags)
+        pipeline = Pipeline(configuration, retriever, folder, today, store=store)
+        state_dict = {"DEFAULT": parse_date("2022-01-01")}
+        pipeline.get_country_data(state_dict, max_days_ago=5)
+        # Rows read back from the store are the same as in memory
+        assert pipeline.get_rows("COD", max_months_ago=5) == expected
+        assert store.get_countries() == ["COD"]
+        assert store.get_last_date("COD", "subnational") == "2023-11-20"
+        # Writing the same rows again does not duplicate them
+        rows = expected[0]
+        store.upsert(rows)
+        assert store.get_rows("COD", record_hxltags) == rows
+        # Metrics not written to the CSVs are kept in the store
+        livelihood_coping = rows.columns["livelihood coping prevalence"]
+        assert any(livelihood_coping)
+        rows = store.get_rows("COD", record_hxltags)
+        assert rows.columns["livelihood coping prevalence"] == livelihood_coping
+        assert "livelihood coping prevalence" not in rows.output_headers
+        # Stores made before a header was added get a column for it
+        path = join(folder, "old_store.sqlite")
+        ObservationStore(path, hxltags).close()
+        old_store = ObservationStore(path, record_hxltags)
+        assert old_store.upsert(rows) == rows.get_no_data_rows()
+        old_store.close()
+
+        # Incremental mode only requests windows newer than the store
+        pipeline = Pipeline(configuration, retriever, folder, today, store=store)
+        pipeline.countries_data["COD"] = []
+        pipeline.get_rows("COD", max_months_ago=5, incremental=True)
+        assert pipeline.instrumentation.get_report()["requests"][0]["count"] == 1
+        # Rebuilt without any requests
+        pipeline = Pipeline(configuration, retriever, folder, today, store=store)
+        assert pipeline.get_rows_from_store("COD", 5) == expected
+        assert pipeline.instrumentation.get_report()["requests"] == []
+        # A country whose rows are all older than the window is not
+        # rebuilt and would get no dataset
+        old_rows = Table(record_hxltags)
+        old_row = rows.get_row(0)
+        old_row.update({"countrycode": "AGO", "date": "2020-01-01"})
+        old_rows.append_dict(old_row)
+        store.upsert(old_rows)
+        assert store.get_countries() == ["AGO", "COD"]
+        assert pipeline.get_store_countries(5) == ["COD"]
+        assert pipeline.generate_dataset_and_showcase(
+            "AGO", *pipeline.get_rows_from_store("AGO", 5)
+        ) == (None, None, None)
+        store.close()
+
+    def test_backfill(self, configuration):
+        assert get_monthly_windows(
+            parse_date("2023-01-31"), parse_date("2023-04-15")
+        ) == [
+            (parse_date("2023-01-31"), parse_date("2023-02-27")),
+            (parse_date("2023-02-28"), parse_date("2023-03-30")),
+            (parse_date("2023-03-31"), parse_date("2023-04-15")),
+        ]
+        today = parse_date("2023-12-05")
+        synthetic_api = SyntheticAPI(today, ["COD"], no_regions=3)
         with temp_dir(
-            "test_wfp_hungermaps", delete_on_success=True, delete_on_failure=False
+            "test_wfp_hungermaps_backfill",
+            delete_on_success=True,
+            delete_on_failure=False,
         ) as folder:
+            with MockHungerMapServer(synthetic_api) as server:
+                mock_configuration = {
+                    **configuration,
+                    "country_url": f"{server.url}/v1/foodsecurity/country",
+                    "rate_limit": None,
+                }
+                with Download() as downloader:
+                    retriever = Retrieve(
+                        downloader, folder, folder, folder, False, False
+                    )
+                    store = ObservationStore(
+                        join(folder, "store.sqlite"), record_hxltags
+                    )
+                    pipeline = Pipeline(
+                        mock_configuration, retriever, folder, today, store=store
+                    )
+                    checkpoint_path = join(folder, "checkpoint.json")
+                    start_date = parse_date("2023-09-01")
+                    end_date = parse_date("2023-10-31")
+                    # Interrupted after the first national window
+                    backfill = Backfill(pipeline, checkpoint_path, 4)
+                    national_item = (
+                        "national/2023-09-01/2023-09-30",
+                        backfill.get_national_rows,
+                        (start_date, parse_date("2023-09-30"), None),
+                    )
+                    results = {"work items": 0, "resumed": 0, "failed": 0, "rows": 0}
+                    backfill.run_work_items([national_item], results)
+                    assert results["rows"] == 30
+                    assert server.statistics["requests"] == 30
+
+                    backfill = Backfill(pipeline, checkpoint_path, 4)
+                    results = backfill.run(start_date, end_date)
+                    assert results == {
+                        "work items": 4,
+                        "resumed": 1,
+                        "failed": 0,
+                        "rows": 31 + 3 * 61,
+                        "countries": ["COD"],
+                    }
+                    # 31 national snapshots and 2 subnational windows
+                    assert server.statistics["requests"] == 30 + 31 + 2
+                    assert not exists(checkpoint_path)
+                    rows, earliest_date, latest_date, has_subnational = (
+                        pipeline.get_rows_from_store("COD", 4)
+                    )
+                    assert rows.get_no_data_rows() == 61 + 3 * 61
+                    assert earliest_date == parse_date("2023-08-30")
+                    assert latest_date == parse_date("2023-10-31")
+                    assert has_subnational is True
+
+                    # Work items fetching national data for some countries
+                    # are not resumed by those for others
+                    backfill = Backfill(pipeline, checkpoint_path, 4)
+                    keys = []
+                    backfill.run_work_items = lambda work_items, results: keys.extend(
+                        work_item[0] for work_item in work_items
+                    )
+                    backfill.run(start_date, end_date, ["COD"])
+                    assert keys == [
+                        "national/COD/2023-09-01/2023-09-30",
+                        "national/COD/2023-10-01/2023-10-31",
+                        "subnational/COD/2023-09-01/2023-09-30",
+                        "subnational/COD/2023-10-01/2023-10-31",
+                    ]
+
+                    # Where snapshots have the same date, the newest one wins
+                    def download_json(url):
+                        days_ago = int(url.split("=")[-1])
+                        rjson = synthetic_api.get_national(0)
+                        for country in rjson["body"]["countries"]:
+                            country["metrics"]["fcs"]["people"] = days_ago
+                        return rjson
+
+                    pipeline.fetcher.download_json = download_json
+                    rows = backfill.get_national_rows(
+                        parse_date("2023-11-01"), parse_date("2023-11-03")
+                    )
+                    assert rows.columns["fcs people"] == [34, 33, 32]
+                    store.upsert(rows)
+                    rows = store.get_rows("COD", record_hxltags, "2023-12-03")
+                    assert rows.columns["fcs people"] == [32]
+
+                    # Also across work items when the older one finishes last
+                    backfill = Backfill(pipeline, checkpoint_path, 4)
+
+                    def get_national_rows(start_date, end_date, countryiso3s):
+                        if start_date.day == 1:
+                            sleep(0.2)
+                        return backfill.get_national_rows(
+                            start_date, end_date, countryiso3s
+                        )
+
+                    work_items = [
+                        (
+                            f"national/2023-11-0{day}",
+                            get_national_rows,
+                            (
+                                parse_date(f"2023-11-0{day}"),
+                                parse_date(f"2023-11-0{day}"),
+                                None,
+                            ),
+                        )
+                        for day in (1, 2)
+                    ]
+                    results = {"work items": 0, "resumed": 0, "failed": 0, "rows": 0}
+                    backfill.run_work_items(work_items, results)
+                    assert results["rows"] == 2
+                    rows = store.get_rows("COD", record_hxltags, "2023-12-03")
+                    assert rows.columns["fcs people"] == [33]
+                    pipeline.close()
+                    store.close()
+
+    def test_parquet(self, configuration, retriever, folder, today, state_dict):
+        pq = pytest.importorskip("pyarrow.parquet")
+        parquet_configuration = {**configuration, "parquet": True}
+        pipeline = Pipeline(parquet_configuration, retriever, folder, today)
+        pipeline.get_country_data(state_dict, max_days_ago=5)
+        rows, earliest_date, latest_date, has_subnational = pipeline.get_rows(
+            "COD", max_months_ago=5
+        )
+        dataset, _, _ = pipeline.generate_dataset_and_showcase(
+            "COD", rows, earliest_date, latest_date, has_subnational
+        )
+        resources = dataset.get_resources()
+        assert [resource["format"] for resource in resources] == [
+            "csv",
+            "csv",
+            "parquet",
+            "parquet",
+        ]
+        path = join(folder, "wfp-hungermap-data-for-cod.parquet")
+        parquet_file = pq.ParquetFile(path)
+        # national and subnational row groups
+        assert parquet_file.num_row_groups == 2
+        table = parquet_file.read()
+        assert table.num_rows == 3619
+        assert str(table.schema.field("adminone").type) == (
+            "dictionary<values=string, indices=int32, ordered=0>"
+        )
+        assert str(table.schema.field("date").type) == "date32[day]"
+        assert str(table.schema.field("fcs prevalence").type) == "double"
+        assert table.schema.field("date").metadata == {b"hxl": b"#date"}
+        assert table.column("fcs people").to_pylist() == [
+            value if value != "" else None for value in rows.columns["fcs people"]
+        ]
+        path = join(folder, "wfp-hungermap-data-for-cod-long.parquet")
+        table = pq.read_table(path)
+        long_rows = rows.melt(
+            long_hxltags,
+            long_id_headers,
+            long_indicators,
+        )
+        assert table.num_rows == long_rows.get_no_data_rows()
+        assert (
+            table.column("indicator name").to_pylist()
+            == (long_rows.columns["indicator name"])
+        )
+
+    def test_generate_global_dataset(self, pipeline, folder, fixtures):
+        validlocations = Locations.validlocations()
+        Locations.set_validlocations(
+            [*validlocations, {"name": "world", "title": "World"}]
+        )
+        rows, earliest_date, latest_date, has_subnational = pipeline.get_rows(
+            "COD", max_months_ago=5
+        )
+        pipeline.generate_dataset_and_showcase(
+            "COD", rows, earliest_date, latest_date, has_subnational
+        )
+        # No CSVs for AFG so there is no partial global dataset
+        assert pipeline.generate_global_dataset(["COD", "AFG"]) is None
+        dataset = pipeline.generate_global_dataset(["COD"])
+        assert dataset["name"] == "wfp-hungermap-global-data"
+        assert dataset["groups"] == [{"name": "world"}]
+        assert dataset["dataset_date"] == "[2023-07-05T00:00:00 TO 2023-11-20T23:59:59]"
+        assert [resource["name"] for resource in dataset.get_resources()] == [
+            "wfp-hungermap-global-data.csv",
+            "wfp-hungermap-global-data-long.csv",
+            "wfp-hungermap-global-data-latest.csv",
+        ]
+        for filename, expected_filename in (
+            ("wfp-hungermap-global-data.csv", "wfp-hungermap-data-for-cod.csv"),
+            (
+                "wfp-hungermap-global-data-long.csv",
+                "wfp-hungermap-data-for-cod-long.csv",
+            ),
+        ):
+            assert_files_same(join(fixtures, expected_filename), join(folder, filename))
+        summary = load_text(
+            join(folder, "wfp-hungermap-global-data-latest.csv")
+        ).splitlines()
+        assert len(summary) == 3
+        assert summary[0] == (
+            "countrycode,countryname,population,date,datatype,fcs people,"
+            "fcs prevalence,rcsi people,rcsi prevalence,health access people,"
+            "health access prevalence,market access people,"
+            "market access prevalence"
+        )
+        latest_row = rows.get_row(0)
+        assert summary[2].startswith(
+            f"COD,Democratic Republic of the Congo,,{latest_row['date']},"
+        )
+
+        # A country without national rows is not in the summary
+        lines = load_text(join(folder, "wfp-hungermap-data-for-cod.csv")).splitlines()
+        subnational_path = join(folder, "subnational.csv")
+        save_text(
+            "\n".join(
+                [
+                    *lines[:2],
+                    *(line for line in lines if ",subnational," in line),
+                ]
+            ),
+            subnational_path,
+        )
+        long_path = join(folder, "wfp-hungermap-data-for-cod-long.csv")
+        results = write_global(
+            [(subnational_path, long_path)],
+            join(folder, "global.csv"),
+            join(folder, "global-long.csv"),
+            join(folder, "global-latest.csv"),
+            summary_headers,
+        )
+        assert results["wide rows"] == 3614
+        assert results["summary rows"] == 0
+        Locations.set_validlocations(validlocations)
+
+    def test_mock_server(self, configuration):
+        today = parse_date("2023-12-05")
+        synthetic_api = SyntheticAPI(today, ["COD"], no_regions=3)
+        with temp_dir(
+            "test_wfp_hungermaps_mock_server",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as folder:
+            with MockHungerMapServer(synthetic_api) as server:
+                mock_configuration = {
+                    **configuration,
+                    "country_url": f"{server.url}/v1/foodsecurity/country",
+                    "rate_limit": None,
+                }
+                with Download() as downloader:
+                    retriever = Retrieve(
+                        downloader, folder, folder, folder, False, False
+                    )
+                    pipeline = Pipeline(mock_configuration, retriever, folder, today)
+                    state_dict = {"DEFAULT": parse_date("2022-01-01")}
+                    countries = pipeline.get_country_data(state_dict, max_days_ago=3)
+                    assert countries == [{"iso3": "COD"}]
+                    rows, earliest_date, latest_date, _ = pipeline.get_rows(
+                        "COD", max_months_ago=2
+                    )
+                    # 3 national rows and 3 regions for each day in 2 months
+                    assert rows.get_no_data_rows() == 3 + 3 * 61
+                    assert earliest_date == parse_date("2023-10-05")
+                    assert latest_date == parse_date("2023-12-04")
+                    pipeline.close()
+                assert server.statistics["requests"] == 5
+                assert server.statistics["bytes"] > 0
+
+            for fault in ("error_rate", "bad_status_rate", "rate_limit_rate"):
+                with MockHungerMapServer(synthetic_api, **{fault: 1}) as server:
+                    mock_configuration = {
+                        **configuration,
+                        "country_url": f"{server.url}/v1/foodsecurity/country",
+                        "rate_limit": None,
+                        "retry": None,
+                        "national_concurrency": 1,
+                    }
+                    # No retries so that each fault reaches the pipeline
+                    with Download(retry_attempts=0) as downloader:
+                        retriever = Retrieve(
+                            downloader, folder, folder, folder, False, False
+                        )
+                        pipeline = Pipeline(
+                            mock_configuration, retriever, folder, today
+                        )
+                        state_dict = {"DEFAULT": parse_date("2022-01-01")}
+                        assert (
+                            pipeline.get_country_data(state_dict, max_days_ago=2) == []
+                        )
+                        pipeline.close()
+
+    def test_stream_through_cache(self, configuration):
+        today = parse_date("2023-12-05")
+        synthetic_api = SyntheticAPI(today, ["COD"], no_regions=3)
+        with temp_dir(
+            "test_wfp_hungermaps_stream_cache",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as folder:
+            with MockHungerMapServer(synthetic_api) as server:
+                country_url = f"{server.url}/v1/foodsecurity/country"
+                closed_url = f"{country_url}/COD/region?date_start=2023-10-05&date_end=2023-11-04"
+                open_url = f"{country_url}/COD/region?date_start=2023-11-05&date_end=2023-12-04"
+                cache = ResponseCache(join(folder, "cache"), today)
+                # Responses are never loaded whole
+                cache.load = None
+                with Download() as downloader:
+                    retriever = Retrieve(
+                        downloader, folder, folder, folder, False, False
+                    )
+                    fetcher = Fetcher(retriever, cache=cache)
+                    records = list(fetcher.iterate_records(closed_url))
+                    assert len(records) == 3 * 31
+                    assert list(fetcher.iterate_records(closed_url)) == records
+                    assert server.statistics["requests"] == 1
+                    # A stream that is not read to the end is not cached
+                    stream = fetcher.iterate_records(open_url)
+                    next(stream)
+                    stream.close()
+                    assert len(list(fetcher.iterate_records(open_url))) == 3 * 30
+                    assert server.statistics["requests"] == 3
+                    fetcher.close()
+            statistics = cache.get_statistics()
+            assert statistics["hits"] == 1
+            assert statistics["misses"] == 3
+            assert statistics["entries"] == 2
+            key, _ = cache.get_key_and_end_date(closed_url)
+            with gzip.open(cache.get_path(key), "rb") as f:
+                assert list(iterate_records(f, closed_url)) == records
+            assert not glob(join(folder, "cache", "*.tmp"))
+
+    def test_fetch_only(self, configuration):
+        today = parse_date("2023-12-05")
+        synthetic_api = SyntheticAPI(today, ["AGO", "COD"], no_regions=3)
+        with temp_dir(
+            "test_wfp_hungermaps_fetch_only",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as folder:
+            with MockHungerMapServer(synthetic_api) as server:
+                # A plain dictionary as no HDX configuration is needed
+                fetch_configuration = {
+                    **configuration,
+                    "country_url": f"{server.url}/v1/foodsecurity/country",
+                    "rate_limit": None,
+                }
+                cache = ResponseCache(join(folder, "cache"), today)
+                failed_urls_path = join(cache.folder, "failed_urls.json")
+                save_text('["http://failed"]', failed_urls_path)
+                with Download() as downloader:
+                    retriever = Retrieve(
+                        downloader, folder, folder, folder, False, False
+                    )
+                    results = fetch_only(
+                        fetch_configuration,
+                        retriever,
+                        folder,
+                        today,
+                        ["COD"],
+                        workers=2,
+                        cache=cache,
+                        max_days_ago=3,
+                    )
+                cache.close()
+                # Left for the normal run to retry
+                assert load_text(failed_urls_path) == '["http://failed"]'
+            # 3 national rows and 3 regions for each day in 12 months
+            assert results == {"COD": {"wide rows": 3 + 3 * 365, "long rows": 5487}}
+            filename = "wfp-hungermap-data-for-cod.csv"
+            assert exists(join(folder, filename))
+            summaries = json.loads(load_text(join(folder, "country_summaries.json")))
+            assert list(summaries) == ["COD"]
+            assert summaries["COD"]["rows"] == {"national": 3, "subnational": 1095}
+            assert summaries["COD"]["latest date"] == "2023-12-04"
+
+    def test_lazy_imports(self):
+        # Only creating datasets in HDX needs the HDX client
+        code = (
+            "import sys\n"
+            "import hdx.scraper.wfp.hungermap.__main__\n"
+            "import hdx.scraper.wfp.hungermap.fetch_only\n"
+            "modules = ('hdx.api', 'hdx.data', 'ckanapi', 'hxl', 'hdx.location')\n"
+            "print([module for module in modules if module in sys.modules])\n"
+        )
+        env = dict(environ, PYTHONPATH=pathsep.join(sys.path))
+        output = subprocess.run(
+            [sys.executable, "-W", "ignore", "-c", code],
+            check=True,
+            capture_output=True,
+            env=env,
+            text=True,
+        ).stdout
+        assert output.strip() == "[]"
+
+    def test_get_country_name(self, configuration):
+        for countryiso3, countryname in get_country_names().items():
+            assert Country.get_country_name_from_iso3(countryiso3) == countryname
+        assert get_country_name("cod") == "Democratic Republic of the Congo"
+        # Not in the table so looked up in the country data
+        assert get_country_name("XYZ") is None
+
+    def test_stale_dataset_cleanup(self):
+        prefix = "wfp-hungermap-data-for-"
+        datasets = []
+        for i, countryiso3 in enumerate(("AFG", "COD", "MLI", "SYR", "YEM")):
+            datasets.append(
+                {
+                    "id": f"id-{i}",
+                    "name": f"{prefix}{countryiso3.lower()}",
+                    "organization": {"name": "wfp"},
+                    "groups": [{"name": countryiso3.lower()}],
+                }
+            )
+        # Other organisation or another prefix: never deleted
+        datasets.append(
+            {
+                "id": "id-other-org",
+                "name": f"{prefix}irq",
+                "organization": {"name": "other"},
+                "groups": [{"name": "irq"}],
+            }
+        )
+        datasets.append(
+            {
+                "id": "id-other-prefix",
+                "name": "wfp-food-prices-for-afg",
+                "organization": {"name": "wfp"},
+                "groups": [{"name": "afg"}],
+            }
+        )
+        with MockHDXServer(datasets) as server:
+            configuration = Configuration(
+                hdx_url=server.url, hdx_key="test", user_agent="test"
+            )
+            configuration.setup_session_remoteckan()
+            cleanup = StaleDatasetCleanup(
+                prefix, configuration=configuration, dry_run=True, page_size=2
+            )
+            index = cleanup.get_index()
+            assert sorted(index) == ["AFG", "COD", "MLI", "SYR", "YEM"]
+            # Searched a page at a time for only the fields needed
+            assert len(server.searches) == 3
+            search = server.searches[0]
+            assert search["q"] == f"name:{prefix}*"
+            assert search["fq"] == "organization:wfp"
+            assert search["fl"] == "id,name,groups"
+
+            report = cleanup.run(["COD", "SYR"])
+            assert report["checked"] == 5
+            assert report["stale countries"] == ["AFG", "MLI", "YEM"]
+            assert report["stale"] == [
+                f"{prefix}afg",
+                f"{prefix}mli",
+                f"{prefix}yem",
+            ]
+            assert report["deleted"] == []
+            assert report["deleted countries"] == []
+            assert report["dry run"] is True
+            assert server.deleted == []
+
+            cleanup = StaleDatasetCleanup(
+                prefix, configuration=configuration, workers=3, page_size=2
+            )
+            report = cleanup.run(["COD", "SYR"])
+            assert sorted(report["deleted"]) == report["stale"]
+            assert report["failed"] == []
+            assert report["deleted countries"] == ["AFG", "MLI", "YEM"]
+            assert sorted(server.deleted) == report["stale"]
+            assert sorted(server.datasets) == [
+                "id-1",
+                "id-3",
+                "id-other-org",
+                "id-other-prefix",
+            ]
+            assert cleanup.run(["COD", "SYR"])["stale"] == []
+
+    def test_get_rows_planned(self, configuration, input_folder, fixtures):
+        # The planned windows are made from the records of the saved monthly
+        # windows. The API would also return records from 2023-07-01 to
+        # 2023-07-04 as planned windows start at the start of a month.
+        records = []
+        for path in sorted(glob(join(input_folder, "cod-region-*.json"))):
+            records.extend(json.loads(load_text(path))["body"])
+        with temp_dir(
+            "test_wfp_hungermaps_rows_planned",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as folder:
+            planned_folder = join(folder, "input")
+            makedirs(planned_folder)
+            for path in glob(join(input_folder, "foodsecurity-country-*.json")):
+                copy2(path, planned_folder)
+            for start_date, end_date in (
+                ("2023-12-01", "2023-12-04"),
+                ("2023-10-01", "2023-11-30"),
+                ("2023-07-01", "2023-09-30"),
+            ):
+                body = [
+                    record
+                    for record in records
+                    if start_date <= record["date"][:10] <= end_date
+                ]
+                save_json(
+                    {"statusCode": "200", "body": body},
+                    join(
+                        planned_folder,
+                        f"cod-region-date-start-{start_date}-date-end-{end_date}.json",
+                    ),
+                )
+            planned_configuration = {
+                **configuration,
+                "range_planner": {**configuration["range_planner"], "enabled": True},
+            }
             with Download() as downloader:
                 retriever = Retrieve(
-                    downloader, folder, input_folder, folder, False, True
+                    downloader, folder, planned_folder, folder, False, True
                 )
                 today = parse_date("2023-12-05")
-                pipeline = Pipeline(configuration, retriever, folder, today)
+                pipeline = Pipeline(planned_configuration, retriever, folder, today)
                 state_dict = {"DEFAULT": parse_date("2022-01-01")}
-                countries = pipeline.get_country_data(state_dict, max_days_ago=5)
-                assert len(countries) == 35
+                pipeline.get_country_data(state_dict, max_days_ago=5)
+                rows, _, _, _ = pipeline.get_rows("COD", max_months_ago=5)
+                assert [
+                    (request["start"], request["end"], request["status"])
+                    for request in pipeline.plans["COD"]
+                ] == [
+                    ("2023-12-01", "2023-12-04", "ok"),
+                    ("2023-10-01", "2023-11-30", "ok"),
+                    ("2023-07-01", "2023-09-30", "ok"),
+                ]
+                pipeline.close()
+                write_country_files(folder, None, "wfp-hungermap-data-for-cod", rows)
+                # Same files as with monthly windows relative to today
+                for filename in (
+                    "wfp-hungermap-data-for-cod.csv",
+                    "wfp-hungermap-data-for-cod-long.csv",
+                ):
+                    assert_files_same(join(fixtures, filename), join(folder, filename))
 
-                rows, earliest_date, latest_date, has_subnational = pipeline.get_rows(
-                    "COD", max_months_ago=5
-                )
-                assert len(rows) == 3620
-                assert earliest_date == parse_date("2023-07-05")
-                assert latest_date == parse_date("2023-11-20")
-
-                (
-                    dataset,
-                    showcase,
-                    bites_disabled,
-                ) = pipeline.generate_dataset_and_showcase(
-                    "COD", rows, earliest_date, latest_date, has_subnational
-                )
-                assert has_subnational is True
-                assert dataset == {
-                    "data_update_frequency": "-2",
-                    "dataset_date": "[2023-07-05T00:00:00 TO 2023-11-20T23:59:59]",
-                    "groups": [{"name": "cod"}],
-                    "maintainer": "196196be-6037-4488-8b71-d786adf4c081",
-                    "name": "wfp-hungermap-data-for-cod",
-                    "owner_org": "3ecac442-7fed-448d-8f78-b385ef6f84e7",
-                    "subnational": "1",
-                    "tags": [
-                        {
-                            "name": "hxl",
-                            "vocabulary_id": "4e61d464-4943-4e97-973a-84673c1aaa87",
-                        },
-                        {
-                            "name": "indicators",
-                            "vocabulary_id": "4e61d464-4943-4e97-973a-84673c1aaa87",
-                        },
-                        {
-                            "name": "food security",
-                            "vocabulary_id": "4e61d464-4943-4e97-973a-84673c1aaa87",
-                        },
-                    ],
-                    "title": "Democratic Republic of the Congo - HungerMap data",
+    def test_range_planner(self, configuration):
+        def get_dates(windows):
+            return [
+                (start_date.date().isoformat(), end_date.date().isoformat())
+                for start_date, end_date in windows
+            ]
+
+        planner = RangePlanner(3)
+        windows = planner.plan(parse_date("2023-07-05"), parse_date("2023-12-04"))
+        # Incomplete month alone, then complete months in calendar quarters
+        assert get_dates(windows) == [
+            ("2023-12-01", "2023-12-04"),
+            ("2023-10-01", "2023-11-30"),
+            ("2023-07-01", "2023-09-30"),
+        ]
+        # The same past windows are planned on later days
+        windows = planner.plan(parse_date("2023-07-20"), parse_date("2023-12-19"))
+        assert get_dates(windows)[1:] == [
+            ("2023-10-01", "2023-11-30"),
+            ("2023-07-01", "2023-09-30"),
+        ]
+        windows = planner.plan(parse_date("2023-05-05"), parse_date("2023-11-30"), 1)
+        assert len(windows) == 7
+        assert get_dates(windows)[0] == ("2023-11-01", "2023-11-30")
+        assert get_dates(planner.split(windows[0])) == [
+            ("2023-11-16", "2023-11-30"),
+            ("2023-11-01", "2023-11-15"),
+        ]
+        assert get_dates(
+            planner.split((parse_date("2023-07-01"), parse_date("2023-09-30")))
+        ) == [("2023-08-01", "2023-09-30"), ("2023-07-01", "2023-07-31")]
+        assert (
+            planner.split((parse_date("2023-12-01"), parse_date("2023-12-04"))) is None
+        )
+
+        today = parse_date("2023-12-05")
+        synthetic_api = SyntheticAPI(today, ["COD"], no_regions=3)
+
+        def get_rows(planner_configuration, **kwargs):
+            with MockHungerMapServer(synthetic_api, **kwargs) as server:
+                mock_configuration = {
+                    **configuration,
+                    "country_url": f"{server.url}/v1/foodsecurity/country",
+                    "rate_limit": None,
+                    "retry": None,
+                    "range_planner": planner_configuration,
                 }
-                resources = dataset.get_resources()
-                assert resources == [
-                    {
-                        "description": "Democratic Republic of the Congo - HungerMap data",
-                        "format": "csv",
-                        "name": "wfp-hungermap-data-for-cod.csv",
-                    },
-                    {
-                        "description": "Democratic Republic of the Congo - HungerMap data long "
-                        "format",
-                        "format": "csv",
-                        "name": "wfp-hungermap-data-for-cod-long.csv",
+                with Download(retry_attempts=0) as downloader:
+                    retriever = Retrieve(
+                        downloader, folder, folder, folder, False, False
+                    )
+                    pipeline = Pipeline(mock_configuration, retriever, folder, today)
+                    state_dict = {"DEFAULT": parse_date("2022-01-01")}
+                    pipeline.get_country_data(state_dict, max_days_ago=1)
+                    rows, earliest_date, _, _ = pipeline.get_rows(
+                        "COD", max_months_ago=5
+                    )
+                    pipeline.close()
+            requests = [
+                (request["start"], request["end"], request["status"])
+                for request in pipeline.plans.get("COD", [])
+            ]
+            statistics = {
+                **server.statistics,
+                "failed urls": len(pipeline.fetcher.failed_urls),
+            }
+            return rows, earliest_date, requests, statistics
+
+        with temp_dir(
+            "test_wfp_hungermaps_range_planner",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as folder:
+            rows, earliest_date, requests, _ = get_rows(None)
+            assert requests == []
+            assert earliest_date == parse_date("2023-07-05")
+            no_rows = rows.get_no_data_rows()
+
+            planner_configuration = {"enabled": True, "max_months": 3}
+            planned_rows, earliest_date, requests, _ = get_rows(planner_configuration)
+            assert requests == [
+                ("2023-12-01", "2023-12-04", "ok"),
+                ("2023-10-01", "2023-11-30", "ok"),
+                ("2023-07-01", "2023-09-30", "ok"),
+            ]
+            # Whole of first month: 4 more days of 3 regions
+            assert earliest_date == parse_date("2023-07-01")
+            assert planned_rows.get_no_data_rows() == no_rows + 3 * 4
+
+            # Ranges longer than a month fail so are split
+            rows, _, requests, statistics = get_rows(
+                planner_configuration, max_range_days=31
+            )
+            assert requests == [
+                ("2023-12-01", "2023-12-04", "ok"),
+                ("2023-10-01", "2023-11-30", "split"),
+                ("2023-11-01", "2023-11-30", "ok"),
+                ("2023-10-01", "2023-10-31", "ok"),
+                ("2023-07-01", "2023-09-30", "split"),
+                ("2023-08-01", "2023-09-30", "split"),
+                ("2023-09-01", "2023-09-30", "ok"),
+                ("2023-08-01", "2023-08-31", "ok"),
+                ("2023-07-01", "2023-07-31", "ok"),
+            ]
+            assert statistics["too large"] == 3
+            # Split windows are not retried next run
+            assert statistics["failed urls"] == 0
+            assert rows == planned_rows
+
+            # Large responses make later windows smaller
+            planner_configuration["max_records"] = 100
+            rows, _, requests, _ = get_rows(planner_configuration)
+            assert requests == [
+                ("2023-12-01", "2023-12-04", "ok"),
+                ("2023-10-01", "2023-11-30", "ok"),
+                ("2023-09-01", "2023-09-30", "ok"),
+                ("2023-08-01", "2023-08-31", "ok"),
+                ("2023-07-01", "2023-07-31", "ok"),
+            ]
+            assert rows == planned_rows
+
+    def test_throttle_and_backoff(self):
+        throttle = AdaptiveThrottle(1, 0.1, 5, 20, target_latency=1)
+        assert throttle.rate == 10
+        throttle.on_success(0.1)
+        assert throttle.rate == pytest.approx(10.15)
+        throttle.on_success(2)
+        assert throttle.rate == pytest.approx(9.135)
+        throttle.on_error()
+        assert throttle.rate == pytest.approx(6.85125)
+        throttle.on_throttled()
+        assert throttle.rate == 5
+        for _ in range(200):
+            throttle.on_success(0.1)
+        assert throttle.rate == 20
+        # Without min and max rate, the rate is fixed
+        throttle = AdaptiveThrottle(1, 0.1)
+        throttle.on_error()
+        throttle.on_success(0.1)
+        assert throttle.rate == 10
+
+        backoff = Backoff(5, 1, 10, seed=1)
+        for attempt in range(1, 10):
+            delay = backoff.get_delay(attempt)
+            assert 0 <= delay <= min(10, 2 ** (attempt - 1))
+        assert backoff.get_delay(1, retry_after=30) == 30
+
+    def test_retry(self, configuration):
+        today = parse_date("2023-12-05")
+        synthetic_api = SyntheticAPI(today, ["COD"], no_regions=3)
+        with temp_dir(
+            "test_wfp_hungermaps_retry",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as folder:
+            retry = {"attempts": 10, "base_delay": 0.01, "max_delay": 0.05}
+            with MockHungerMapServer(
+                synthetic_api,
+                error_rate=0.25,
+                rate_limit_rate=0.25,
+                retry_after=0,
+                seed=3,
+            ) as server:
+                mock_configuration = {
+                    **configuration,
+                    "country_url": f"{server.url}/v1/foodsecurity/country",
+                    "rate_limit": {
+                        "calls": 20,
+                        "period": 1,
+                        "min_rate": 10,
+                        "max_rate": 50,
                     },
-                ]
-                for resource in resources:
-                    filename = resource["name"]
-                    expected_path = join(fixtures, filename)
-                    actual_path = join(folder, filename)
-                    assert_files_same(expected_path, actual_path)
-
-                assert showcase == {
-                    "image_url": "https://www.wfp.org/sites/default/files/2020-11/migrated-story-hero-images/1%2AwHonqWsryfHjnj3FRQS_xA.png",
-                    "name": "wfp-hungermap-data-for-cod-showcase",
-                    "notes": "HungerMap LIVE",
-                    "tags": [
-                        {
-                            "name": "hxl",
-                            "vocabulary_id": "4e61d464-4943-4e97-973a-84673c1aaa87",
-                        },
-                        {
-                            "name": "indicators",
-                            "vocabulary_id": "4e61d464-4943-4e97-973a-84673c1aaa87",
-                        },
-                        {
-                            "name": "food security",
-                            "vocabulary_id": "4e61d464-4943-4e97-973a-84673c1aaa87",
-                        },
-                    ],
-                    "title": "Democratic Republic of the Congo - HungerMap data showcase",
-                    "url": "https://hungermap.wfp.org/",
+                    "retry": retry,
                 }
+                with Download(retry_attempts=0, status_forcelist=()) as downloader:
+                    retriever = Retrieve(
+                        downloader, folder, folder, folder, False, False
+                    )
+                    pipeline = Pipeline(mock_configuration, retriever, folder, today)
+                    state_dict = {"DEFAULT": parse_date("2022-01-01")}
+                    countries = pipeline.get_country_data(state_dict, max_days_ago=3)
+                    assert countries == [{"iso3": "COD"}]
+                    rows, _, _, _ = pipeline.get_rows("COD", max_months_ago=2)
+                    # Every request eventually succeeds so nothing is lost
+                    assert rows.get_no_data_rows() == 3 + 3 * 61
+                    assert pipeline.fetcher.failed_urls == set()
+                    pipeline.close()
+                assert server.statistics["errors"] > 0
+                assert server.statistics["rate limited"] > 0
 
-                assert bites_disabled == (False, False, False)
-
-                assert state_dict == {
-                    "AGO": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "BEN": datetime(2022, 1, 11, 0, 0, tzinfo=timezone.utc),
-                    "BFA": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "CAF": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "CIV": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "CMR": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "COD": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "COG": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "COL": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "DEFAULT": datetime(2022, 1, 1, 0, 0, tzinfo=timezone.utc),
-                    "ETH": datetime(2023, 6, 12, 0, 0, tzinfo=timezone.utc),
-                    "GIN": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "GTM": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "HND": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "HTI": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "IRQ": datetime(2023, 5, 7, 0, 0, tzinfo=timezone.utc),
-                    "KEN": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "LAO": datetime(2023, 7, 26, 0, 0, tzinfo=timezone.utc),
-                    "MDG": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "MLI": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "MOZ": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "MRT": datetime(2023, 7, 13, 0, 0, tzinfo=timezone.utc),
-                    "MWI": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "NAM": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "NER": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "NGA": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "SLE": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "SLV": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "SOM": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "SYR": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "TCD": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "TZA": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "UKR": datetime(2023, 9, 3, 0, 0, tzinfo=timezone.utc),
-                    "YEM": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "ZMB": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
-                    "ZWE": datetime(2023, 10, 13, 0, 0, tzinfo=timezone.utc),
+            retry = {"attempts": 2, "base_delay": 0.01, "max_delay": 0.05}
+            cache = ResponseCache(join(folder, "cache"), today)
+            with MockHungerMapServer(synthetic_api, error_rate=1) as server:
+                country_url = f"{server.url}/v1/foodsecurity/country"
+                mock_configuration = {
+                    **configuration,
+                    "country_url": country_url,
+                    "retry": retry,
                 }
+                with Download(retry_attempts=0, status_forcelist=()) as downloader:
+                    retriever = Retrieve(
+                        downloader, folder, folder, folder, False, False
+                    )
+                    pipeline = Pipeline(
+                        mock_configuration, retriever, folder, today, cache
+                    )
+                    state_dict = {"DEFAULT": parse_date("2022-01-01")}
+                    # The national walk carries on after failures
+                    assert pipeline.get_country_data(state_dict, max_days_ago=3) == []
+                    pipeline.countries_data["COD"] = []
+                    rows, _, _, has_subnational = pipeline.get_rows(
+                        "COD", max_months_ago=1
+                    )
+                    assert has_subnational is False
+                    pipeline.close()
+                # Each URL is attempted twice
+                assert server.statistics["requests"] == 8
+            subnational_url = (
+                f"{country_url}/COD/region?date_start=2023-11-05&date_end=2023-12-04"
+            )
+            assert sorted(pipeline.fetcher.failed_urls) == [
+                subnational_url,
+                f"{country_url}?days_ago=0",
+                f"{country_url}?days_ago=1",
+                f"{country_url}?days_ago=2",
+            ]
+            # The next run refetches windows whose requests failed and walks
+            # back through every national snapshot
+            pipeline = Pipeline(configuration, retriever, folder, today, cache)
+            assert pipeline.failed_start_dates == {"COD": parse_date("2023-11-05")}
+            assert pipeline.national_failed is True
+
+            # Requests failing with other HTTP errors are not retried but are
+            # requested again in the next run
+            class Downloader:
+                response = SimpleNamespace(status_code=404)
+
+            def not_found():
+                calls.append(subnational_url)
+                raise DownloadError("Not found")
+
+            calls = []
+            with pytest.raises(DownloadError):
+                pipeline.fetcher.call_with_retry(
+                    subnational_url, Downloader(), not_found
+                )
+            assert calls == [subnational_url]
+            assert pipeline.fetcher.failed_urls == {subnational_url}
+            pipeline.close()
+            pipeline = Pipeline(configuration, retriever, folder, today, cache)
+            assert pipeline.failed_start_dates == {"COD": parse_date("2023-11-05")}
+            assert pipeline.national_failed is False
+            cache.close()